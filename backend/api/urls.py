@@ -1,9 +1,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AgentViewSet
+from .views import AgentViewSet, SalesCoachViewSet
 
 router = DefaultRouter()
 router.register(r'agent', AgentViewSet, basename='agent')
+router.register(r'sales-coach', SalesCoachViewSet, basename='sales-coach')
 
 urlpatterns = [
     path('', include(router.urls)),
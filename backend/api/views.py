@@ -2,120 +2,257 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from core.agents import AIAgent
-from core.models import (
-    Organization, Usage, EmailThread, EmailInteraction,
-    InfrastructureComponent, CloudResource, ResourceMetric
-)
+from core.agents import get_agent
+from core.views import AsyncJobMixin
+from core.models import Organization, EmailBacklog, InfrastructureComponent, CloudResource
+from core.classifier import classifier_stats
+from core.services import classify_email_batch, health_window
+from core.ingest import ingest_samples, parse_csv, parse_ndjson, parse_remote_write
+from core.router import routing
+from core.timeseries import query_metrics
+from core.usage import metered, record_usage, usage_summary, parse_timeframe
 from django.conf import settings
-import pandas as pd
-from datetime import datetime, timedelta
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import json
+import os
+import uuid
 
-class AgentViewSet(viewsets.ViewSet):
+class AgentViewSet(AsyncJobMixin, viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.agent = AIAgent(
-            api_key=settings.OPENAI_API_KEY,
-            prometheus_url=settings.DEVOPS_SETTINGS.get('prometheus_url')
-        )
+        self.agent = get_agent()
 
     @action(detail=False, methods=['post'])
     def process_email(self, request):
-        email_content = request.data.get('email_content')
-        subject = request.data.get('subject')
-        sender_email = request.data.get('sender_email')
+        return self.dispatch_job(request, 'email', {
+            'email_content': request.data.get('email_content'),
+            'subject': request.data.get('subject'),
+            'sender_email': request.data.get('sender_email'),
+            'message_id': request.data.get('message_id'),
+            'in_reply_to': request.data.get('in_reply_to'),
+            'references': request.data.get('references'),
+        })
+
+    @action(detail=False, methods=['post'])
+    def process_email_batch(self, request):
+        # mode=backlog queues the emails for the bulk worker, mode=sync classifies them now.
+        # Either way only a classification is produced, replies are left for review
         organization = request.user.organization
+        emails = request.data.get('emails')
+        max_batch = settings.EMAIL_SETTINGS['max_batch_request']
+
+        if not isinstance(emails, list) or not emails:
+            return Response({'error': 'emails must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(emails) > max_batch:
+            return Response({'error': f"At most {max_batch} emails per request"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        fields = ('email_content', 'subject', 'sender_email')
+        if not all(isinstance(email, dict) and all(email.get(field) for field in fields) for email in emails):
+            return Response({'error': f"each email needs {', '.join(fields)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        headers = ('message_id', 'in_reply_to', 'references')
+        emails = [{**{field: str(email[field]) for field in fields},
+                   **{header: email[header] for header in headers if email.get(header)}} for email in emails]
+
+        if request.data.get('mode', 'backlog') == 'sync':
+            return Response({'results': classify_email_batch(organization, emails)})
+
+        EmailBacklog.objects.bulk_create([
+            EmailBacklog(organization=organization,
+                         headers={header: email[header] for header in headers if header in email},
+                         **{field: email[field] for field in fields})
+            for email in emails
+        ])
+        return Response({'queued': len(emails)}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'])
+    def email_classifier_stats(self, request):
+        return Response(classifier_stats(request.user.organization.id))
+
+    @action(detail=False, methods=['post'])
+    def analyze_infrastructure(self, request):
+        # Checked here so a bad window is a 400 rather than a failed job
+        try:
+            health_window(request.data.get('window', '24h'), request.data.get('resolution'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return self.dispatch_job(request, 'infrastructure', {
+            'resource_id': request.data.get('resource_id'),
+            'window': request.data.get('window', '24h'),
+            'resolution': request.data.get('resolution'),
+        })
+
+    @action(detail=False, methods=['post'])
+    def analyze_fleet(self, request):
+        organization = request.user.organization
+        resources = list(CloudResource.objects.filter(organization=organization).only('id', 'configuration'))
+        if not resources:
+            return Response({'error': 'No resources to analyze'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            start_date, end_date, resolution = health_window(request.data.get('window', '24h'),
+                                                             request.data.get('resolution'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # One query for the whole fleet, scoring is spread over the health process pool
+        df = query_metrics(organization, [resource.id for resource in resources],
+                           start_date, end_date, resolution)
+        recommendations = bool(request.data.get('recommendations', False))
+
+        def stream():
+            # Results are written as NDJSON lines as soon as each resource is scored
+            with metered() as meter, routing(organization):
+                for analysis in self.agent.analyze_fleet(df, resources, recommendations):
+                    yield json.dumps(analysis.dict()) + '\n'
+            record_usage(
+                organization=organization,
+                feature='infrastructure_analysis',
+                tokens=meter.tokens,
+                cost=meter.cost
+            )
+
+        response = StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @action(detail=False, methods=['post'])
+    def ingest_metrics(self, request):
+        organization = request.user.organization
+        content_type = request.content_type.split(';')[0].strip()
         
-        # Create or get email thread
-        thread, _ = EmailThread.objects.get_or_create(
-            organization=organization,
-            subject=subject,
-            sender_email=sender_email,
-            defaults={'thread_id': f"{organization.id}-{datetime.now().timestamp()}"}
-        )
-        
-        # Process email
-        result = self.agent.process_email(email_content, organization.name)
-        
-        # Save interaction
-        EmailInteraction.objects.create(
-            thread=thread,
-            email_content=email_content,
-            classification=result.classification,
-            response=result.response
-        )
+        if content_type in ('application/x-ndjson', 'application/jsonl'):
+            samples, errors = parse_ndjson(request.body)
+        elif content_type == 'text/csv':
+            samples, errors = parse_csv(request.body)
+        elif content_type == 'application/json':
+            samples, errors = parse_remote_write(request.data)
+        else:
+            return Response({'error': f"Unsupported content type: {content_type}"},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
         
-        # Track usage
-        Usage.objects.create(
-            organization=organization,
-            feature='email_assistant',
-            tokens=len(email_content) // 4,
-            cost=0.002 * (len(email_content) // 4000)
-        )
+        if len(samples) > settings.METRIC_SETTINGS['max_samples_per_request']:
+            return Response({'error': f"At most {settings.METRIC_SETTINGS['max_samples_per_request']} samples per request"},
+                            status=status.HTTP_400_BAD_REQUEST)
         
+        result = ingest_samples(organization, samples)
+        result.rejected += len(errors)
+        result.errors = errors[:100] + result.errors
         return Response(result.dict())
 
     @action(detail=False, methods=['post'])
-    def analyze_infrastructure(self, request):
+    def ingest_traces(self, request):
         organization = request.user.organization
-        resource_id = request.data.get('resource_id')
+        traces = request.data.get('traces')
+        default_resource_id = request.data.get('resource_id')
         
-        resource = CloudResource.objects.get(
-            id=resource_id, 
-            organization=organization
-        )
+        if not isinstance(traces, list):
+            return Response({'error': 'traces must be a list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(traces) > settings.TRACE_SETTINGS['max_batch_size']:
+            return Response({'error': f"At most {settings.TRACE_SETTINGS['max_batch_size']} traces per request"},
+                            status=status.HTTP_400_BAD_REQUEST)
         
-        metrics = ResourceMetric.objects.filter(
-            resource=resource,
-            timestamp__gte=datetime.now() - timedelta(hours=24)
-        )
+        # Resolve every referenced resource in one query
+        resource_ids = {
+            str(t.get('resource_id', default_resource_id))
+            for t in traces if isinstance(t, dict)
+        }
+        resources = {
+            str(r.id): r for r in CloudResource.objects.filter(
+                organization=organization,
+                id__in=[rid for rid in resource_ids if rid.isdigit()]
+            )
+        }
         
-        df = pd.DataFrame(list(metrics.values()))
-        analysis = self.agent.analyze_resource_health(df, resource.configuration)
+        results = [None] * len(traces)
+        accepted = []
+        for index, trace_data in enumerate(traces):
+            if not isinstance(trace_data, dict):
+                results[index] = {'index': index, 'error': 'trace must be an object'}
+                continue
+            trace_data = dict(trace_data)
+            resource = resources.get(str(trace_data.pop('resource_id', default_resource_id)))
+            if resource is None:
+                results[index] = {'index': index, 'error': 'unknown resource_id'}
+                continue
+            accepted.append((index, trace_data, resource))
         
-        Usage.objects.create(
-            organization=organization,
-            feature='infrastructure_analysis',
-            tokens=len(str(metrics)) // 4,
-            cost=0.002 * (len(str(metrics)) // 4000)
-        )
+        created = self.agent.process_traces([(data, resource) for _, data, resource in accepted])
+        for (index, _, _), trace in zip(accepted, created):
+            results[index] = {'index': index, 'trace_id': trace.id, 'status': trace.status}
         
-        return Response(analysis.dict())
+        return Response({
+            'accepted': len(created),
+            'rejected': len(traces) - len(created),
+            'results': results
+        })
 
     @action(detail=False, methods=['get'])
     def usage_stats(self, request):
         organization = request.user.organization
         timeframe = request.query_params.get('timeframe', '7d')
+        granularity = request.query_params.get('granularity', 'total')
         
-        # Calculate date range
-        end_date = datetime.now()
-        if timeframe == '24h':
-            start_date = end_date - timedelta(hours=24)
-        elif timeframe == '7d':
-            start_date = end_date - timedelta(days=7)
-        elif timeframe == '30d':
-            start_date = end_date - timedelta(days=30)
+        # Calculate date range, explicit start/end take precedence over the timeframe
+        start = request.query_params.get('start')
+        end = request.query_params.get('end')
+        try:
+            if start:
+                start_date = parse_datetime(start)
+                end_date = parse_datetime(end) if end else timezone.now()
+                if start_date is None or end_date is None:
+                    raise ValueError("Invalid start/end")
+                # Values without an offset are read in settings.TIME_ZONE
+                if timezone.is_naive(start_date):
+                    start_date = timezone.make_aware(start_date)
+                if timezone.is_naive(end_date):
+                    end_date = timezone.make_aware(end_date)
+                if start_date >= end_date:
+                    raise ValueError("start must be before end")
+            else:
+                start_date, end_date = parse_timeframe(timeframe)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        usage = Usage.objects.filter(
-            organization=organization,
-            timestamp__range=(start_date, end_date)
-        )
+        if granularity not in ('total', 'hour', 'day'):
+            return Response({'error': f"Unsupported granularity: {granularity}"},
+                            status=status.HTTP_400_BAD_REQUEST)
         
-        stats = {
-            'total_cost': sum(u.cost for u in usage),
-            'total_tokens': sum(u.tokens for u in usage),
-            'by_feature': {}
-        }
-        
-        for u in usage:
-            if u.feature not in stats['by_feature']:
-                stats['by_feature'][u.feature] = {
-                    'cost': 0,
-                    'tokens': 0
-                }
-            stats['by_feature'][u.feature]['cost'] += u.cost
-            stats['by_feature'][u.feature]['tokens'] += u.tokens
-        
-        return Response(stats) 
\ No newline at end of file
+        stats = usage_summary(organization, start_date, end_date, granularity)
+        return Response(stats)
+
+class SalesCoachViewSet(AsyncJobMixin, viewsets.ViewSet):
+    permission_classes = [IsAuthenticated]
+
+    @action(detail=False, methods=['post'], url_path='analyze-call')
+    def analyze_call(self, request):
+        audio_file = request.FILES.get('audio_file')
+        max_upload_mb = settings.TRANSCRIPTION_SETTINGS['max_upload_mb']
+        if audio_file is None:
+            return Response({'error': 'audio_file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if audio_file.size > max_upload_mb * 1024 * 1024:
+            return Response({'error': f"audio_file is larger than {max_upload_mb}MB"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Transcribing takes minutes, the transcription worker picks the recording up from
+        # upload_dir and removes it when the job finishes
+        upload_dir = settings.TRANSCRIPTION_SETTINGS['upload_dir']
+        os.makedirs(upload_dir, exist_ok=True)
+        extension = os.path.splitext(audio_file.name)[1]
+        path = os.path.join(upload_dir, uuid.uuid4().hex + (extension if extension[1:].isalnum() else ''))
+        with open(path, 'wb') as f:
+            for block in audio_file.chunks():
+                f.write(block)
+        response = None
+        try:
+            response = self.queue_job(request, 'sales_call', {
+                'path': path,
+                'language': request.data.get('language') or None,
+            })
+        finally:
+            if response is None or response.status_code != status.HTTP_202_ACCEPTED:
+                os.unlink(path)
+        return response
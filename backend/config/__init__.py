@@ -0,0 +1,4 @@
+# Loads the Celery app with Django so .delay() from the web process uses its broker and routes
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
@@ -0,0 +1,21 @@
+import os
+from celery import Celery
+from celery.signals import task_postrun, worker_process_shutdown
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+app = Celery('config')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
+
+# Prefork children leave through os._exit, so atexit never flushes the usage buffer there.
+# Flushing after each task keeps at most the running task's usage in memory
+@task_postrun.connect
+def flush_usage_after_task(**kwargs):
+    from core.usage import get_usage_recorder
+    get_usage_recorder().flush()
+
+@worker_process_shutdown.connect
+def flush_usage_on_shutdown(**kwargs):
+    from core.usage import get_usage_recorder
+    get_usage_recorder().flush()
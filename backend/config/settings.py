@@ -51,10 +51,192 @@ DATABASES = {
 # Redis settings
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = os.getenv('REDIS_PORT', '6379')
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+
+# Celery settings. Jobs go to the realtime, default or bulk queue and each queue has its
+# own worker service, so bulk work and slow LLM calls never delay the realtime queue
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', os.getenv('REDIS_URL', f'redis://{REDIS_HOST}:{REDIS_PORT}/0'))
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'core.tasks.deliver_job_callback': {'queue': 'realtime'},
+    'core.tasks.handle_inbound_events': {'queue': 'realtime'},
+    'core.tasks.send_social_reply': {'queue': 'realtime'},
+    'core.tasks.collect_metrics_task': {'queue': 'bulk'},
+    'core.tasks.maintain_metrics_task': {'queue': 'bulk'},
+    'core.tasks.refresh_day_rollups_task': {'queue': 'bulk'},
+    'core.tasks.summarize_conversation_task': {'queue': 'bulk'},
+    'core.tasks.drain_email_backlog_task': {'queue': 'bulk'},
+    'core.tasks.train_email_classifiers_task': {'queue': 'bulk'},
+}
+CELERY_BEAT_SCHEDULE = {
+    'collect-metrics': {
+        'task': 'core.tasks.collect_metrics_task',
+        'schedule': float(os.getenv('COLLECTOR_INTERVAL_SECONDS', '60')),
+    },
+    'drain-email-backlog': {
+        'task': 'core.tasks.drain_email_backlog_task',
+        'schedule': float(os.getenv('EMAIL_BACKLOG_INTERVAL_SECONDS', '60')),
+    },
+    'train-email-classifiers': {
+        'task': 'core.tasks.train_email_classifiers_task',
+        'schedule': float(os.getenv('EMAIL_CLASSIFIER_RETRAIN_SECONDS', '86400')),
+    },
+    'refresh-day-rollups': {
+        'task': 'core.tasks.refresh_day_rollups_task',
+        'schedule': float(os.getenv('METRIC_DAY_ROLLUP_INTERVAL_SECONDS', '900')),
+    },
+    'maintain-metrics': {
+        'task': 'core.tasks.maintain_metrics_task',
+        'schedule': 3600.0,
+    },
+}
 
 # OpenAI settings
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# Agent settings
+AGENT_SETTINGS = {
+    'parallel_llm_calls': os.getenv('AGENT_PARALLEL_LLM_CALLS', 'True') == 'True',
+    'llm_timeout': float(os.getenv('AGENT_LLM_TIMEOUT', '60')),
+    'llm_max_workers': int(os.getenv('AGENT_LLM_MAX_WORKERS', '8')),
+    # 'fused' analyses a social message and its context in one structured call,
+    # 'two_call' keeps the separate analysis and context update requests
+    'social_analysis_mode': os.getenv('AGENT_SOCIAL_ANALYSIS_MODE', 'fused'),
+    # Connection pool of the OpenAI client shared by every request in a worker
+    'http_max_connections': int(os.getenv('AGENT_HTTP_MAX_CONNECTIONS', '20')),
+    'http_max_keepalive_connections': int(os.getenv('AGENT_HTTP_MAX_KEEPALIVE_CONNECTIONS', '10')),
+    'http_keepalive_expiry': float(os.getenv('AGENT_HTTP_KEEPALIVE_EXPIRY', '60')),
+    'openai_max_retries': int(os.getenv('AGENT_OPENAI_MAX_RETRIES', '2')),
+    'warm_up_connection': os.getenv('AGENT_WARM_UP_CONNECTION', 'True') == 'True',
+    # Run agent endpoints on the Celery workers unless the request sets "async": false
+    'async_by_default': os.getenv('AGENT_ASYNC_BY_DEFAULT', 'False') == 'True',
+    # Celery queue per job kind
+    'job_queues': {
+        'social_message': 'realtime',
+        'email': 'default',
+        'infrastructure': 'default',
+        # Served by one thread-pool worker so every call shares its Whisper process pool
+        'sales_call': 'transcription',
+    },
+    'callback_timeout': float(os.getenv('AGENT_CALLBACK_TIMEOUT', '10')),
+    'callback_max_retries': int(os.getenv('AGENT_CALLBACK_MAX_RETRIES', '5')),
+    # Callbacks may only reach public addresses, plus these hosts on the internal network
+    'callback_allowed_hosts': [host.strip().lower() for host in
+                               os.getenv('AGENT_CALLBACK_ALLOWED_HOSTS', 'n8n').split(',') if host.strip()],
+}
+
+# Price per 1K tokens, used to bill the token counts OpenAI reports
+MODEL_PRICING = {
+    'gpt-4': {'prompt': 0.03, 'completion': 0.06},
+    'gpt-3.5-turbo': {'prompt': 0.0005, 'completion': 0.0015},
+    'default': {'prompt': 0.03, 'completion': 0.06},
+}
+
+EMAIL_SETTINGS = {
+    # Emails packed into one classification request
+    'batch_size': int(os.getenv('EMAIL_BATCH_SIZE', '20')),
+    'batch_max_item_chars': int(os.getenv('EMAIL_BATCH_MAX_ITEM_CHARS', '4000')),
+    'max_batch_request': int(os.getenv('EMAIL_MAX_BATCH_REQUEST', '500')),
+    # Backlog rows claimed per drain pass of the bulk worker
+    'backlog_claim_size': int(os.getenv('EMAIL_BACKLOG_CLAIM_SIZE', '200')),
+    'backlog_lease': int(os.getenv('EMAIL_BACKLOG_LEASE_SECONDS', '900')),
+    # Per-organization local classifier, see core.classifier
+    'classifier_enabled': os.getenv('EMAIL_CLASSIFIER_ENABLED', 'True') == 'True',
+    # Outside MEDIA_ROOT, which nginx serves publicly
+    'classifier_dir': os.getenv('EMAIL_CLASSIFIER_DIR', os.path.join(BASE_DIR, 'classifiers')),
+    'classifier_threshold': float(os.getenv('EMAIL_CLASSIFIER_THRESHOLD', '0.85')),
+    'classifier_min_samples': int(os.getenv('EMAIL_CLASSIFIER_MIN_SAMPLES', '200')),
+    'classifier_max_samples': int(os.getenv('EMAIL_CLASSIFIER_MAX_SAMPLES', '20000')),
+    'classifier_max_features': int(os.getenv('EMAIL_CLASSIFIER_MAX_FEATURES', '50000')),
+    # Share of confident local answers also sent to the LLM to keep measuring agreement
+    'classifier_shadow_rate': float(os.getenv('EMAIL_CLASSIFIER_SHADOW_RATE', '0.05')),
+    'classifier_reload_interval': float(os.getenv('EMAIL_CLASSIFIER_RELOAD_SECONDS', '60')),
+}
+
+# Sales call transcription, see core.transcription
+TRANSCRIPTION_SETTINGS = {
+    'model': os.getenv('WHISPER_MODEL', 'base'),
+    # Processes in the Whisper pool, each loads the model once. 0 uses every core
+    'workers': int(os.getenv('WHISPER_WORKERS', '0')),
+    # Torch threads per process, 0 splits the cores between the processes
+    'threads_per_worker': int(os.getenv('WHISPER_THREADS_PER_WORKER', '0')),
+    # Chunks are cut at the quietest point near chunk_seconds, never longer than one
+    # 30 second Whisper window
+    'chunk_seconds': float(os.getenv('WHISPER_CHUNK_SECONDS', '25')),
+    'max_chunk_seconds': float(os.getenv('WHISPER_MAX_CHUNK_SECONDS', '30')),
+    'chunk_search_seconds': float(os.getenv('WHISPER_CHUNK_SEARCH_SECONDS', '4')),
+    'cache_ttl': int(os.getenv('WHISPER_CACHE_TTL', '604800')),
+    'max_upload_mb': int(os.getenv('SALES_COACH_MAX_UPLOAD_MB', '25')),
+    # Recordings wait here for the transcription worker, which must see the same directory
+    'upload_dir': os.getenv('SALES_COACH_UPLOAD_DIR', os.path.join(BASE_DIR, 'uploads', 'calls')),
+    # Sentiment is scored per window of the call while the rest is still transcribed
+    'sentiment_window_seconds': float(os.getenv('SALES_COACH_SENTIMENT_WINDOW_SECONDS', '300')),
+    'max_transcript_chars': int(os.getenv('SALES_COACH_MAX_TRANSCRIPT_CHARS', '12000')),
+}
+
+# Model tier per LLM call, see core.router
+MODEL_ROUTER_SETTINGS = {
+    'enabled': os.getenv('MODEL_ROUTER_ENABLED', 'True') == 'True',
+    'models': {
+        'small': os.getenv('MODEL_ROUTER_SMALL_MODEL', 'gpt-3.5-turbo'),
+        'large': os.getenv('MODEL_ROUTER_LARGE_MODEL', 'gpt-4'),
+    },
+    # Starting tier per feature, features not listed use the large model
+    'features': {
+        'email_classification': 'small',
+        'email_classification_batch': 'small',
+        'email_response': 'large',
+        'social_analysis': 'large',
+        'social_reply': 'large',
+        'social_context': 'small',
+        'social_summary': 'small',
+        'resource_recommendations': 'large',
+        'call_sentiment': 'small',
+        'sales_coaching': 'large',
+    },
+    # Tier bounds per Organization.plan
+    'plans': {
+        'free': {'max_tier': 'small'},
+        'pro': {},
+        'enterprise': {'min_tier': 'large'},
+    },
+    # Inputs longer than this skip the small model
+    'long_input_chars': int(os.getenv('MODEL_ROUTER_LONG_INPUT_CHARS', '6000')),
+    # Structured results reporting less confidence are retried on the next tier
+    'min_confidence': float(os.getenv('MODEL_ROUTER_MIN_CONFIDENCE', '0.6')),
+    # Features escalated more often than this go straight to the large model
+    'max_escalation_rate': float(os.getenv('MODEL_ROUTER_MAX_ESCALATION_RATE', '0.3')),
+}
+
+# Usage accounting, buffered per worker and written in batches
+USAGE_SETTINGS = {
+    'buffered': os.getenv('USAGE_BUFFERED', 'True') == 'True',
+    'max_batch': int(os.getenv('USAGE_MAX_BATCH', '500')),
+    'flush_interval': float(os.getenv('USAGE_FLUSH_INTERVAL', '5')),
+    # Rows kept while the database is unreachable, the oldest are dropped beyond this
+    'max_buffer': int(os.getenv('USAGE_MAX_BUFFER', '10000')),
+}
+
+# LLM response cache, in-process LRU in front of Redis
+LLM_CACHE_SETTINGS = {
+    'enabled': os.getenv('LLM_CACHE_ENABLED', 'True') == 'True',
+    'use_redis': os.getenv('LLM_CACHE_USE_REDIS', 'True') == 'True',
+    'l1_max_entries': int(os.getenv('LLM_CACHE_L1_MAX_ENTRIES', '2048')),
+    # TTL in seconds per feature, 0 disables caching for that feature
+    'ttl': {
+        'email_classification': int(os.getenv('LLM_CACHE_TTL_EMAIL_CLASSIFICATION', '86400')),
+        'email_classification_batch': int(os.getenv('LLM_CACHE_TTL_EMAIL_CLASSIFICATION_BATCH', '86400')),
+        'email_response': int(os.getenv('LLM_CACHE_TTL_EMAIL_RESPONSE', '3600')),
+        'social_analysis': int(os.getenv('LLM_CACHE_TTL_SOCIAL_ANALYSIS', '0')),
+        'social_context': int(os.getenv('LLM_CACHE_TTL_SOCIAL_CONTEXT', '0')),
+        'social_summary': int(os.getenv('LLM_CACHE_TTL_SOCIAL_SUMMARY', '0')),
+        'resource_recommendations': int(os.getenv('LLM_CACHE_TTL_RESOURCE_RECOMMENDATIONS', '900')),
+    }
+}
+
 # Static files
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
@@ -70,7 +252,82 @@ DEVOPS_SETTINGS = {
         'cpu_utilization': 80,
         'memory_utilization': 85,
         'disk_usage': 90
-    }
+    },
+    # Processes used to score an organization's resources in fleet analysis, 0 means one per core
+    'fleet_workers': int(os.getenv('DEVOPS_FLEET_WORKERS', '0')) or None,
+}
+
+# Metric ingestion
+METRIC_SETTINGS = {
+    # 'copy' uses PostgreSQL COPY, anything else falls back to bulk_create
+    'ingest_method': os.getenv('METRIC_INGEST_METHOD', 'copy'),
+    'bulk_batch_size': int(os.getenv('METRIC_BULK_BATCH_SIZE', '5000')),
+    'max_samples_per_request': int(os.getenv('METRIC_MAX_SAMPLES_PER_REQUEST', '200000')),
+    'resource_cache_ttl': float(os.getenv('METRIC_RESOURCE_CACHE_TTL', '300')),
+    'rollups_enabled': os.getenv('METRIC_ROLLUPS_ENABLED', 'True') == 'True',
+    # Day buckets of the last this many hours are refolded by refresh_day_rollups_task,
+    # ingests of older samples refold their days inline
+    'day_rollup_lookback_hours': float(os.getenv('METRIC_DAY_ROLLUP_LOOKBACK_HOURS', '48')),
+    # Default days kept per tier, organizations can override them in metric_retention
+    'retention_days': {
+        'raw': int(os.getenv('METRIC_RETENTION_RAW_DAYS', '14')),
+        '1m': int(os.getenv('METRIC_RETENTION_MINUTE_DAYS', '30')),
+        '1h': int(os.getenv('METRIC_RETENTION_HOUR_DAYS', '400')),
+        '1d': int(os.getenv('METRIC_RETENTION_DAY_DAYS', '1825')),
+    },
+}
+
+ALERT_SETTINGS = {
+    'enabled': os.getenv('ALERTS_ENABLED', 'True') == 'True',
+    # 'redis' shares rule state between workers, 'memory' keeps it per process
+    'state_backend': os.getenv('ALERT_STATE_BACKEND', 'redis'),
+    # Defaults for rules built from alert_thresholds, resources can override them in
+    # configuration['alert_rules']
+    'window': int(os.getenv('ALERT_WINDOW_SECONDS', '300')),
+    'aggregate': os.getenv('ALERT_AGGREGATE', 'avg'),
+    'for_duration': int(os.getenv('ALERT_FOR_SECONDS', '120')),
+    # A firing rule resolves once the aggregate drops this fraction below its threshold
+    'hysteresis': float(os.getenv('ALERT_HYSTERESIS', '0.1')),
+    'severity': os.getenv('ALERT_SEVERITY', 'warning'),
+    'max_window_samples': int(os.getenv('ALERT_MAX_WINDOW_SAMPLES', '600')),
+    # Seconds a worker waits for, and may hold, the lock on a resource's rule state
+    'lock_timeout': int(os.getenv('ALERT_LOCK_TIMEOUT', '30')),
+}
+
+COLLECTOR_SETTINGS = {
+    'max_workers': int(os.getenv('COLLECTOR_MAX_WORKERS', '32')),
+    # How far back a resource without recent samples is fetched
+    'lookback': int(os.getenv('COLLECTOR_LOOKBACK_SECONDS', '3600')),
+    'interval': int(os.getenv('COLLECTOR_INTERVAL_SECONDS', '60')),
+    'flush_samples': int(os.getenv('COLLECTOR_FLUSH_SAMPLES', '50000')),
+    'gcp_project': os.getenv('GCP_PROJECT', ''),
+    # API requests per second and concurrent resources per provider
+    'providers': {
+        provider: {
+            'enabled': os.getenv(f'COLLECTOR_{provider.upper()}_ENABLED', 'True') == 'True',
+            'rate': float(os.getenv(f'COLLECTOR_{provider.upper()}_RATE', rate)),
+            'concurrency': int(os.getenv(f'COLLECTOR_{provider.upper()}_CONCURRENCY', concurrency)),
+        }
+        for provider, rate, concurrency in (
+            ('aws', '20', '8'),
+            ('gcp', '10', '8'),
+            ('azure', '10', '8'),
+            ('k8s', '50', '16'),
+        )
+    },
+}
+
+# Trace Management
+TRACE_SETTINGS = {
+    'ticket_webhook_url': os.getenv('TICKET_WEBHOOK_URL'),
+    'evaluation_sample_rate': float(os.getenv('EVALUATION_SAMPLE_RATE', '0.1')),
+    'error_dataset_retention_days': int(os.getenv('ERROR_DATASET_RETENTION_DAYS', '30')),
+    'max_batch_size': int(os.getenv('TRACE_MAX_BATCH_SIZE', '5000')),
+    # Errors with the same signature on one resource share a ticket within this many seconds
+    'ticket_coalesce_window': int(os.getenv('TICKET_COALESCE_WINDOW', '3600')),
+    'ticket_concurrency': int(os.getenv('TICKET_CONCURRENCY', '4')),
+    'ticket_max_attempts': int(os.getenv('TICKET_MAX_ATTEMPTS', '8')),
+    'ticket_timeout': float(os.getenv('TICKET_TIMEOUT', '10')),
 }
 
 # Social Media Settings
@@ -79,11 +336,36 @@ SOCIAL_SETTINGS = {
         'app_id': os.getenv('META_APP_ID'),
         'app_secret': os.getenv('META_APP_SECRET'),
         'verify_token': os.getenv('META_VERIFY_TOKEN'),
+        # Replies go to {graph_api_url}/{graph_api_version}/{channel}/messages, point it at a
+        # local fake Graph API in development
+        'graph_api_url': os.getenv('META_GRAPH_API_URL', 'https://graph.facebook.com'),
+        'graph_api_version': os.getenv('META_GRAPH_API_VERSION', 'v19.0'),
+        'send_timeout': float(os.getenv('META_SEND_TIMEOUT', '10')),
+        'send_max_retries': int(os.getenv('META_SEND_MAX_RETRIES', '5')),
     },
     'whatsapp': {
         'api_key': os.getenv('WHATSAPP_API_KEY'),
         'phone_number_id': os.getenv('WHATSAPP_PHONE_NUMBER_ID'),
-    }
+    },
+    # Prompt size per social message stays flat: history is trimmed to this many tokens
+    # after the summary, the context and the new message are accounted for
+    'prompt_token_budget': int(os.getenv('SOCIAL_PROMPT_TOKEN_BUDGET', '1500')),
+    'prompt_overhead_tokens': int(os.getenv('SOCIAL_PROMPT_OVERHEAD_TOKENS', '250')),
+    'max_recent_messages': int(os.getenv('SOCIAL_MAX_RECENT_MESSAGES', '20')),
+    # Older turns are folded into conversation_summary in the background
+    'summarize_after': int(os.getenv('SOCIAL_SUMMARIZE_AFTER', '12')),
+    'keep_recent_messages': int(os.getenv('SOCIAL_KEEP_RECENT_MESSAGES', '4')),
+    'summary_max_words': int(os.getenv('SOCIAL_SUMMARY_MAX_WORDS', '200')),
+    'context_max_list_items': int(os.getenv('SOCIAL_CONTEXT_MAX_LIST_ITEMS', '10')),
+    'context_max_string_chars': int(os.getenv('SOCIAL_CONTEXT_MAX_STRING_CHARS', '300')),
+    'context_max_tokens': int(os.getenv('SOCIAL_CONTEXT_MAX_TOKENS', '400')),
+    # Queued messages from one contact that arrive within the debounce window are analyzed
+    # together, 0 processes every message on its own
+    'debounce_seconds': float(os.getenv('SOCIAL_DEBOUNCE_SECONDS', '3')),
+    'max_burst_wait': float(os.getenv('SOCIAL_MAX_BURST_WAIT', '10')),
+    'lock_timeout': int(os.getenv('SOCIAL_LOCK_TIMEOUT', '180')),
+    # A burst that can't get the conversation lock is retried this many times, then its jobs fail
+    'lock_retries': int(os.getenv('SOCIAL_LOCK_RETRIES', '3')),
 }
 
 TEMPLATES = [
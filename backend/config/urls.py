@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from core.views import AIAgentViewSet
+from core.views import AIAgentViewSet, meta_webhook
 
 router = DefaultRouter()
 router.register(r'ai', AIAgentViewSet, basename='ai')
@@ -9,4 +9,6 @@ router.register(r'ai', AIAgentViewSet, basename='ai')
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
+    path('api/', include('api.urls')),
+    path('webhooks/meta/', meta_webhook, name='meta-webhook'),
 ] 
\ No newline at end of file
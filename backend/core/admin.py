@@ -4,19 +4,30 @@ from .models import (
     SocialConversation,
     SocialMessage,
     EmailThread,
+    EmailThreadRef,
     EmailInteraction,
+    EmailBacklog,
     Usage,
+    UsageRollup,
     InfrastructureComponent,
     CloudResource,
     ResourceMetric,
+    ResourceMetricMinute,
+    ResourceMetricHour,
+    ResourceMetricDay,
     Trace,
     TraceDataset,
-    Alert
+    TicketOutbox,
+    Alert,
+    AgentJob,
+    SocialChannel,
+    InboundEvent
 )
 
 @admin.register(Organization)
 class OrganizationAdmin(admin.ModelAdmin):
-    list_display = ('name', 'api_key', 'created_at')
+    list_display = ('name', 'plan', 'api_key', 'created_at')
+    list_filter = ('plan',)
     search_fields = ('name', 'api_key')
     readonly_fields = ('created_at',)
 
@@ -33,9 +44,14 @@ class SocialMessageAdmin(admin.ModelAdmin):
 
 @admin.register(EmailThread)
 class EmailThreadAdmin(admin.ModelAdmin):
-    list_display = ('organization', 'subject', 'sender_email', 'created_at')
+    list_display = ('organization', 'subject', 'sender_email', 'thread_id', 'created_at')
     list_filter = ('created_at',)
-    search_fields = ('subject', 'sender_email')
+    search_fields = ('subject', 'sender_email', 'thread_id')
+
+@admin.register(EmailThreadRef)
+class EmailThreadRefAdmin(admin.ModelAdmin):
+    list_display = ('key', 'thread')
+    search_fields = ('key',)
 
 @admin.register(EmailInteraction)
 class EmailInteractionAdmin(admin.ModelAdmin):
@@ -43,6 +59,11 @@ class EmailInteractionAdmin(admin.ModelAdmin):
     list_filter = ('needs_human_review', 'created_at')
     search_fields = ('email_content',)
 
+@admin.register(EmailBacklog)
+class EmailBacklogAdmin(admin.ModelAdmin):
+    list_display = ('organization', 'subject', 'sender_email', 'received_at', 'claimed_until')
+    search_fields = ('subject', 'sender_email')
+
 @admin.register(InfrastructureComponent)
 class InfrastructureComponentAdmin(admin.ModelAdmin):
     list_display = ('name', 'component_type', 'cloud_provider', 'organization')
@@ -61,6 +82,12 @@ class ResourceMetricAdmin(admin.ModelAdmin):
     list_filter = ('metric_name', 'timestamp')
     search_fields = ('resource__name',)
 
+@admin.register(ResourceMetricMinute, ResourceMetricHour, ResourceMetricDay)
+class MetricRollupAdmin(admin.ModelAdmin):
+    list_display = ('resource', 'metric_name', 'bucket', 'min_value', 'max_value', 'count', 'p95')
+    list_filter = ('metric_name', 'bucket')
+    search_fields = ('resource__name',)
+
 @admin.register(Trace)
 class TraceAdmin(admin.ModelAdmin):
     list_display = ('resource', 'status', 'created_at', 'reviewed', 'ticket_id')
@@ -72,14 +99,44 @@ class TraceDatasetAdmin(admin.ModelAdmin):
     list_display = ('type', 'created_at')
     list_filter = ('type',)
 
+@admin.register(TicketOutbox)
+class TicketOutboxAdmin(admin.ModelAdmin):
+    list_display = ('resource', 'status', 'occurrences', 'attempts', 'ticket_id', 'next_attempt_at')
+    list_filter = ('status',)
+    search_fields = ('ticket_id', 'coalesce_key')
+
+@admin.register(AgentJob)
+class AgentJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'organization', 'kind', 'status', 'created_at', 'finished_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'callback_delivered_at', 'reply_sent_at')
+
+@admin.register(SocialChannel)
+class SocialChannelAdmin(admin.ModelAdmin):
+    list_display = ('organization', 'platform', 'external_id', 'is_active', 'created_at')
+    list_filter = ('platform', 'is_active')
+    search_fields = ('external_id',)
+
+@admin.register(InboundEvent)
+class InboundEventAdmin(admin.ModelAdmin):
+    list_display = ('platform', 'message_id', 'contact_id', 'status', 'received_at')
+    list_filter = ('platform', 'status')
+    search_fields = ('message_id', 'contact_id')
+
 @admin.register(Alert)
 class AlertAdmin(admin.ModelAdmin):
-    list_display = ('alert_type', 'created_at')
-    list_filter = ('alert_type',)
-    search_fields = ('description',)
+    list_display = ('resource', 'rule', 'severity', 'is_active', 'created_at', 'resolved_at')
+    list_filter = ('severity', 'is_active', 'rule')
+    search_fields = ('title', 'description')
 
 @admin.register(Usage)
 class UsageAdmin(admin.ModelAdmin):
     list_display = ('organization', 'feature', 'tokens', 'cost', 'timestamp')
     list_filter = ('feature', 'timestamp')
-    search_fields = ('organization__name',) 
\ No newline at end of file
+    search_fields = ('organization__name',)
+
+@admin.register(UsageRollup)
+class UsageRollupAdmin(admin.ModelAdmin):
+    list_display = ('organization', 'feature', 'bucket', 'tokens', 'cost', 'requests')
+    list_filter = ('feature', 'bucket')
+    search_fields = ('organization__name',)
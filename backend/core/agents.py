@@ -1,13 +1,52 @@
-from typing import List, Dict
+from typing import Callable, List, Dict, Iterator, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import contextvars
+import multiprocessing
+import math
+import os
+import threading
+import time
+import logging
+import httpx
 import openai
-from pydantic import BaseModel
+import instructor
+from pydantic import BaseModel, ValidationError
 import pandas as pd
 from datetime import datetime
 from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
 import json
 import random
-import requests
-from django.db import models
+import re
+import types
+from django.conf import settings
+from django.db import models, transaction
+from .models import CloudResource, Trace, TraceDataset
+from .cache import LLMCache, llm_cache_key, get_llm_cache
+from .usage import meter_completion
+from .health import HealthReport, score_metrics, score_metrics_batch
+from .tickets import enqueue_ticket_outbox, ticket_coalesce_key
+from .transcription import Transcript, TranscriptChunk
+from .router import ModelRouter, Route, build_model_router, current_organization_id
+from .classifier import EmailClassifier, get_email_classifier, record_agreement
+
+logger = logging.getLogger(__name__)
+
+class EmailClassification(BaseModel):
+    category: str
+    priority: str
+    intent: str
+    confidence: float
+
+class BatchEmailClassification(EmailClassification):
+    id: str
+
+class EmailClassificationBatch(BaseModel):
+    items: List[BatchEmailClassification]
+
+EMAIL_TAG = re.compile(r'<(/?email)', re.IGNORECASE)
+
+def defuse_email_tags(content: str) -> str:
+    return EMAIL_TAG.sub(r'&lt;\1', content)
 
 class EmailResponse(BaseModel):
     classification: Dict
@@ -27,129 +66,703 @@ class MessageAnalysis(BaseModel):
     suggested_stage: str
     updated_context: Dict
 
+class CallSentiment(BaseModel):
+    start: float
+    end: float
+    sentiment: float
+    summary: str
+    objections: List[str]
+
+class SalesCallAnalysis(BaseModel):
+    sentiment: float
+    score: float
+    summary: str
+    strengths: List[str]
+    improvements: List[str]
+    objections: List[str]
+    next_steps: List[str]
+
+class CallAnalysisError(BaseModel):
+    stage: str
+    error: str
+
+DEFAULT_SOCIAL_ANALYSIS = {
+    "intent": {"type": "unknown"},
+    "sentiment": 0.0,
+    "suggested_response": "I apologize, but I need more context to provide a proper response.",
+    "lead_score_delta": 0.0,
+    "suggested_stage": "lead"
+}
+
+class SocialMessageUpdate(BaseModel):
+    # MessageAnalysis without the reply, used while the reply itself is streamed
+    intent: Dict
+    sentiment: float
+    lead_score_delta: float
+    suggested_stage: str
+    updated_context: Dict
+
+# Shared by every agent in the worker so parallel LLM calls don't spawn a pool per request
+_llm_executor: Optional[ThreadPoolExecutor] = None
+_llm_executor_lock = threading.Lock()
+
+def get_llm_executor(max_workers: int = 8) -> ThreadPoolExecutor:
+    global _llm_executor
+    with _llm_executor_lock:
+        if _llm_executor is None:
+            _llm_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm')
+        return _llm_executor
+
+# One metrics registry per worker, a Gauge can only be registered once per registry
+METRICS_REGISTRY = CollectorRegistry()
+HEALTH_GAUGE = Gauge('resource_health', 'Resource Health Score',
+                     ['resource_id'], registry=METRICS_REGISTRY)
+
+def build_openai_client(api_key: str, max_connections: int = 20,
+                        max_keepalive_connections: int = 10, keepalive_expiry: float = 60.0,
+                        timeout: float = 60.0, max_retries: int = 2) -> openai.OpenAI:
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        ),
+        timeout=timeout
+    )
+    # Patched so create() also accepts response_model for schema-validated output
+    return instructor.patch(openai.OpenAI(
+        api_key=api_key,
+        http_client=http_client,
+        max_retries=max_retries
+    ))
+
+# TraceDataset rows never change once created, so their ids are resolved once per worker
+_trace_dataset_ids: Dict[str, int] = {}
+_trace_dataset_lock = threading.Lock()
+
+def get_trace_dataset_ids() -> Dict[str, int]:
+    with _trace_dataset_lock:
+        for dataset_type, _ in TraceDataset.DATASET_TYPE:
+            if dataset_type not in _trace_dataset_ids:
+                dataset, _ = TraceDataset.objects.get_or_create(
+                    type=dataset_type,
+                    defaults={'created_at': datetime.now()}
+                )
+                _trace_dataset_ids[dataset_type] = dataset.id
+        return dict(_trace_dataset_ids)
+
+_health_pool: Optional[ProcessPoolExecutor] = None
+_health_pool_lock = threading.Lock()
+
+def get_health_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    global _health_pool
+    with _health_pool_lock:
+        if _health_pool is None:
+            # forkserver children don't inherit the web worker's threads or DB connections
+            _health_pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('forkserver')
+            )
+        return _health_pool
+
 class AIAgent:
-    def __init__(self, api_key: str, prometheus_url: str = None, webhook_url: str = None):
-        self.client = openai.OpenAI(api_key=api_key)
-        self.registry = CollectorRegistry()
-        self.health_gauge = Gauge('resource_health', 'Resource Health Score', 
-                                ['resource_id'], registry=self.registry)
+    def __init__(self, api_key: str, prometheus_url: str = None, webhook_url: str = None,
+                 llm_timeout: float = 60.0, parallel: bool = True, max_workers: int = 8,
+                 social_mode: str = 'fused', cache: Optional[LLMCache] = None,
+                 client: Optional[openai.OpenAI] = None,
+                 registry: Optional[CollectorRegistry] = None, trace_sample_rate: float = 0.1,
+                 alert_thresholds: Optional[Dict[str, float]] = None,
+                 health_workers: Optional[int] = None,
+                 router: Optional[ModelRouter] = None,
+                 classifier: Optional[EmailClassifier] = None):
+        self.client = client or build_openai_client(api_key, timeout=llm_timeout)
+        if registry is None:
+            self.registry = METRICS_REGISTRY
+            self.health_gauge = HEALTH_GAUGE
+        else:
+            self.registry = registry
+            self.health_gauge = Gauge('resource_health', 'Resource Health Score', 
+                                    ['resource_id'], registry=self.registry)
         self.prometheus_url = prometheus_url
         self.webhook_url = webhook_url
+        self.llm_timeout = llm_timeout
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.social_mode = social_mode
+        self.cache = cache
+        self.trace_sample_rate = trace_sample_rate
+        self.alert_thresholds = alert_thresholds or {}
+        self.health_workers = health_workers or os.cpu_count()
+        # Without a router every call goes to the large model
+        self.router = router or ModelRouter(models={'small': 'gpt-4', 'large': 'gpt-4'}, features={},
+                                            plans={}, enabled=False)
+        self.classifier = classifier
+
+    def warm_up(self, open_connection: bool = False) -> None:
+        if self.cache is not None and self.cache.redis is not None:
+            self.cache.redis.ping()
+        if open_connection:
+            # Pays for DNS and the TLS handshake before the first real request does
+            self.client.models.list()
 
     def process_email(self, content: str, org_name: str) -> EmailResponse:
-        classification = self._classify_email(content)
-        response = self._generate_email_response(content, org_name)
+        # Classification and reply don't depend on each other, so they run side by side
+        classification, response = self._run_concurrently(
+            (self._classify_email, content),
+            (self._generate_email_response, content, org_name)
+        )
         return EmailResponse(classification=classification, response=response)
 
-    def analyze_resource_health(self, metrics_data: pd.DataFrame, 
-                              resource_config: Dict) -> ResourceHealth:
-        # Reference existing DevOpsAgent implementation
-        startLine: 23
-        endLine: 41
+    def classify_emails(self, emails: List[Tuple[str, str]], batch_size: int = 20,
+                        max_item_chars: int = 4000) -> Dict[str, Dict]:
+        # Packs up to batch_size (id, content) pairs per request, items the batch doesn't
+        # answer with a valid entry are classified one at a time. Emails the organization's
+        # local classifier is sure about never reach the LLM
+        results: Dict[str, Dict] = {}
+        local_categories: Dict[str, str] = {}
+        pending = []
+        for email_id, content in emails:
+            local, local_category = self._classify_locally(content)
+            if local is not None:
+                results[email_id] = local
+                continue
+            if local_category is not None:
+                local_categories[email_id] = local_category
+            pending.append((email_id, content))
 
-    def process_trace(self, trace_data: dict, resource: CloudResource) -> None:
-        # Create trace record
-        trace = Trace.objects.create(
-            resource=resource,
-            status='error' if trace_data.get('error') else 'success',
-            content=trace_data
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            classified = self._classify_email_batch(batch, max_item_chars)
+            missing = [(email_id, content) for email_id, content in batch if email_id not in classified]
+            if missing:
+                logger.info("Classifying %d of %d batched emails one by one", len(missing), len(batch))
+                fallback = self._run_concurrently(*[(self._classify_email_llm, content) for _, content in missing])
+                classified.update({email_id: c for (email_id, _), c in zip(missing, fallback)})
+            results.update(classified)
+
+        organization_id = current_organization_id()
+        for email_id, local_category in local_categories.items():
+            record_agreement(organization_id, local_category, results[email_id]['category'])
+        return results
+
+    def _classify_email_batch(self, batch: List[Tuple[str, str]], max_item_chars: int) -> Dict[str, Dict]:
+        if len(batch) == 1:
+            return {}
+        # Emails are numbered e1, e2... within the batch rather than sent with their own ids,
+        # and email tags inside a body are defused so one email can't pose as another
+        refs = {f"e{i}": email_id for i, (email_id, _) in enumerate(batch, 1)}
+        packed = "\n\n".join(f'<email id="{ref}">\n{defuse_email_tags(content[:max_item_chars])}\n</email>'
+                               for ref, (_, content) in zip(refs, batch))
+        prompt = f"""
+        Classify each of these emails:
+        
+        {packed}
+        
+        Return one item per email with its id, and for each:
+        category: one of inquiry, support, sales, complaint, billing, spam, other
+        priority: one of low, medium, high
+        intent: what the sender wants, in a few words
+        confidence: 0 to 1, how sure you are of the category
+        """
+        try:
+            result = self._complete_structured("You are an email classifier.", prompt, EmailClassificationBatch,
+                                               feature='email_classification_batch')
+        except ValidationError:
+            return {}
+
+        # Only ids that were asked for and answered exactly once are trusted
+        answers: Dict[str, List[BatchEmailClassification]] = {}
+        for item in result.items:
+            answers.setdefault(item.id.strip(), []).append(item)
+        return {
+            refs[ref]: items[0].model_dump(exclude={'id'})
+            for ref, items in answers.items()
+            if ref in refs and len(items) == 1 and items[0].confidence >= self.router.min_confidence
+        }
+
+    def _run_concurrently(self, *calls) -> List:
+        if not self.parallel:
+            return [fn(*args) for fn, *args in calls]
+
+        executor = get_llm_executor(self.max_workers)
+        # Each call gets its own copy of the context so the caller's usage meter follows it
+        futures = [executor.submit(contextvars.copy_context().run, fn, *args) for fn, *args in calls]
+        deadline = time.monotonic() + self.llm_timeout
+        try:
+            return [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+        finally:
+            # Drop calls that haven't started yet if a sibling failed or timed out
+            for f in futures:
+                f.cancel()
+
+    def _complete(self, system: str, user: str, feature: Optional[str] = None,
+                  route: Optional[Route] = None) -> str:
+        route = route or self.router.route(feature, len(system) + len(user))
+        model = route.model
+        key = llm_cache_key(model, system, user)
+        if self.cache is not None:
+            cached = self.cache.get(key, feature)
+            if cached is not None:
+                return cached
+
+        started = time.monotonic()
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": user}
+            ],
+            timeout=self.llm_timeout
         )
+        self.router.log(feature, route, time.monotonic() - started, response.usage)
+        meter_completion(model, response.usage)
+        content = response.choices[0].message.content
+
+        if self.cache is not None:
+            self.cache.set(key, content, feature)
+        return content
+
+    def _complete_validated(self, system: str, user: str, feature: str, is_valid: Callable[[str], bool]) -> str:
+        # Free-form completions that must parse, e.g. JSON, move up a tier when they don't
+        route = self.router.route(feature, len(system) + len(user))
+        content = self._complete(system, user, feature, route)
+        valid = is_valid(content)
+        self.router.record_outcome(feature, route, not valid)
+        escalated = None if valid else self.router.escalate(route)
+        if escalated is None:
+            return content
+
+        logger.info("Escalating %s from %s to %s after an unparsable reply", feature, route.model, escalated.model)
+        content = self._complete(system, user, feature, escalated)
+        if self.cache is not None and is_valid(content):
+            # Later calls routed to the small tier reuse the escalated answer
+            self.cache.set(llm_cache_key(route.model, system, user), content, feature)
+        return content
+
+    def _complete_structured(self, system: str, user: str, response_model: type,
+                             feature: Optional[str] = None, route: Optional[Route] = None) -> BaseModel:
+        route = route or self.router.route(feature, len(system) + len(user))
+        model = route.model
+        key = llm_cache_key(f"{model}:{response_model.__name__}", system, user)
+        if self.cache is not None:
+            cached = self.cache.get(key, feature)
+            if cached is not None:
+                return response_model.model_validate_json(cached)
+
+        started = time.monotonic()
+        try:
+            result = self.client.chat.completions.create(
+                model=model,
+                response_model=response_model,
+                max_retries=1,
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": user}
+                ],
+                timeout=self.llm_timeout
+            )
+        except ValidationError:
+            self.router.log(feature, route, time.monotonic() - started, None, outcome='invalid')
+            if self.router.escalate(route) is None:
+                self.router.record_outcome(feature, route, True)
+                raise
+            return self._escalate_structured(system, user, response_model, feature, route, key, 'invalid')
+
+        raw_response = getattr(result, '_raw_response', None)
+        usage = getattr(raw_response, 'usage', None)
+        meter_completion(model, usage)
+        confidence = getattr(result, 'confidence', None)
+        if confidence is not None and confidence < self.router.min_confidence:
+            self.router.log(feature, route, time.monotonic() - started, usage, outcome='low_confidence')
+            if self.router.escalate(route) is not None:
+                return self._escalate_structured(system, user, response_model, feature, route, key, 'low_confidence')
+            # The plan allows nothing higher, the answer is kept but doesn't count as a success
+        else:
+            self.router.log(feature, route, time.monotonic() - started, usage)
+            self.router.record_outcome(feature, route, False)
+
+        if self.cache is not None:
+            self.cache.set(key, result.model_dump_json(), feature)
+        return result
+
+    def _escalate_structured(self, system: str, user: str, response_model: type, feature: Optional[str],
+                             route: Route, key: str, outcome: str) -> BaseModel:
+        self.router.record_outcome(feature, route, True)
+        escalated = self.router.escalate(route)
+        logger.info("Escalating %s from %s to %s (%s)", feature, route.model, escalated.model, outcome)
+        result = self._complete_structured(system, user, response_model, feature, escalated)
+        if self.cache is not None:
+            self.cache.set(key, result.model_dump_json(), feature)
+        return result
 
-        # Handle error traces
-        if trace.status == 'error':
-            self._add_to_error_dataset(trace)
-            self._create_ticket(trace)
-        # Handle successful traces (10% sample)
-        elif random.random() < 0.1:
-            self._add_to_evaluation_dataset(trace)
-
-    def _add_to_error_dataset(self, trace: Trace) -> None:
-        dataset, _ = TraceDataset.objects.get_or_create(
-            type='error',
-            defaults={'created_at': datetime.now()}
+    def analyze_resource_health(self, metrics_data: pd.DataFrame, 
+                              resource_config: Dict, resource_id: str = '') -> ResourceHealth:
+        thresholds = {**self.alert_thresholds, **resource_config.get('alert_thresholds', {})}
+        report = score_metrics(metrics_data, thresholds)
+        
+        # Only anomalous resources need the LLM, healthy ones are scored locally
+        recommendations = self._recommend_remediation(report, resource_config) if report.anomalous else []
+        
+        self.health_gauge.labels(resource_id=resource_id).set(report.health_score)
+        if self.prometheus_url:
+            try:
+                push_to_gateway(self.prometheus_url, job='resource_health', registry=self.registry)
+            except OSError:
+                logger.warning("Pushing resource health to Prometheus failed", exc_info=True)
+        
+        return ResourceHealth(
+            resource_id=resource_id,
+            health_score=report.health_score,
+            issues=report.issues,
+            recommendations=recommendations
         )
-        dataset.traces.add(trace)
 
-    def _add_to_evaluation_dataset(self, trace: Trace) -> None:
-        dataset, _ = TraceDataset.objects.get_or_create(
-            type='evaluation',
-            defaults={'created_at': datetime.now()}
+    def analyze_fleet(self, metrics_data: pd.DataFrame, resources: List[CloudResource],
+                      recommendations: bool = False, batches_per_worker: int = 4) -> Iterator[ResourceHealth]:
+        configs = {resource.id: resource.configuration or {} for resource in resources}
+        if 'resource_id' not in metrics_data.columns and len(resources) == 1:
+            metrics_data = metrics_data.assign(resource_id=resources[0].id)
+
+        work = []
+        for resource_id, frame in metrics_data.groupby('resource_id', sort=False):
+            config = configs.get(resource_id)
+            if config is not None:
+                work.append((resource_id, frame, {**self.alert_thresholds, **config.get('alert_thresholds', {})}))
+
+        pool = get_health_pool(self.health_workers)
+        batch_size = max(1, math.ceil(len(work) / ((self.health_workers or 1) * batches_per_worker)))
+        futures = [pool.submit(score_metrics_batch, work[i:i + batch_size])
+                   for i in range(0, len(work), batch_size)]
+
+        try:
+            # Resources without samples in the window have nothing to score
+            for resource_id in configs.keys() - {item[0] for item in work}:
+                yield self._fleet_result(resource_id, HealthReport(
+                    health_score=100.0, issues=[], anomalous=False, metrics={}
+                ), configs[resource_id], False)
+
+            for future in as_completed(futures):
+                for resource_id, report in future.result():
+                    yield self._fleet_result(resource_id, HealthReport(**report),
+                                             configs[resource_id], recommendations)
+        finally:
+            for future in futures:
+                future.cancel()
+            # One push for the whole fleet instead of one per resource
+            if self.prometheus_url:
+                try:
+                    push_to_gateway(self.prometheus_url, job='resource_health', registry=self.registry)
+                except OSError:
+                    logger.warning("Pushing fleet health to Prometheus failed", exc_info=True)
+
+    def _fleet_result(self, resource_id: int, report: HealthReport, resource_config: Dict,
+                      recommendations: bool) -> ResourceHealth:
+        self.health_gauge.labels(resource_id=str(resource_id)).set(report.health_score)
+        return ResourceHealth(
+            resource_id=str(resource_id),
+            health_score=report.health_score,
+            issues=report.issues,
+            recommendations=self._recommend_remediation(report, resource_config)
+            if recommendations and report.anomalous else []
         )
-        dataset.traces.add(trace)
 
-    def _create_ticket(self, trace: Trace) -> None:
-        if self.webhook_url:
+    def _recommend_remediation(self, report: HealthReport, resource_config: Dict) -> List[str]:
+        prompt = f"""
+        Resource configuration:
+        {json.dumps(resource_config, separators=(',', ':'))}
+        
+        Detected issues:
+        {chr(10).join(f"- {issue}" for issue in report.issues)}
+        
+        Metric summary (last 24h):
+        {json.dumps(report.metrics, separators=(',', ':'))}
+        
+        Suggest concrete remediation steps, one per line, without numbering.
+        """
+        content = self._complete("You are an expert DevOps engineer.", prompt,
+                                 feature='resource_recommendations')
+        return [line.strip(" -*\t") for line in content.splitlines() if line.strip(" -*\t")]
+
+    def process_trace(self, trace_data: dict, resource: CloudResource) -> None:
+        self.process_traces([(trace_data, resource)])
+
+    def process_traces(self, items: List[Tuple[Dict, CloudResource]]) -> List[Trace]:
+        dataset_ids = get_trace_dataset_ids()
+        Membership = TraceDataset.traces.through
+
+        with transaction.atomic():
+            # Ticket intents are persisted with the traces and delivered by core.tickets
+            ticket_keys = [
+                ticket_coalesce_key(trace_data, resource) if trace_data.get('error') else None
+                for trace_data, resource in items
+            ]
+            outbox = self._enqueue_tickets([
+                (key, trace_data, resource)
+                for key, (trace_data, resource) in zip(ticket_keys, items) if key
+            ])
+
+            # Postgres returns the primary keys, so memberships can be built without re-reading.
+            # Traces that coalesce into an already delivered ticket take its id now, the
+            # dispatcher only fills in ticket_id for traces that exist when it delivers
+            traces = Trace.objects.bulk_create([
+                Trace(
+                    resource=resource,
+                    status='error' if trace_data.get('error') else 'success',
+                    content=trace_data,
+                    ticket_outbox_id=outbox.get(key, (None, None))[0],
+                    ticket_id=outbox.get(key, (None, None))[1]
+                )
+                for key, (trace_data, resource) in zip(ticket_keys, items)
+            ], batch_size=1000)
+
+            memberships = []
+            for trace in traces:
+                # Handle error traces
+                if trace.status == 'error':
+                    memberships.append(Membership(tracedataset_id=dataset_ids['error'], trace_id=trace.id))
+                # Handle successful traces (sampled)
+                elif random.random() < self.trace_sample_rate:
+                    memberships.append(Membership(tracedataset_id=dataset_ids['evaluation'], trace_id=trace.id))
+
+            Membership.objects.bulk_create(memberships, batch_size=1000, ignore_conflicts=True)
+
+        return traces
+
+    def _enqueue_tickets(self, error_items: List[Tuple[str, Dict, CloudResource]]) -> Dict[str, Tuple]:
+        if not self.webhook_url or not error_items:
+            return {}
+
+        # Repeated errors from one resource collapse into a single ticket per coalesce window
+        grouped = {}
+        for key, trace_data, resource in error_items:
+            if key in grouped:
+                grouped[key][2] += 1
+            else:
+                grouped[key] = [resource, trace_data, 1]
+
+        rows = []
+        for key, (resource, trace_data, occurrences) in grouped.items():
             payload = {
-                'title': f'Error Trace - Resource {trace.resource.identifier}',
-                'description': json.dumps(trace.content, indent=2),
+                'title': f'Error Trace - Resource {resource.resource_id}',
+                'description': json.dumps(trace_data, indent=2),
                 'priority': 'high',
                 'type': 'error_trace'
             }
-            response = requests.post(self.webhook_url, json=payload)
-            if response.ok:
-                trace.ticket_id = response.json().get('ticket_id')
-                trace.save()
+            rows.append((resource.id, key, json.dumps(payload), occurrences))
+        return enqueue_ticket_outbox(rows)
 
     def _classify_email(self, content: str) -> Dict:
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are an email classifier."},
-                {"role": "user", "content": content}
-            ]
-        )
-        return {"classification": response.choices[0].message.content}
+        local, local_category = self._classify_locally(content)
+        if local is not None:
+            return local
+        classification = self._classify_email_llm(content)
+        if local_category is not None:
+            record_agreement(current_organization_id(), local_category, classification['category'])
+        return classification
+
+    def _classify_locally(self, content: str) -> Tuple[Optional[Dict], Optional[str]]:
+        # A sample of confident local answers still goes to the LLM, so agreement keeps
+        # being measured on the emails the classifier actually answers
+        if self.classifier is None:
+            return None, None
+        local, local_category = self.classifier.predict(current_organization_id(), content)
+        if local is not None and random.random() < self.classifier.shadow_rate:
+            return None, local_category
+        return local, local_category
+
+    def _classify_email_llm(self, content: str) -> Dict:
+        prompt = f"""
+        Classify this email:
+        
+        {content}
+        
+        category: one of inquiry, support, sales, complaint, billing, spam, other
+        priority: one of low, medium, high
+        intent: what the sender wants, in a few words
+        confidence: 0 to 1, how sure you are of the category
+        """
+        return self._complete_structured("You are an email classifier.", prompt, EmailClassification,
+                                         feature='email_classification').model_dump()
 
     def _generate_email_response(self, content: str, org_name: str) -> str:
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": f"You are representing {org_name}."},
-                {"role": "user", "content": content}
-            ]
-        )
-        return response.choices[0].message.content
+        return self._complete(f"You are representing {org_name}.", content,
+                              feature='email_response')
 
     def process_social_message(self, 
                              message_content: str,
                              conversation_history: List[Dict],
                              current_stage: str,
-                             context_data: Dict) -> MessageAnalysis:
+                             context_data: Dict,
+                             summary: Optional[str] = None) -> MessageAnalysis:
+        if self.social_mode == 'fused':
+            try:
+                return self._analyze_social_message_fused(
+                    message_content,
+                    conversation_history,
+                    current_stage,
+                    context_data,
+                    summary
+                )
+            except ValidationError:
+                # Fall through to the two-call path if the model can't satisfy the schema
+                pass
         
         prompt = self._create_social_prompt(
             message_content, 
             conversation_history,
             current_stage,
-            context_data
+            context_data,
+            summary=summary
         )
         
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are an expert sales assistant."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        if self.parallel:
+            # The extracted context only depends on the customer's message, so it can be
+            # built while the analysis is still running
+            content, updated_context = self._run_concurrently(
+                (self._complete_validated, "You are an expert sales assistant.", prompt, 'social_analysis',
+                 self._is_json_object),
+                (self._update_context, message_content, context_data)
+            )
+        else:
+            content = self._complete_validated("You are an expert sales assistant.", prompt,
+                                               'social_analysis', self._is_json_object)
+            # Actualizar contexto basado en el nuevo mensaje
+            updated_context = self._update_context(message_content, context_data, content)
         
-        # Actualizar contexto basado en el nuevo mensaje
-        updated_context = self._update_context(
+        return self._build_social_analysis(content, updated_context)
+
+    def _analyze_social_message_fused(self,
+                                      message_content: str,
+                                      conversation_history: List[Dict],
+                                      current_stage: str,
+                                      context_data: Dict,
+                                      summary: Optional[str] = None) -> MessageAnalysis:
+        prompt = self._create_social_prompt(
             message_content,
+            conversation_history,
+            current_stage,
             context_data,
-            response.choices[0].message.content
+            fused=True,
+            summary=summary
         )
         
-        analysis = self._parse_social_analysis(response.choices[0].message.content)
-        analysis.updated_context = updated_context
+        analysis = self._complete_structured(
+            "You are an expert sales assistant.",
+            prompt,
+            MessageAnalysis,
+            feature='social_analysis'
+        )
         
+        # The model only returns the keys that changed, merge them into the stored context
+        analysis.updated_context = {**context_data, **analysis.updated_context}
         return analysis
 
-    def _update_context(self, message: str, current_context: Dict, ai_response: str) -> Dict:
+    def stream_social_message(self,
+                              message_content: str,
+                              conversation_history: List[Dict],
+                              current_stage: str,
+                              context_data: Dict,
+                              summary: Optional[str] = None) -> Iterator[Union[str, MessageAnalysis]]:
+        # Yields the reply as it is generated, then the finished MessageAnalysis. The rest of
+        # the analysis runs alongside the stream so it is usually ready when the reply ends
+        executor = get_llm_executor(self.max_workers)
+        update = executor.submit(
+            contextvars.copy_context().run,
+            self._complete_structured,
+            "You are an expert sales assistant.",
+            self._create_social_prompt(message_content, conversation_history, current_stage,
+                                       context_data, fused=True, respond=False, summary=summary),
+            SocialMessageUpdate,
+            'social_analysis'
+        )
+
+        try:
+            prompt = self._create_reply_prompt(message_content, conversation_history, current_stage,
+                                               context_data, summary)
+            route = self.router.route('social_reply', len(prompt))
+            model = route.model
+            started = time.monotonic()
+            stream = self.client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "You are an expert sales assistant."},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=True,
+                # The last chunk then carries the usage. openai 1.12 has no stream_options
+                # argument and hands that usage back as a plain dict
+                extra_body={"stream_options": {"include_usage": True}},
+                timeout=self.llm_timeout
+            )
+            parts, usage = [], None
+            for chunk in stream:
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+            if isinstance(usage, dict):
+                usage = types.SimpleNamespace(**usage)
+            if usage is None:
+                # Servers that ignore stream_options: about one token per chunk, 4 chars a prompt token
+                usage = types.SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(parts))
+            meter_completion(model, usage)
+            self.router.log('social_reply', route, time.monotonic() - started, usage)
+            reply = "".join(parts)
+
+            try:
+                result = update.result(timeout=self.llm_timeout)
+                updated_context = {**context_data, **result.updated_context}
+            except ValidationError:
+                result = self._default_social_update(current_stage)
+                updated_context = self._update_context(message_content, context_data, reply)
+            except Exception:
+                # The reply has already been streamed, so the turn is still saved
+                logger.exception("Social analysis failed, keeping the streamed reply with the default analysis")
+                result = self._default_social_update(current_stage)
+                updated_context = context_data
+        finally:
+            update.cancel()
+
+        yield MessageAnalysis(
+            intent=result.intent,
+            sentiment=result.sentiment,
+            suggested_response=reply,
+            lead_score_delta=result.lead_score_delta,
+            suggested_stage=result.suggested_stage,
+            updated_context=updated_context
+        )
+
+    def _default_social_update(self, current_stage: str) -> SocialMessageUpdate:
+        return SocialMessageUpdate(intent={"type": "unknown"}, sentiment=0.0, lead_score_delta=0.0,
+                                   suggested_stage=current_stage, updated_context={})
+
+    def _create_reply_prompt(self, message: str, history: List[Dict], stage: str, context_data: Dict,
+                             summary: Optional[str] = None) -> str:
+        return f"""
+        Current sales stage: {stage}
+        
+        Conversation history:
+        {self._format_conversation_history(history, summary)}
+        
+        New message from customer:
+        {message}
+        
+        Context data:
+        {json.dumps(context_data, separators=(',', ':'))}
+        
+        Write the reply to send to the customer. Answer with the message text only.
+        """
+
+    def _update_context(self, message: str, current_context: Dict, ai_response: Optional[str] = None) -> Dict:
+        ai_response_line = f"AI Response: {ai_response}" if ai_response else ""
         context_prompt = f"""
         Based on this message and current context, update the context information:
         
         Message: {message}
-        Current Context: {json.dumps(current_context, indent=2)}
-        AI Response: {ai_response}
+        Current Context: {json.dumps(current_context, separators=(',', ':'))}
+        {ai_response_line}
         
         Extract and update:
         1. Customer preferences
@@ -161,16 +774,11 @@ class AIAgent:
         Return as JSON.
         """
         
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You update conversation context."},
-                {"role": "user", "content": context_prompt}
-            ]
-        )
+        content = self._complete_validated("You update conversation context.", context_prompt,
+                                           'social_context', self._is_json_object)
         
         try:
-            return json.loads(response.choices[0].message.content)
+            return json.loads(content)
         except:
             return current_context
 
@@ -178,18 +786,51 @@ class AIAgent:
                             message: str, 
                             history: List[Dict],
                             stage: str,
-                            context_data: Dict) -> str:
+                            context_data: Dict,
+                            fused: bool = False,
+                            respond: bool = True,
+                            summary: Optional[str] = None) -> str:
+        if fused:
+            fields = [
+                'intent: customer intent, with at least a "type" key',
+                'sentiment: scale -1 to 1',
+                'suggested_response: reply to send to the customer',
+                'lead_score_delta: lead score adjustment (-1 to 1)',
+                'suggested_stage: one of lead, qualifying, proposal, negotiation, closed_won, closed_lost',
+                'updated_context: only the context keys that are new or changed by this message\n'
+                '           (customer preferences, key discussion points, important dates/numbers,\n'
+                '           action items, relevant tags)',
+            ]
+            if not respond:
+                fields = [field for field in fields if not field.startswith('suggested_response')]
+            aspects = "\n        ".join(f"{i}. {field}" for i, field in enumerate(fields, start=1))
+            return f"""
+        Current sales stage: {stage}
+        
+        Conversation history:
+        {self._format_conversation_history(history, summary)}
+        
+        New message from customer:
+        {message}
+        
+        Context data:
+        {json.dumps(context_data, separators=(',', ':'))}
+        
+        Analyze the following aspects:
+        {aspects}
+        """
+
         return f"""
         Current sales stage: {stage}
         
         Conversation history:
-        {self._format_conversation_history(history)}
+        {self._format_conversation_history(history, summary)}
         
         New message from customer:
         {message}
         
         Context data:
-        {json.dumps(context_data, indent=2)}
+        {json.dumps(context_data, separators=(',', ':'))}
         
         Analyze the following aspects:
         1. Customer intent
@@ -201,21 +842,192 @@ class AIAgent:
         Provide analysis in JSON format.
         """
 
-    def _format_conversation_history(self, history: List[Dict]) -> str:
-        formatted = []
+    def _format_conversation_history(self, history: List[Dict], summary: Optional[str] = None) -> str:
+        formatted = [f"Summary of earlier conversation: {summary}"] if summary else []
         for msg in history:
             sender = "Customer" if msg['is_from_contact'] else "Agent"
             formatted.append(f"{sender}: {msg['content']}")
         return "\n".join(formatted)
 
+    def summarize_conversation(self, summary: str, messages: List[Dict], max_words: int = 200) -> str:
+        prompt = f"""
+        Current summary of the conversation:
+        {summary or "(none)"}
+        
+        New messages:
+        {self._format_conversation_history(messages)}
+        
+        Rewrite the summary so it also covers the new messages. Keep customer needs, objections,
+        commitments, dates and numbers. Use at most {max_words} words and answer with the summary only.
+        """
+        return self._complete("You summarize sales conversations.", prompt,
+                              feature='social_summary').strip()
+
+    def analyze_sales_call(self, transcript_stream: Iterator, window_seconds: float = 300.0,
+                           max_transcript_chars: int = 12000) -> Iterator:
+        # Passes the transcription stream through, scoring sentiment on windows of the call as
+        # soon as their chunks are in and coaching on the whole call at the end. Yields the
+        # stream's TranscriptChunk/Transcript items, CallSentiment per window, then SalesCallAnalysis
+        executor = get_llm_executor(self.max_workers)
+        chunks: Dict[int, TranscriptChunk] = {}
+        futures, reported = [], set()
+        next_index, window = 0, []
+        transcript = None
+        try:
+            for item in transcript_stream:
+                yield item
+                if isinstance(item, Transcript):
+                    transcript = item
+                    continue
+                chunks[item.index] = item
+                # Windows are cut from the chunks that are already contiguous from the start
+                while next_index in chunks:
+                    window.append(chunks[next_index])
+                    next_index += 1
+                    if window[-1].end - window[0].start >= window_seconds:
+                        futures.append(executor.submit(contextvars.copy_context().run, self._call_sentiment, window))
+                        window = []
+                for future in futures:
+                    if future.done() and future not in reported:
+                        reported.add(future)
+                        yield self._sentiment_result(future)
+
+            if window:
+                futures.append(executor.submit(contextvars.copy_context().run, self._call_sentiment, window))
+            results = {future: self._sentiment_result(future) for future in futures}
+            for future, result in results.items():
+                if future not in reported:
+                    yield result
+        finally:
+            for future in futures:
+                future.cancel()
+
+        if transcript is None:
+            yield CallAnalysisError(stage='transcription', error="Transcription ended without a transcript")
+            return
+        # Windows whose sentiment failed were already reported, coaching goes on without them
+        sentiments = [result for result in results.values() if isinstance(result, CallSentiment)]
+        yield self._coach_sales_call(transcript, sentiments, max_transcript_chars)
+
+    def _sentiment_result(self, future) -> Union[CallSentiment, CallAnalysisError]:
+        try:
+            return future.result(timeout=self.llm_timeout)
+        except Exception:
+            logger.exception("Sentiment analysis of a sales call window failed")
+            return CallAnalysisError(stage='sentiment', error="Sentiment analysis failed for part of the call")
+
+    def _call_sentiment(self, window: List[TranscriptChunk]) -> CallSentiment:
+        text = " ".join(chunk.text for chunk in window if chunk.text)
+        prompt = f"""
+        Part of a sales call transcript, {window[0].start:.0f}s to {window[-1].end:.0f}s:
+        
+        {text or "(silence)"}
+        
+        Return:
+        sentiment: -1 (hostile) to 1 (enthusiastic), the customer's attitude in this part
+        summary: one sentence on what happened
+        objections: customer objections raised, empty if none
+        start: {window[0].start:.1f}
+        end: {window[-1].end:.1f}
+        """
+        return self._complete_structured("You analyze sales calls.", prompt, CallSentiment,
+                                         feature='call_sentiment')
+
+    def _coach_sales_call(self, transcript: Transcript, sentiments: List[CallSentiment],
+                          max_transcript_chars: int) -> SalesCallAnalysis:
+        # The window notes cover the whole call, the raw transcript only as far as it fits
+        timeline = "\n".join(
+            f"{s.start / 60:.0f}-{s.end / 60:.0f} min, sentiment {s.sentiment:+.1f}: {s.summary}"
+            + (f" Objections: {'; '.join(s.objections)}" if s.objections else "")
+            for s in sentiments
+        )
+        text = transcript.text if len(transcript.text) <= max_transcript_chars else (
+            transcript.text[:max_transcript_chars // 2] + " [...] " + transcript.text[-max_transcript_chars // 2:]
+        )
+        prompt = f"""
+        Sales call of {transcript.duration / 60:.0f} minutes.
+        
+        Timeline:
+        {timeline or "(none)"}
+        
+        Transcript:
+        {text or "(empty)"}
+        
+        As a sales coach, return:
+        sentiment: -1 to 1, the customer's overall attitude
+        score: 0 to 100, how well the salesperson handled the call
+        summary: what happened in two or three sentences
+        strengths: what the salesperson did well
+        improvements: concrete things to do better next time
+        objections: the customer's objections and whether they were handled
+        next_steps: agreed or recommended follow-ups
+        """
+        return self._complete_structured("You are an experienced sales coach.", prompt, SalesCallAnalysis,
+                                         feature='sales_coaching')
+
+    @staticmethod
+    def _is_json_object(content: str) -> bool:
+        try:
+            return isinstance(json.loads(content), dict)
+        except (TypeError, ValueError):
+            return False
+
     def _parse_social_analysis(self, content: str) -> Dict:
         try:
             return json.loads(content)
         except:
-            return {
-                "intent": {"type": "unknown"},
-                "sentiment": 0.0,
-                "suggested_response": "I apologize, but I need more context to provide a proper response.",
-                "lead_score_delta": 0.0,
-                "suggested_stage": "lead"
-            }
\ No newline at end of file
+            return dict(DEFAULT_SOCIAL_ANALYSIS)
+
+    def _build_social_analysis(self, content: str, updated_context: Dict) -> MessageAnalysis:
+        # The two-call analysis is free-form JSON: unknown keys are dropped, missing ones take
+        # the defaults, and anything that still doesn't fit the schema gets the default analysis
+        parsed = self._parse_social_analysis(content)
+        fields = {key: value for key, value in parsed.items() if key in MessageAnalysis.model_fields} \
+            if isinstance(parsed, dict) else {}
+        try:
+            return MessageAnalysis(**{**DEFAULT_SOCIAL_ANALYSIS, **fields, 'updated_context': updated_context})
+        except ValidationError:
+            logger.warning("Social analysis didn't match the schema, using the default analysis")
+            return MessageAnalysis(**DEFAULT_SOCIAL_ANALYSIS, updated_context=updated_context)
+
+_agent: Optional[AIAgent] = None
+_agent_lock = threading.Lock()
+
+def get_agent() -> AIAgent:
+    global _agent
+    with _agent_lock:
+        if _agent is None:
+            agent_settings = settings.AGENT_SETTINGS
+            client = build_openai_client(
+                settings.OPENAI_API_KEY,
+                max_connections=agent_settings['http_max_connections'],
+                max_keepalive_connections=agent_settings['http_max_keepalive_connections'],
+                keepalive_expiry=agent_settings['http_keepalive_expiry'],
+                timeout=agent_settings['llm_timeout'],
+                max_retries=agent_settings['openai_max_retries']
+            )
+            _agent = AIAgent(
+                api_key=settings.OPENAI_API_KEY,
+                prometheus_url=settings.DEVOPS_SETTINGS.get('prometheus_url'),
+                webhook_url=settings.TRACE_SETTINGS['ticket_webhook_url'],
+                llm_timeout=agent_settings['llm_timeout'],
+                parallel=agent_settings['parallel_llm_calls'],
+                max_workers=agent_settings['llm_max_workers'],
+                social_mode=agent_settings['social_analysis_mode'],
+                cache=get_llm_cache(),
+                client=client,
+                router=build_model_router(),
+                trace_sample_rate=settings.TRACE_SETTINGS['evaluation_sample_rate'],
+                alert_thresholds=settings.DEVOPS_SETTINGS['alert_thresholds'],
+                health_workers=settings.DEVOPS_SETTINGS['fleet_workers'],
+                classifier=get_email_classifier()
+            )
+            get_llm_executor(agent_settings['llm_max_workers'])
+        return _agent
+
+def warm_up() -> None:
+    try:
+        get_agent().warm_up(open_connection=settings.AGENT_SETTINGS['warm_up_connection'])
+    except Exception:
+        # A cold start is slower, not broken, so never keep a worker from booting
+        logger.warning("Agent warm-up failed", exc_info=True)
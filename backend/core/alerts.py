@@ -0,0 +1,252 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+import json
+import logging
+import threading
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from redis.exceptions import LockError
+from .cache import get_redis_client
+from .models import Alert, CloudResource
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES = {
+    'avg': lambda values: sum(values) / len(values),
+    'max': max,
+    'min': min,
+    'last': lambda values: values[-1],
+}
+
+class AlertRule(NamedTuple):
+    name: str
+    metric_name: str
+    threshold: float
+    aggregate: str
+    window: int
+    for_duration: int
+    hysteresis: float
+    severity: str
+
+    @property
+    def clear_threshold(self) -> float:
+        return self.threshold - abs(self.threshold) * self.hysteresis
+
+class Transition(NamedTuple):
+    resource_id: int
+    rule: AlertRule
+    firing: bool
+    value: float
+    timestamp: datetime
+
+def build_rules(resource_config: Dict, defaults: Optional[Dict[str, float]] = None) -> List[AlertRule]:
+    # Plain thresholds become rules with the ALERT_SETTINGS defaults, alert_rules entries
+    # can set any rule field and replace the threshold rule for their metric
+    alert_settings = settings.ALERT_SETTINGS
+    thresholds = {**(defaults or {}), **resource_config.get('alert_thresholds', {})}
+    specs = {metric: {'metric': metric, 'threshold': threshold} for metric, threshold in thresholds.items()}
+    for spec in resource_config.get('alert_rules', []):
+        specs[spec.get('name', spec.get('metric'))] = spec
+
+    rules = []
+    for name, spec in specs.items():
+        try:
+            rules.append(AlertRule(
+                name=spec.get('name', f"{spec['metric']}_high"),
+                metric_name=spec['metric'],
+                threshold=float(spec['threshold']),
+                aggregate=spec.get('aggregate', alert_settings['aggregate']),
+                window=int(spec.get('window', alert_settings['window'])),
+                for_duration=int(spec.get('for', alert_settings['for_duration'])),
+                hysteresis=float(spec.get('hysteresis', alert_settings['hysteresis'])),
+                severity=spec.get('severity', alert_settings['severity'])
+            ))
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Ignoring invalid alert rule %s", name)
+    return [rule for rule in rules if rule.aggregate in AGGREGATES]
+
+class AlertStateStore:
+    # Per (resource, rule) state: samples inside the window, when the condition started
+    # holding, whether the rule is firing and the newest sample seen
+    def __init__(self, redis_client=None, ttl: int = 86400, lock_timeout: int = 30):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self._memory: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._evaluation_lock = threading.Lock()
+
+    @contextmanager
+    def locked(self, resource_ids: Iterable[int]):
+        # Evaluating is load, update and save of the states, so two workers with samples of
+        # the same resource take turns. Locks are taken in id order to avoid deadlocks
+        if self.redis is None:
+            with self._evaluation_lock:
+                yield
+            return
+        locks = []
+        try:
+            for resource_id in sorted(resource_ids):
+                lock = self.redis.lock(f"alerts:lock:{resource_id}", timeout=self.lock_timeout,
+                                       blocking_timeout=self.lock_timeout)
+                if not lock.acquire():
+                    raise TimeoutError(f"Alert state of resource {resource_id} is still busy")
+                locks.append(lock)
+            yield
+        finally:
+            for lock in reversed(locks):
+                try:
+                    lock.release()
+                except LockError:
+                    logger.warning("Alert lock %s expired before the evaluation finished", lock.name)
+
+    @staticmethod
+    def key(resource_id: int, rule: AlertRule) -> str:
+        return f"alerts:{resource_id}:{rule.name}"
+
+    def load(self, keys: List[str]) -> Dict[str, Dict]:
+        if not keys:
+            return {}
+        if self.redis is None:
+            with self._lock:
+                return {key: json.loads(json.dumps(self._memory[key])) for key in keys if key in self._memory}
+        return {key: json.loads(value) for key, value in zip(keys, self.redis.mget(keys)) if value}
+
+    def save(self, states: Dict[str, Dict]) -> None:
+        if not states:
+            return
+        if self.redis is None:
+            with self._lock:
+                self._memory.update(states)
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, state in states.items():
+            # Firing state never expires so the alert can still resolve after a long gap
+            pipeline.set(key, json.dumps(state, separators=(',', ':')),
+                         ex=None if state['firing'] else self.ttl)
+        pipeline.execute()
+
+def evaluate(state: Dict, rule: AlertRule, samples: List[Tuple[float, float]],
+             max_window_samples: int) -> Optional[Tuple[bool, float, float]]:
+    # samples are (epoch seconds, value) in timestamp order, returns the last
+    # (firing, aggregate, timestamp) transition if the rule changed state
+    transition = None
+    window = state['window']
+    for ts, value in samples:
+        if ts <= state['last_ts']:
+            # Replayed or late samples don't move the state backwards
+            continue
+        state['last_ts'] = ts
+        window.append((ts, value))
+        cutoff = ts - rule.window
+        while window and window[0][0] <= cutoff:
+            window.pop(0)
+        del window[:-max_window_samples]
+
+        current = AGGREGATES[rule.aggregate]([v for _, v in window])
+        if not state['firing']:
+            if current > rule.threshold:
+                state['pending_since'] = state['pending_since'] or ts
+                if ts - state['pending_since'] >= rule.for_duration:
+                    state['firing'] = True
+                    state['pending_since'] = None
+                    transition = (True, current, ts)
+            else:
+                state['pending_since'] = None
+        elif current < rule.clear_threshold:
+            state['firing'] = False
+            transition = (False, current, ts)
+    return transition
+
+class AlertEvaluator:
+    def __init__(self, store: AlertStateStore, default_thresholds: Optional[Dict[str, float]] = None,
+                 max_window_samples: int = 600):
+        self.store = store
+        self.default_thresholds = default_thresholds or {}
+        self.max_window_samples = max_window_samples
+
+    def process(self, rows: Iterable[Tuple]) -> List[Transition]:
+        # rows are (resource_id, metric_name, value, unit, timestamp) as written by core.ingest
+        series: Dict[Tuple[int, str], List[Tuple[float, float]]] = defaultdict(list)
+        for resource_id, metric_name, value, _, timestamp in rows:
+            series[(resource_id, metric_name)].append((timestamp.timestamp(), value))
+        if not series:
+            return []
+
+        configs = dict(CloudResource.objects.filter(
+            id__in={resource_id for resource_id, _ in series}
+        ).values_list('id', 'configuration'))
+
+        work = []
+        for (resource_id, metric_name), samples in series.items():
+            samples.sort()
+            for rule in build_rules(configs.get(resource_id) or {}, self.default_thresholds):
+                if rule.metric_name == metric_name:
+                    work.append((self.store.key(resource_id, rule), resource_id, rule, samples))
+
+        with self.store.locked({resource_id for _, resource_id, _, _ in work}):
+            states = self.store.load([key for key, _, _, _ in work])
+            changed, transitions = {}, []
+            for key, resource_id, rule, samples in work:
+                state = states.get(key) or {'window': [], 'pending_since': None, 'firing': False, 'last_ts': 0.0}
+                state['window'] = [tuple(item) for item in state['window']]
+                result = evaluate(state, rule, samples, self.max_window_samples)
+                changed[key] = state
+                if result is not None:
+                    firing, value, ts = result
+                    transitions.append(Transition(
+                        resource_id, rule, firing, value, datetime.fromtimestamp(ts, tz=dt_timezone.utc)
+                    ))
+
+            # Alert rows only change on transitions, the database never sees the samples themselves
+            apply_transitions(transitions)
+            self.store.save(changed)
+        return transitions
+
+def apply_transitions(transitions: List[Transition]) -> None:
+    if not transitions:
+        return
+
+    opened = [t for t in transitions if t.firing]
+    resolved = [t for t in transitions if not t.firing]
+    now = timezone.now()
+    with transaction.atomic():
+        # The partial unique constraint turns a second open for an active alert into a no-op
+        Alert.objects.bulk_create([
+            Alert(
+                resource_id=t.resource_id,
+                rule=t.rule.name,
+                title=f"{t.rule.metric_name} above {t.rule.threshold:g}",
+                description=(f"{t.rule.aggregate} of {t.rule.metric_name} over {t.rule.window}s was "
+                             f"{t.value:.2f} for at least {t.rule.for_duration}s "
+                             f"(threshold {t.rule.threshold:g}) at {t.timestamp.isoformat()}"),
+                severity=t.rule.severity
+            )
+            for t in opened
+        ], ignore_conflicts=True)
+        for t in resolved:
+            Alert.objects.filter(resource_id=t.resource_id, rule=t.rule.name, is_active=True).update(
+                is_active=False,
+                resolved_at=now,
+                resolution_note=(f"{t.rule.aggregate} of {t.rule.metric_name} dropped to {t.value:.2f}, "
+                                 f"below {t.rule.clear_threshold:g} at {t.timestamp.isoformat()}")
+            )
+
+_alert_evaluator: Optional[AlertEvaluator] = None
+_alert_evaluator_lock = threading.Lock()
+
+def get_alert_evaluator() -> AlertEvaluator:
+    global _alert_evaluator
+    with _alert_evaluator_lock:
+        if _alert_evaluator is None:
+            alert_settings = settings.ALERT_SETTINGS
+            redis_client = get_redis_client() if alert_settings['state_backend'] == 'redis' else None
+            _alert_evaluator = AlertEvaluator(
+                AlertStateStore(redis_client, lock_timeout=alert_settings['lock_timeout']),
+                default_thresholds=settings.DEVOPS_SETTINGS['alert_thresholds'],
+                max_window_samples=alert_settings['max_window_samples']
+            )
+        return _alert_evaluator
@@ -0,0 +1,125 @@
+from typing import Dict, Optional
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import time
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_redis_client: Optional[redis.Redis] = None
+_redis_lock = threading.Lock()
+
+def get_redis_client() -> redis.Redis:
+    global _redis_client
+    with _redis_lock:
+        if _redis_client is None:
+            _redis_client = redis.Redis(
+                host=settings.REDIS_HOST,
+                port=int(settings.REDIS_PORT),
+                password=settings.REDIS_PASSWORD,
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5
+            )
+        return _redis_client
+
+def llm_cache_key(model: str, system: str, user: str) -> str:
+    # Whitespace differences (indentation, trailing newlines) shouldn't produce a new entry
+    normalized = json.dumps([model, " ".join(system.split()), " ".join(user.split())])
+    return 'llm:' + hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+class LLMCache:
+    def __init__(self, ttls: Dict[str, int], l1_max_entries: int = 1024,
+                 redis_client: Optional[redis.Redis] = None, enabled: bool = True):
+        self.ttls = ttls
+        self.l1_max_entries = l1_max_entries
+        self.redis = redis_client
+        self.enabled = enabled
+        self._l1: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'errors': 0}
+
+    def ttl_for(self, feature: Optional[str]) -> int:
+        if not self.enabled or feature is None:
+            return 0
+        return self.ttls.get(feature, 0)
+
+    def get(self, key: str, feature: str) -> Optional[str]:
+        ttl = self.ttl_for(feature)
+        if not ttl:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._l1.move_to_end(key)
+                    self._stats['l1_hits'] += 1
+                    return value
+                del self._l1[key]
+
+        value = None
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(key)
+                value = raw.decode('utf-8') if raw is not None else None
+            except redis.RedisError:
+                logger.warning("LLM cache lookup failed, treating as miss", exc_info=True)
+                self._count('errors')
+
+        if value is None:
+            self._count('misses')
+            return None
+
+        self._count('l2_hits')
+        self._store_l1(key, value, ttl)
+        return value
+
+    def set(self, key: str, value: str, feature: str) -> None:
+        ttl = self.ttl_for(feature)
+        if not ttl:
+            return
+
+        self._store_l1(key, value, ttl)
+        if self.redis is not None:
+            try:
+                self.redis.set(key, value, ex=ttl)
+            except redis.RedisError:
+                logger.warning("LLM cache write failed", exc_info=True)
+                self._count('errors')
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'l1_size': len(self._l1)}
+
+    def _store_l1(self, key: str, value: str, ttl: int) -> None:
+        with self._lock:
+            self._l1[key] = (value, time.monotonic() + ttl)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_max_entries:
+                self._l1.popitem(last=False)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+_llm_cache: Optional[LLMCache] = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache() -> LLMCache:
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            cache_settings = settings.LLM_CACHE_SETTINGS
+            _llm_cache = LLMCache(
+                ttls=cache_settings['ttl'],
+                l1_max_entries=cache_settings['l1_max_entries'],
+                redis_client=get_redis_client() if cache_settings['use_redis'] else None,
+                enabled=cache_settings['enabled']
+            )
+        return _llm_cache
@@ -0,0 +1,116 @@
+from typing import Dict, List, NamedTuple, Optional
+import hashlib
+import hmac
+import logging
+import threading
+import httpx
+from django.conf import settings
+from .models import SocialChannel
+
+logger = logging.getLogger(__name__)
+
+# Meta webhook parsing and the Graph API client that sends replies back. WhatsApp Cloud API,
+# Messenger and Instagram share the signature scheme and differ in payload shape
+
+WEBHOOK_OBJECTS = {
+    'whatsapp_business_account': 'whatsapp',
+    'page': 'messenger',
+    'instagram': 'instagram',
+}
+
+# Longest text message each platform accepts
+MAX_TEXT_CHARS = {
+    'whatsapp': 4096,
+    'messenger': 2000,
+    'instagram': 1000,
+}
+
+class InboundMessage(NamedTuple):
+    platform: str
+    message_id: str
+    channel_external_id: str
+    contact_id: str
+    text: Optional[str]
+    payload: Dict
+
+def verify_signature(body: bytes, signature: Optional[str], app_secret: str) -> bool:
+    # X-Hub-Signature-256 is an HMAC-SHA256 of the raw body keyed with the app secret
+    if not signature or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(app_secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature[len('sha256='):])
+
+def parse_webhook(data: Dict) -> List[InboundMessage]:
+    # Delivery receipts, reads and echoes of our own replies carry no message and are skipped
+    platform = WEBHOOK_OBJECTS.get(data.get('object'))
+    messages = []
+    for entry in data.get('entry') or []:
+        if platform == 'whatsapp':
+            for change in entry.get('changes') or []:
+                value = change.get('value') or {}
+                metadata = value.get('metadata') or {}
+                for message in value.get('messages') or []:
+                    text = (message.get('text') or {}).get('body') if message.get('type') == 'text' else None
+                    messages.append(InboundMessage(
+                        'whatsapp', message['id'], metadata['phone_number_id'], message['from'], text,
+                        {'metadata': metadata, 'contacts': value.get('contacts'), 'message': message}
+                    ))
+        elif platform is not None:
+            for event in entry.get('messaging') or []:
+                message = event.get('message') or {}
+                if not message.get('mid') or message.get('is_echo'):
+                    continue
+                messages.append(InboundMessage(
+                    platform, message['mid'], str(entry['id']), str(event['sender']['id']),
+                    message.get('text'), event
+                ))
+    return messages
+
+class GraphAPIClient:
+    def __init__(self, base_url: str, version: str, timeout: float = 10.0, pool_size: int = 10,
+                 transport: Optional[httpx.BaseTransport] = None):
+        self.base_url = base_url.rstrip('/')
+        self.version = version
+        # Keep-alive pool shared by the worker's reply tasks. Tests pass an httpx.MockTransport
+        self.client = httpx.Client(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+            transport=transport
+        )
+
+    def send_text(self, channel: SocialChannel, contact_id: str, text: str) -> Dict:
+        text = text[:MAX_TEXT_CHARS.get(channel.platform, 2000)]
+        if channel.platform == 'whatsapp':
+            body = {
+                'messaging_product': 'whatsapp',
+                'recipient_type': 'individual',
+                'to': contact_id,
+                'type': 'text',
+                'text': {'body': text},
+            }
+            token = channel.access_token or settings.SOCIAL_SETTINGS['whatsapp']['api_key']
+        else:
+            body = {
+                'recipient': {'id': contact_id},
+                'messaging_type': 'RESPONSE',
+                'message': {'text': text},
+            }
+            token = channel.access_token
+        response = self.client.post(
+            f"{self.base_url}/{self.version}/{channel.external_id}/messages",
+            json=body,
+            headers={'Authorization': f"Bearer {token}"}
+        )
+        response.raise_for_status()
+        return response.json() if response.content else {}
+
+_graph_client: Optional[GraphAPIClient] = None
+_graph_client_lock = threading.Lock()
+
+def get_graph_client() -> GraphAPIClient:
+    global _graph_client
+    with _graph_client_lock:
+        if _graph_client is None:
+            meta = settings.SOCIAL_SETTINGS['meta']
+            _graph_client = GraphAPIClient(meta['graph_api_url'], meta['graph_api_version'], meta['send_timeout'])
+        return _graph_client
@@ -0,0 +1,189 @@
+from typing import Dict, List, Optional, Tuple
+from collections import Counter
+import logging
+import os
+import threading
+import time
+import joblib
+from django.conf import settings
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+from .cache import get_redis_client
+from .models import EmailInteraction, Organization
+
+logger = logging.getLogger(__name__)
+
+# Per-organization TF-IDF + logistic regression models trained from the classifications the
+# LLM already made. Confident predictions answer _classify_email locally, the rest go to the LLM
+
+def _build_pipeline(max_features: int) -> Pipeline:
+    return Pipeline([
+        ('tfidf', TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), min_df=2, max_features=max_features)),
+        ('model', LogisticRegression(max_iter=1000, class_weight='balanced')),
+    ])
+
+def model_path(organization_id: int) -> str:
+    return os.path.join(settings.EMAIL_SETTINGS['classifier_dir'], f"{organization_id}.joblib")
+
+def load_training_data(organization: Organization, max_samples: int) -> List[Tuple[str, Dict]]:
+    # Local predictions are left out so the model only ever learns from the LLM
+    rows = (EmailInteraction.objects.filter(thread__organization=organization)
+            .exclude(classification__contains={'source': 'local'})
+            .order_by('-created_at')
+            .values_list('email_content', 'classification')[:max_samples])
+    return [(content, classification) for content, classification in rows
+            if isinstance(classification, dict) and classification.get('category') and classification.get('priority')]
+
+def train_email_classifier(organization: Organization) -> Optional[Dict]:
+    email_settings = settings.EMAIL_SETTINGS
+    samples = load_training_data(organization, email_settings['classifier_max_samples'])
+    categories = Counter(classification['category'] for _, classification in samples)
+    if len(samples) < email_settings['classifier_min_samples'] or len(categories) < 2:
+        return None
+
+    texts = [content for content, _ in samples]
+    labels = {field: [classification[field] for _, classification in samples] for field in ('category', 'priority')}
+    # Held-out agreement with the LLM at the serving threshold, before refitting on everything
+    train, test = train_test_split(range(len(samples)), test_size=0.2, random_state=0)
+    threshold = email_settings['classifier_threshold']
+    holdout = _build_pipeline(email_settings['classifier_max_features']).fit(
+        [texts[i] for i in train], [labels['category'][i] for i in train]
+    )
+    probabilities = holdout.predict_proba([texts[i] for i in test])
+    confident = [(i, row.argmax()) for i, row in zip(test, probabilities) if row.max() >= threshold]
+    agreed = sum(int(holdout.classes_[best] == labels['category'][i]) for i, best in confident)
+
+    models = {}
+    for field, values in labels.items():
+        if len(set(values)) > 1:
+            models[field] = _build_pipeline(email_settings['classifier_max_features']).fit(texts, values)
+    intents = {}
+    for content, classification in samples:
+        intents.setdefault(classification['category'], Counter())[classification.get('intent') or ''] += 1
+
+    metadata = {
+        'samples': len(samples),
+        'trained_at': time.time(),
+        'holdout_coverage': len(confident) / len(test) if len(test) else 0.0,
+        'holdout_agreement': agreed / len(confident) if confident else 0.0,
+    }
+    bundle = {
+        'models': models,
+        # Used when the history has a single priority and no priority model was fit
+        'default_priority': labels['priority'][0],
+        'intents': {category: counts.most_common(1)[0][0] for category, counts in intents.items()},
+        'metadata': metadata,
+    }
+    # Written next to the old file and swapped in, so workers never load half a model
+    path = model_path(organization.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    joblib.dump(bundle, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    logger.info("Trained email classifier for organization %s: %s", organization.id, metadata)
+    return metadata
+
+def train_email_classifiers() -> Dict[int, Optional[Dict]]:
+    results = {}
+    for organization in Organization.objects.all():
+        try:
+            results[organization.id] = train_email_classifier(organization)
+        except Exception:
+            logger.exception("Training the email classifier of organization %s failed", organization.id)
+            results[organization.id] = None
+    return results
+
+class EmailClassifier:
+    def __init__(self, threshold: float, reload_interval: float = 60.0, shadow_rate: float = 0.0,
+                 enabled: bool = True):
+        self.threshold = threshold
+        self.reload_interval = reload_interval
+        self.shadow_rate = shadow_rate
+        self.enabled = enabled
+        # organization_id -> (bundle or None, file mtime, last checked)
+        self._bundles: Dict[int, Tuple[Optional[Dict], float, float]] = {}
+        self._lock = threading.Lock()
+
+    def bundle(self, organization_id: int) -> Optional[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            bundle, mtime, checked = self._bundles.get(organization_id, (None, 0.0, 0.0))
+            if checked and now - checked < self.reload_interval:
+                return bundle
+            # Other callers keep using the current bundle while this one checks the file
+            self._bundles[organization_id] = (bundle, mtime, now)
+
+        path = model_path(organization_id)
+        try:
+            current = os.path.getmtime(path)
+        except OSError:
+            current = 0.0
+        if current != mtime:
+            # Retrained by the bulk worker since the last look. Loaded outside the lock so
+            # predictions for other organizations don't wait on the disk
+            bundle = joblib.load(path) if current else None
+            with self._lock:
+                self._bundles[organization_id] = (bundle, current, now)
+        return bundle
+
+    def predict(self, organization_id: Optional[int], content: str) -> Tuple[Optional[Dict], Optional[str]]:
+        # Returns the classification when confident enough, plus the top category either way
+        # so the caller can compare it with the LLM's answer
+        if not self.enabled or organization_id is None:
+            return None, None
+        bundle = self.bundle(organization_id)
+        if bundle is None or 'category' not in bundle['models']:
+            return None, None
+
+        probabilities = bundle['models']['category'].predict_proba([content])[0]
+        best = probabilities.argmax()
+        category = str(bundle['models']['category'].classes_[best])
+        confidence = float(probabilities[best])
+        if confidence < self.threshold:
+            return None, category
+
+        priority_model = bundle['models'].get('priority')
+        return {
+            'category': category,
+            'priority': str(priority_model.predict([content])[0]) if priority_model else bundle['default_priority'],
+            'intent': bundle['intents'].get(category, ''),
+            'confidence': confidence,
+            'source': 'local',
+        }, category
+
+def record_agreement(organization_id: int, local_category: str, llm_category: str) -> None:
+    try:
+        pipeline = get_redis_client().pipeline()
+        pipeline.hincrby(f"email_classifier:agreement:{organization_id}", 'compared', 1)
+        pipeline.hincrby(f"email_classifier:agreement:{organization_id}", 'agreed', int(local_category == llm_category))
+        pipeline.execute()
+    except Exception:
+        logger.warning("Could not record classifier agreement", exc_info=True)
+
+def classifier_stats(organization_id: int) -> Dict:
+    counts = get_redis_client().hgetall(f"email_classifier:agreement:{organization_id}")
+    compared = int(counts.get(b'compared', 0))
+    agreed = int(counts.get(b'agreed', 0))
+    bundle = get_email_classifier().bundle(organization_id)
+    return {
+        'model': bundle['metadata'] if bundle else None,
+        'compared': compared,
+        'agreement': agreed / compared if compared else None,
+    }
+
+_classifier: Optional[EmailClassifier] = None
+_classifier_lock = threading.Lock()
+
+def get_email_classifier() -> EmailClassifier:
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            email_settings = settings.EMAIL_SETTINGS
+            _classifier = EmailClassifier(
+                threshold=email_settings['classifier_threshold'],
+                reload_interval=email_settings['classifier_reload_interval'],
+                shadow_rate=email_settings['classifier_shadow_rate'],
+                enabled=email_settings['classifier_enabled']
+            )
+        return _classifier
@@ -0,0 +1,394 @@
+from typing import Callable, Dict, Iterable, List, Optional
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+from pydantic import BaseModel
+from .ingest import Sample, ingest_samples
+from .models import CloudResource, Organization, ResourceMetric
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    # Token bucket shared by every thread talking to one provider
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = float(burst or max(1, int(rate)))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class Collector(ABC):
+    provider = ''
+    # metric name stored in ResourceMetric -> provider specific query, per resource_type.
+    # configuration['metrics'] on a resource replaces the defaults for its type. Percentages
+    # use the names DEVOPS_SETTINGS['alert_thresholds'], health scoring and alert rules expect
+    default_metrics: Dict[str, Dict[str, Dict]] = {}
+
+    def __init__(self, rate: float = 10.0, burst: Optional[int] = None, concurrency: int = 4):
+        self.limiter = RateLimiter(rate, burst)
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def call(self, fn: Callable, *args, **kwargs):
+        # Every provider API request goes through the rate limit
+        self.limiter.acquire()
+        return fn(*args, **kwargs)
+
+    def metrics_for(self, resource: CloudResource) -> Dict[str, Dict]:
+        configured = (resource.configuration or {}).get('metrics')
+        if configured:
+            return configured
+        return self.default_metrics.get(resource.resource_type, {})
+
+    def collect(self, resource: CloudResource, since: datetime, until: datetime,
+                cursors: Optional[Dict[str, datetime]] = None) -> List[Sample]:
+        # cursors holds the newest stored sample per metric, metrics without one start at since.
+        # The request starts at the oldest cursor so a metric the provider publishes late
+        # isn't skipped because another metric of the resource is already further along
+        metrics = self.metrics_for(resource)
+        if not metrics:
+            return []
+        starts = {metric_name: (cursors or {}).get(metric_name, since) for metric_name in metrics}
+        with self.slots:
+            samples = self.fetch(resource, metrics, min(starts.values()), until)
+        # Providers return the boundary point again, it is already stored
+        return [sample for sample in samples if sample.timestamp > starts.get(sample.metric_name, since)]
+
+    @abstractmethod
+    def fetch(self, resource: CloudResource, metrics: Dict[str, Dict],
+              since: datetime, until: datetime) -> List[Sample]:
+        pass
+
+class AWSCollector(Collector):
+    provider = 'aws'
+    default_metrics = {
+        'ec2': {
+            'cpu_utilization': {'namespace': 'AWS/EC2', 'name': 'CPUUtilization', 'dimension': 'InstanceId',
+                                'unit': 'percent'},
+            # Published by the CloudWatch agent, instances without it simply return no points
+            'memory_utilization': {'namespace': 'CWAgent', 'name': 'mem_used_percent', 'dimension': 'InstanceId',
+                                   'unit': 'percent'},
+            'network_in': {'namespace': 'AWS/EC2', 'name': 'NetworkIn', 'dimension': 'InstanceId',
+                           'stat': 'Sum', 'unit': 'bytes'},
+        },
+        'rds': {
+            'cpu_utilization': {'namespace': 'AWS/RDS', 'name': 'CPUUtilization',
+                                'dimension': 'DBInstanceIdentifier', 'unit': 'percent'},
+            'free_storage': {'namespace': 'AWS/RDS', 'name': 'FreeStorageSpace',
+                             'dimension': 'DBInstanceIdentifier', 'unit': 'bytes'},
+        },
+    }
+
+    def __init__(self, client_factory: Optional[Callable[[str], object]] = None, period: int = 60, **kwargs):
+        super().__init__(**kwargs)
+        self.period = period
+        self.client_factory = client_factory or self._boto3_client
+        self._clients: Dict[str, object] = {}
+        self._clients_lock = threading.Lock()
+
+    @staticmethod
+    def _boto3_client(region: str):
+        import boto3
+        return boto3.client('cloudwatch', region_name=region)
+
+    def client(self, region: str):
+        # boto3 clients are thread-safe, one per region is shared by all workers
+        with self._clients_lock:
+            if region not in self._clients:
+                self._clients[region] = self.client_factory(region)
+            return self._clients[region]
+
+    def fetch(self, resource, metrics, since, until):
+        queries, names = [], {}
+        for i, (metric_name, spec) in enumerate(metrics.items()):
+            query_id = f"m{i}"
+            names[query_id] = (metric_name, spec.get('unit', ''))
+            queries.append({
+                'Id': query_id,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': spec['namespace'],
+                        'MetricName': spec['name'],
+                        'Dimensions': [{'Name': spec['dimension'], 'Value': resource.resource_id}],
+                    },
+                    'Period': int(spec.get('period', self.period)),
+                    'Stat': spec.get('stat', 'Average'),
+                },
+                'ReturnData': True,
+            })
+
+        client = self.client(resource.region)
+        samples = []
+        request = {'MetricDataQueries': queries, 'StartTime': since, 'EndTime': until,
+                   'ScanBy': 'TimestampAscending'}
+        while True:
+            response = self.call(client.get_metric_data, **request)
+            for result in response['MetricDataResults']:
+                metric_name, unit = names[result['Id']]
+                samples.extend(
+                    Sample(resource.resource_id, metric_name, float(value), timestamp, unit)
+                    for timestamp, value in zip(result['Timestamps'], result['Values'])
+                )
+            if not response.get('NextToken'):
+                return samples
+            request['NextToken'] = response['NextToken']
+
+class GCPCollector(Collector):
+    provider = 'gcp'
+    default_metrics = {
+        'instance': {
+            'cpu_utilization': {'type': 'compute.googleapis.com/instance/cpu/utilization',
+                                'label': 'instance_id', 'scale': 100.0, 'unit': 'percent'},
+        },
+    }
+
+    def __init__(self, client=None, project: str = '', **kwargs):
+        super().__init__(**kwargs)
+        self.project = project
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from google.cloud import monitoring_v3
+                self._client = monitoring_v3.MetricServiceClient()
+            return self._client
+
+    def fetch(self, resource, metrics, since, until):
+        project = (resource.configuration or {}).get('project', self.project)
+        samples = []
+        for metric_name, spec in metrics.items():
+            request = {
+                'name': f"projects/{project}",
+                'filter': (f'metric.type = "{spec["type"]}" AND '
+                           f'resource.labels.{spec.get("label", "instance_id")} = "{resource.resource_id}"'),
+                'interval': {'start_time': since, 'end_time': until},
+            }
+            scale = float(spec.get('scale', 1.0))
+            for series in self.call(self.client.list_time_series, request=request):
+                for point in series.points:
+                    value = point.value.double_value or float(point.value.int64_value)
+                    samples.append(Sample(resource.resource_id, metric_name, value * scale,
+                                          point.interval.end_time, spec.get('unit', '')))
+        return samples
+
+class AzureCollector(Collector):
+    provider = 'azure'
+    default_metrics = {
+        'vm': {
+            'cpu_utilization': {'name': 'Percentage CPU', 'unit': 'percent'},
+            'available_memory': {'name': 'Available Memory Bytes', 'unit': 'bytes'},
+        },
+    }
+
+    def __init__(self, client=None, granularity: timedelta = timedelta(minutes=1), **kwargs):
+        super().__init__(**kwargs)
+        self.granularity = granularity
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from azure.identity import DefaultAzureCredential
+                from azure.monitor.query import MetricsQueryClient
+                self._client = MetricsQueryClient(DefaultAzureCredential())
+            return self._client
+
+    def fetch(self, resource, metrics, since, until):
+        # resource_id holds the full ARM id, one request covers every metric of the resource
+        by_name = {spec['name']: (metric_name, spec.get('unit', '')) for metric_name, spec in metrics.items()}
+        response = self.call(
+            self.client.query_resource,
+            resource.resource_id,
+            metric_names=list(by_name),
+            timespan=(since, until),
+            granularity=self.granularity,
+            aggregations=['Average']
+        )
+        samples = []
+        for metric in response.metrics:
+            metric_name, unit = by_name.get(metric.name, (metric.name, ''))
+            for series in metric.timeseries:
+                samples.extend(
+                    Sample(resource.resource_id, metric_name, float(point.average), point.timestamp, unit)
+                    for point in series.data if point.average is not None
+                )
+        return samples
+
+def parse_quantity(value: str) -> float:
+    # Kubernetes resource quantities, CPU comes back in nanocores and memory in Ki
+    suffixes = {'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'Ki': 1024.0, 'Mi': 1024.0 ** 2,
+                'Gi': 1024.0 ** 3, 'k': 1e3, 'M': 1e6, 'G': 1e9}
+    for suffix in sorted(suffixes, key=len, reverse=True):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * suffixes[suffix]
+    return float(value)
+
+class KubernetesCollector(Collector):
+    provider = 'k8s'
+    default_metrics = {
+        'node': {'cpu_cores': {'usage': 'cpu', 'unit': 'cores'}, 'memory_bytes': {'usage': 'memory', 'unit': 'bytes'}},
+        'pod': {'cpu_cores': {'usage': 'cpu', 'unit': 'cores'}, 'memory_bytes': {'usage': 'memory', 'unit': 'bytes'}},
+    }
+
+    def __init__(self, api=None, **kwargs):
+        super().__init__(**kwargs)
+        self._api = api
+        self._api_lock = threading.Lock()
+
+    @property
+    def api(self):
+        with self._api_lock:
+            if self._api is None:
+                from kubernetes import client, config
+                try:
+                    config.load_incluster_config()
+                except config.ConfigException:
+                    config.load_kube_config()
+                self._api = client.CustomObjectsApi()
+            return self._api
+
+    def fetch(self, resource, metrics, since, until):
+        # metrics-server only keeps the latest sample, so every run yields at most one point
+        if resource.resource_type == 'pod':
+            namespace, _, name = resource.resource_id.rpartition('/')
+            item = self.call(self.api.get_namespaced_custom_object, 'metrics.k8s.io', 'v1beta1',
+                             namespace or 'default', 'pods', name)
+            usage = defaultdict(float)
+            for container in item.get('containers', []):
+                for key, value in container['usage'].items():
+                    usage[key] += parse_quantity(value)
+        else:
+            item = self.call(self.api.get_cluster_custom_object, 'metrics.k8s.io', 'v1beta1',
+                             'nodes', resource.resource_id)
+            usage = {key: parse_quantity(value) for key, value in item['usage'].items()}
+
+        timestamp = datetime.fromisoformat(item['timestamp'].replace('Z', '+00:00'))
+        return [
+            Sample(resource.resource_id, metric_name, usage[spec['usage']], timestamp, spec.get('unit', ''))
+            for metric_name, spec in metrics.items() if spec['usage'] in usage
+        ]
+
+class CollectionResult(BaseModel):
+    resources: int
+    failed: int
+    samples: int
+    inserted: int
+
+def last_timestamps(resource_ids: List[int], since: datetime) -> Dict[int, Dict[str, datetime]]:
+    # resource_id -> metric_name -> newest stored sample. Bounded by the lookback so the scan
+    # never reaches into old history
+    cursors: Dict[int, Dict[str, datetime]] = defaultdict(dict)
+    rows = (ResourceMetric.objects.filter(resource_id__in=resource_ids, timestamp__gte=since)
+            .values('resource_id', 'metric_name').annotate(last=Max('timestamp'))
+            .values_list('resource_id', 'metric_name', 'last'))
+    for resource_id, metric_name, last in rows:
+        cursors[resource_id][metric_name] = last
+    return cursors
+
+class CollectorRunner:
+    def __init__(self, collectors: Dict[str, Collector], max_workers: int = 32,
+                 lookback: timedelta = timedelta(hours=1), flush_samples: int = 50000):
+        self.collectors = collectors
+        self.max_workers = max_workers
+        self.lookback = lookback
+        self.flush_samples = flush_samples
+
+    def run(self, resources: Iterable[CloudResource]) -> CollectionResult:
+        resources = [resource for resource in resources if resource.provider in self.collectors]
+        until = timezone.now()
+        floor = until - self.lookback
+        last = last_timestamps([resource.id for resource in resources], floor)
+
+        pending: Dict[int, List[Sample]] = defaultdict(list)
+        organizations: Dict[int, Organization] = {}
+        failed = collected = inserted = 0
+        # Per-provider semaphores inside each collector cap concurrency, the pool only
+        # needs to be large enough to keep every provider busy
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='collector') as executor:
+            futures = {
+                executor.submit(self.collectors[resource.provider].collect, resource,
+                                floor, until, last.get(resource.id)): resource
+                for resource in resources
+            }
+            for future in as_completed(futures):
+                resource = futures[future]
+                try:
+                    samples = future.result()
+                except Exception:
+                    failed += 1
+                    logger.exception("Collecting metrics for %s resource %s failed",
+                                     resource.provider, resource.resource_id)
+                    continue
+                collected += len(samples)
+                organizations[resource.organization_id] = resource.organization
+                pending[resource.organization_id].extend(samples)
+                if len(pending[resource.organization_id]) >= self.flush_samples:
+                    inserted += self._flush(organizations[resource.organization_id],
+                                            pending.pop(resource.organization_id))
+
+        for organization_id, samples in pending.items():
+            inserted += self._flush(organizations[organization_id], samples)
+        return CollectionResult(resources=len(resources), failed=failed, samples=collected, inserted=inserted)
+
+    @staticmethod
+    def _flush(organization: Organization, samples: List[Sample]) -> int:
+        if not samples:
+            return 0
+        return ingest_samples(organization, samples).inserted
+
+COLLECTOR_CLASSES = {
+    'aws': AWSCollector,
+    'gcp': GCPCollector,
+    'azure': AzureCollector,
+    'k8s': KubernetesCollector,
+}
+
+def build_collector_runner(collectors: Optional[Dict[str, Collector]] = None) -> CollectorRunner:
+    collector_settings = settings.COLLECTOR_SETTINGS
+    if collectors is None:
+        collectors = {}
+        for provider, limits in collector_settings['providers'].items():
+            if not limits['enabled']:
+                continue
+            options = {'rate': limits['rate'], 'concurrency': limits['concurrency']}
+            if provider == 'gcp':
+                options['project'] = collector_settings['gcp_project']
+            collectors[provider] = COLLECTOR_CLASSES[provider](**options)
+    return CollectorRunner(
+        collectors,
+        max_workers=collector_settings['max_workers'],
+        lookback=timedelta(seconds=collector_settings['lookback']),
+        flush_samples=collector_settings['flush_samples']
+    )
+
+def collect_metrics(organization: Optional[Organization] = None,
+                    runner: Optional[CollectorRunner] = None) -> CollectionResult:
+    resources = CloudResource.objects.select_related('organization')
+    if organization is not None:
+        resources = resources.filter(organization=organization)
+    return (runner or build_collector_runner()).run(resources)
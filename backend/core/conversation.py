@@ -0,0 +1,165 @@
+from typing import Dict, List, Optional, Tuple
+from contextlib import contextmanager
+import json
+import logging
+import time
+from django.conf import settings
+from redis.exceptions import LockError
+from .cache import get_redis_client
+from .models import SocialConversation, SocialMessage
+from .router import routing
+from .usage import metered, record_usage
+
+logger = logging.getLogger(__name__)
+
+def estimate_tokens(text: str) -> int:
+    # About 4 characters per token for English and Spanish text with GPT-4's tokenizer
+    return len(text) // 4 + 1
+
+def prune_context(context: Dict, max_list_items: Optional[int] = None,
+                  max_string_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> Dict:
+    # Keeps context_data compact: empty values go, lists keep their newest unique items,
+    # long strings are cut, and past the token budget the largest keys are dropped
+    social_settings = settings.SOCIAL_SETTINGS
+    max_list_items = max_list_items or social_settings['context_max_list_items']
+    max_string_chars = max_string_chars or social_settings['context_max_string_chars']
+    max_tokens = max_tokens or social_settings['context_max_tokens']
+
+    def compact(value):
+        if isinstance(value, dict):
+            items = {key: compact(item) for key, item in value.items()}
+            return {key: item for key, item in items.items() if item not in (None, '', [], {})}
+        if isinstance(value, list):
+            unique = []
+            for item in (compact(item) for item in value):
+                if item not in (None, '', [], {}) and item not in unique:
+                    unique.append(item)
+            return unique[-max_list_items:]
+        if isinstance(value, str) and len(value) > max_string_chars:
+            return value[:max_string_chars]
+        return value
+
+    pruned = compact(context or {})
+    sizes = {key: len(json.dumps(value, separators=(',', ':'))) for key, value in pruned.items()}
+    while pruned and estimate_tokens(json.dumps(pruned, separators=(',', ':'))) > max_tokens:
+        largest = max(sizes, key=sizes.get)
+        logger.debug("Dropping context key %s to fit %d tokens", largest, max_tokens)
+        pruned.pop(largest)
+        sizes.pop(largest)
+    return pruned
+
+def fit_history(history: List[Dict], budget: int) -> List[Dict]:
+    # history is newest first, returns the newest messages that fit in chronological order
+    kept, used = [], 0
+    for message in history:
+        cost = estimate_tokens(message['content']) + 3
+        if kept and used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    return kept[::-1]
+
+def load_prompt_history(conversation: SocialConversation, message: str) -> Tuple[List[Dict], Optional[str]]:
+    # Only turns not yet folded into the summary are sent verbatim, trimmed to what is left
+    # of the prompt budget after the summary, the context and the new message
+    social_settings = settings.SOCIAL_SETTINGS
+    summary = conversation.conversation_summary or None
+    history = list(
+        SocialMessage.objects.filter(conversation=conversation, id__gt=conversation.summarized_message_id)
+        .order_by('-timestamp', '-id')[:social_settings['max_recent_messages']]
+        .values('id', 'is_from_contact', 'content')
+    )
+    fixed = (estimate_tokens(summary or '') + estimate_tokens(message) +
+             estimate_tokens(json.dumps(conversation.context_data or {}, separators=(',', ':'))) +
+             social_settings['prompt_overhead_tokens'])
+    return fit_history(history, max(0, social_settings['prompt_token_budget'] - fixed)), summary
+
+def needs_summary(conversation: SocialConversation) -> bool:
+    pending = SocialMessage.objects.filter(
+        conversation=conversation, id__gt=conversation.summarized_message_id
+    ).count()
+    if pending < settings.SOCIAL_SETTINGS['summarize_after']:
+        return False
+    # One queued summary per conversation at a time, later messages wait for it to land
+    return bool(get_redis_client().set(f"social:summary:{conversation.id}", 1, nx=True, ex=300))
+
+def summarize_conversation(conversation_id: int, agent=None) -> bool:
+    # Folds every unsummarized turn except the most recent few into conversation_summary
+    from .agents import get_agent
+    social_settings = settings.SOCIAL_SETTINGS
+    conversation = SocialConversation.objects.select_related('organization').get(id=conversation_id)
+    pending = list(
+        SocialMessage.objects.filter(conversation=conversation, id__gt=conversation.summarized_message_id)
+        .order_by('timestamp', 'id').values('id', 'is_from_contact', 'content')
+    )
+    fold = pending[:-social_settings['keep_recent_messages']] if social_settings['keep_recent_messages'] else pending
+    if not fold:
+        return False
+
+    # Billed and routed like the social turns it summarizes
+    with metered() as meter, routing(conversation.organization):
+        summary = (agent or get_agent()).summarize_conversation(
+            conversation.conversation_summary or '', fold, social_settings['summary_max_words']
+        )
+    record_usage(
+        organization=conversation.organization,
+        feature='social_assistant',
+        tokens=meter.tokens,
+        cost=meter.cost
+    )
+    # Guarded on the old marker so two overlapping runs can't fold the same turns twice
+    updated = SocialConversation.objects.filter(
+        id=conversation.id, summarized_message_id=conversation.summarized_message_id
+    ).update(conversation_summary=summary, summarized_message_id=fold[-1]['id'])
+    get_redis_client().delete(f"social:summary:{conversation.id}")
+    return bool(updated)
+
+def conversation_key(organization_id: int, platform: str, contact_id: str) -> str:
+    return f"{organization_id}:{platform}:{contact_id}"
+
+@contextmanager
+def conversation_lock(key: str):
+    # Messages of one conversation are analyzed one turn at a time across all workers
+    timeout = settings.SOCIAL_SETTINGS['lock_timeout']
+    lock = get_redis_client().lock(f"social:lock:{key}", timeout=timeout, blocking_timeout=timeout)
+    if not lock.acquire():
+        raise TimeoutError(f"Conversation {key} is still busy")
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning("Lock on conversation %s expired before the turn finished", key)
+
+def push_pending_message(key: str, job_id: str) -> bool:
+    # Returns True when no burst is scheduled yet and the caller has to schedule one
+    redis_client = get_redis_client()
+    now = time.time()
+    pipeline = redis_client.pipeline()
+    pipeline.rpush(f"social:pending:{key}", job_id)
+    pipeline.expire(f"social:pending:{key}", 3600)
+    pipeline.set(f"social:first:{key}", now, nx=True, ex=3600)
+    pipeline.set(f"social:last:{key}", now, ex=3600)
+    pipeline.set(f"social:burst:{key}", 1, nx=True, ex=settings.SOCIAL_SETTINGS['lock_timeout'])
+    return bool(pipeline.execute()[-1])
+
+def burst_wait(key: str) -> float:
+    # Seconds until the burst is quiet for the debounce window, capped at max_burst_wait
+    # from its first message so a chatty contact still gets an answer
+    social_settings = settings.SOCIAL_SETTINGS
+    first, last = get_redis_client().mget(f"social:first:{key}", f"social:last:{key}")
+    if last is None:
+        return 0.0
+    due = float(last) + social_settings['debounce_seconds']
+    if first is not None:
+        due = min(due, float(first) + social_settings['max_burst_wait'])
+    return max(0.0, due - time.time())
+
+def take_pending_messages(key: str) -> List[str]:
+    # Clearing the burst flag in the same transaction lets the next message schedule a new burst
+    pipeline = get_redis_client().pipeline()
+    pipeline.delete(f"social:burst:{key}", f"social:first:{key}")
+    pipeline.lrange(f"social:pending:{key}", 0, -1)
+    pipeline.delete(f"social:pending:{key}")
+    return [job_id.decode() for job_id in pipeline.execute()[1]]
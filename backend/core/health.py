@@ -0,0 +1,131 @@
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+
+class HealthReport(BaseModel):
+    health_score: float
+    issues: List[str]
+    anomalous: bool
+    metrics: Dict[str, Dict[str, float]]
+
+# Score penalties per metric, the health score starts at 100
+PENALTIES = {
+    'current_breach': 25.0,
+    'p95_breach': 15.0,
+    'zscore': 15.0,
+    'ewma': 10.0,
+    'trend': 10.0,
+}
+
+def score_metrics(metrics_data: pd.DataFrame, thresholds: Dict[str, float],
+                  rolling_window: str = '1h', z_threshold: float = 3.0,
+                  ewma_span: int = 12, ewma_threshold: float = 3.0, ewma_min_anomalies: int = 3,
+                  recent_points: int = 5, trend_horizon_hours: float = 24.0) -> HealthReport:
+    if metrics_data.empty:
+        return HealthReport(health_score=100.0, issues=[], anomalous=False, metrics={})
+
+    if 'timestamp' not in metrics_data.columns:
+        # Frames from core.metrics.load_resource_metrics are indexed by timestamp
+        metrics_data = metrics_data.reset_index()
+    df = metrics_data[['metric_name', 'value', 'timestamp']].dropna()
+    df = df.assign(
+        metric_name=df['metric_name'].astype('category'),
+        value=df['value'].astype('float64'),
+        timestamp=pd.to_datetime(df['timestamp'], utc=True)
+    ).sort_values(['metric_name', 'timestamp'], kind='stable').reset_index(drop=True)
+    if df.empty:
+        return HealthReport(health_score=100.0, issues=[], anomalous=False, metrics={})
+
+    by_metric = df.groupby('metric_name', observed=True, sort=True)
+    values = by_metric['value']
+    stats = values.agg(['count', 'mean', 'std', 'min', 'max', 'last'])
+    stats['p95'] = values.quantile(0.95)
+
+    # Time-based rolling mean, the last value per metric is the mean of the trailing window
+    rolling = (df.set_index('timestamp').groupby('metric_name', observed=True)['value']
+               .rolling(rolling_window).mean())
+    stats['rolling_mean'] = rolling.groupby(level=0, observed=True).last()
+
+    # z-score of the latest sample against the whole window
+    stats['zscore'] = (stats['last'] - stats['mean']) / stats['std'].replace(0.0, np.nan)
+
+    # EWMA anomalies: a recent sample is anomalous when it leaves the EWMA band as it stood
+    # just before the recent window, so a sustained shift can't widen the band it is tested on
+    ewm = by_metric['value'].ewm(span=ewma_span)
+    ewm_mean = ewm.mean().reset_index(level=0, drop=True).sort_index()
+    ewm_std = ewm.std().reset_index(level=0, drop=True).sort_index()
+    df['position'] = by_metric.cumcount(ascending=False)
+    before = df['position'] == recent_points
+    names = df.loc[before, 'metric_name'].astype(str).values
+    band_mean = pd.Series(ewm_mean[before].values, index=names)
+    band_std = pd.Series(ewm_std[before].values, index=names)
+    recent = df[df['position'] < recent_points]
+    recent_names = recent['metric_name'].astype(str)
+    anomaly = ((recent['value'] - recent_names.map(band_mean)).abs() >
+               ewma_threshold * recent_names.map(band_std))
+    stats['ewma_anomalies'] = anomaly.groupby(recent['metric_name'], observed=True).sum()
+
+    # Least-squares slope per metric in units per hour, from grouped sums
+    t = (df['timestamp'] - df['timestamp'].min()).dt.total_seconds() / 3600.0
+    sums = pd.DataFrame({
+        'metric_name': df['metric_name'],
+        't': t,
+        'v': df['value'],
+        'tt': t * t,
+        'tv': t * df['value'],
+    }).groupby('metric_name', observed=True).sum()
+    n = stats['count']
+    denominator = n * sums['tt'] - sums['t'] ** 2
+    stats['slope'] = (n * sums['tv'] - sums['t'] * sums['v']) / denominator.replace(0.0, np.nan)
+
+    stats['threshold'] = stats.index.map(lambda name: thresholds.get(name, np.nan)).astype('float64')
+    df['breach'] = df['value'] > df['metric_name'].map(thresholds).astype('float64')
+    stats['breach_ratio'] = df.groupby('metric_name', observed=True)['breach'].mean()
+
+    flags = pd.DataFrame({
+        'current_breach': stats['last'] > stats['threshold'],
+        'p95_breach': (stats['p95'] > stats['threshold']) & ~(stats['last'] > stats['threshold']),
+        'zscore': stats['zscore'].abs() > z_threshold,
+        # A single sample outside the band is routine noise on a steady metric, it takes
+        # several of the recent samples to count as an anomaly
+        'ewma': stats['ewma_anomalies'].fillna(0) >= ewma_min_anomalies,
+        'trend': (stats['slope'] > 0) & ~(stats['last'] > stats['threshold']) &
+                 (stats['last'] + stats['slope'] * trend_horizon_hours > stats['threshold']),
+    }, index=stats.index).fillna(False)
+
+    penalty = flags.astype('float64').mul(pd.Series(PENALTIES)).sum(axis=1)
+    health_score = float(np.clip(100.0 - penalty.sum(), 0.0, 100.0))
+
+    issues = []
+    for name, row in stats[flags.any(axis=1)].iterrows():
+        flag = flags.loc[name]
+        if flag['current_breach']:
+            issues.append(f"{name} at {row['last']:.2f} is above the {row['threshold']:g} threshold")
+        if flag['p95_breach']:
+            issues.append(f"{name} p95 of {row['p95']:.2f} exceeded the {row['threshold']:g} threshold "
+                          f"({row['breach_ratio']:.0%} of samples)")
+        if flag['zscore']:
+            issues.append(f"{name} latest value deviates {row['zscore']:.1f} standard deviations from its mean")
+        if flag['ewma']:
+            issues.append(f"{name} had {int(row['ewma_anomalies'])} anomalous samples in the last {recent_points}")
+        if flag['trend']:
+            issues.append(f"{name} is trending up {row['slope']:.2f}/h and will cross "
+                          f"{row['threshold']:g} within {trend_horizon_hours:g}h")
+
+    summary = stats[['count', 'mean', 'p95', 'last', 'rolling_mean', 'zscore', 'slope']]
+    metrics = {
+        str(name): {key: float(value) for key, value in row.items() if pd.notna(value)}
+        for name, row in summary.iterrows()
+    }
+    return HealthReport(
+        health_score=health_score,
+        issues=issues,
+        anomalous=bool(issues),
+        metrics=metrics
+    )
+
+def score_metrics_batch(batch: List[Tuple[int, pd.DataFrame, Dict[str, float]]]) -> List[Tuple[int, Dict]]:
+    # Process pool entry point, results are plain dicts so they pickle cheaply on the way back
+    return [(resource_id, score_metrics(frame, thresholds).model_dump())
+            for resource_id, frame, thresholds in batch]
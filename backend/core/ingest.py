@@ -0,0 +1,221 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from datetime import datetime, timezone as dt_timezone
+import csv
+import io
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+from pydantic import BaseModel
+from .alerts import get_alert_evaluator
+from .models import CloudResource, Organization, ResourceMetric
+from .timeseries import refresh_rollups
+
+logger = logging.getLogger(__name__)
+
+class Sample(NamedTuple):
+    resource: str
+    metric_name: str
+    value: float
+    timestamp: datetime
+    unit: str
+
+class IngestResult(BaseModel):
+    received: int
+    inserted: int
+    duplicates: int
+    rejected: int
+    errors: List[str]
+
+def parse_timestamp(value) -> datetime:
+    if isinstance(value, (int, float)):
+        # Epoch seconds, or milliseconds as sent by Prometheus
+        seconds = value / 1000.0 if value > 1e11 else value
+        return datetime.fromtimestamp(seconds, tz=dt_timezone.utc)
+    parsed = parse_datetime(str(value))
+    if parsed is None:
+        raise ValueError(f"Invalid timestamp: {value}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt_timezone.utc)
+    return parsed
+
+def parse_ndjson(body: bytes) -> Tuple[List[Sample], List[str]]:
+    samples, errors = [], []
+    for number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            samples.append(Sample(
+                str(item['resource_id']),
+                item['metric'],
+                float(item['value']),
+                parse_timestamp(item['timestamp']),
+                item.get('unit', '')
+            ))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(f"line {number}: {e}")
+    return samples, errors
+
+def parse_csv(body: bytes) -> Tuple[List[Sample], List[str]]:
+    # Header row: resource_id,metric,value,timestamp[,unit]
+    samples, errors = [], []
+    reader = csv.DictReader(io.StringIO(body.decode('utf-8')))
+    for number, row in enumerate(reader, start=2):
+        try:
+            timestamp = row['timestamp']
+            samples.append(Sample(
+                row['resource_id'],
+                row['metric'],
+                float(row['value']),
+                parse_timestamp(float(timestamp) if timestamp.replace('.', '', 1).isdigit() else timestamp),
+                row.get('unit') or ''
+            ))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            errors.append(f"line {number}: {e}")
+    return samples, errors
+
+def parse_remote_write(payload: Dict) -> Tuple[List[Sample], List[str]]:
+    # JSON form of a Prometheus remote-write request: series labels plus [timestamp_ms, value] pairs
+    samples, errors = [], []
+    for number, series in enumerate(payload.get('timeseries', [])):
+        try:
+            labels = series['labels']
+            resource, metric_name = str(labels['resource_id']), labels['__name__']
+            unit = labels.get('unit', '')
+            for timestamp, value in series['samples']:
+                samples.append(Sample(resource, metric_name, float(value), parse_timestamp(timestamp), unit))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(f"series {number}: {e}")
+    return samples, errors
+
+class ResourceLookup:
+    # Maps provider resource ids to CloudResource primary keys, per organization
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._entries: Dict[Tuple[int, str], Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, organization_id: int, resource_ids: Iterable[str]) -> Dict[str, int]:
+        now = time.monotonic()
+        resolved, missing = {}, set()
+        with self._lock:
+            for resource_id in set(resource_ids):
+                entry = self._entries.get((organization_id, resource_id))
+                if entry is not None and entry[1] > now:
+                    resolved[resource_id] = entry[0]
+                else:
+                    missing.add(resource_id)
+
+        if missing:
+            found = CloudResource.objects.filter(
+                organization_id=organization_id,
+                resource_id__in=missing
+            ).values_list('resource_id', 'id')
+            with self._lock:
+                for resource_id, pk in found:
+                    self._entries[(organization_id, resource_id)] = (pk, now + self.ttl)
+                    resolved[resource_id] = pk
+        return resolved
+
+_resource_lookup: Optional[ResourceLookup] = None
+_resource_lookup_lock = threading.Lock()
+
+def get_resource_lookup() -> ResourceLookup:
+    global _resource_lookup
+    with _resource_lookup_lock:
+        if _resource_lookup is None:
+            _resource_lookup = ResourceLookup(ttl=settings.METRIC_SETTINGS['resource_cache_ttl'])
+        return _resource_lookup
+
+def ingest_samples(organization: Organization, samples: List[Sample],
+                   method: Optional[str] = None) -> IngestResult:
+    lookup = get_resource_lookup().resolve(organization.id, (s.resource for s in samples))
+
+    # Last sample wins for repeated (resource, metric, timestamp) keys inside the batch
+    rows: Dict[Tuple[int, str, datetime], Tuple] = {}
+    rejected = 0
+    for sample in samples:
+        pk = lookup.get(sample.resource)
+        if pk is None:
+            rejected += 1
+            continue
+        rows[(pk, sample.metric_name, sample.timestamp)] = (
+            pk, sample.metric_name, sample.value, sample.unit, sample.timestamp
+        )
+
+    method = method or settings.METRIC_SETTINGS['ingest_method']
+    if method == 'copy' and connection.vendor == 'postgresql':
+        inserted = _copy_metric_rows(list(rows.values()))
+    else:
+        inserted = _bulk_create_metric_rows(list(rows.values()))
+
+    if inserted and settings.METRIC_SETTINGS['rollups_enabled']:
+        timestamps = [key[2] for key in rows]
+        refresh_rollups({key[0] for key in rows}, min(timestamps), max(timestamps))
+
+    if rows and settings.ALERT_SETTINGS['enabled']:
+        # Samples are already stored, a failing evaluation must not fail the ingest
+        try:
+            get_alert_evaluator().process(rows.values())
+        except Exception:
+            logger.exception("Alert evaluation failed for organization %s", organization.id)
+
+    return IngestResult(
+        received=len(samples),
+        inserted=inserted,
+        duplicates=len(samples) - rejected - inserted,
+        rejected=rejected,
+        errors=[f"unknown resource_id: {rid}" for rid in
+                sorted({s.resource for s in samples} - set(lookup))][:100]
+    )
+
+def _copy_metric_rows(rows: List[Tuple]) -> int:
+    if not rows:
+        return 0
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for pk, metric_name, value, unit, timestamp in rows:
+        writer.writerow((pk, metric_name, repr(value), unit, timestamp.isoformat()))
+    buffer.seek(0)
+
+    table = ResourceMetric._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        # COPY into a scratch table, then let the unique constraint drop already stored samples
+        cursor.execute("""
+            CREATE TEMP TABLE metric_ingest (
+                resource_id integer,
+                metric_name varchar(100),
+                value double precision,
+                unit varchar(50),
+                timestamp timestamptz
+            ) ON COMMIT DROP
+        """)
+        cursor.copy_expert(
+            "COPY metric_ingest (resource_id, metric_name, value, unit, timestamp) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+        cursor.execute(f"""
+            INSERT INTO {table} (resource_id, metric_name, value, unit, timestamp)
+            SELECT resource_id, metric_name, value, unit, timestamp FROM metric_ingest
+            ON CONFLICT (resource_id, metric_name, timestamp) DO NOTHING
+        """)
+        inserted = cursor.rowcount
+        # ON COMMIT DROP never fires when the caller holds an outer transaction
+        cursor.execute("DROP TABLE metric_ingest")
+        return inserted
+
+def _bulk_create_metric_rows(rows: List[Tuple]) -> int:
+    if not rows:
+        return 0
+
+    ResourceMetric.objects.bulk_create([
+        ResourceMetric(resource_id=pk, metric_name=metric_name, value=value, unit=unit, timestamp=timestamp)
+        for pk, metric_name, value, unit, timestamp in rows
+    ], batch_size=settings.METRIC_SETTINGS['bulk_batch_size'], ignore_conflicts=True)
+    # ignore_conflicts doesn't report skipped rows, so already stored samples count as written here
+    return len(rows)
@@ -0,0 +1,21 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.collectors import build_collector_runner, collect_metrics
+
+class Command(BaseCommand):
+    help = 'Pulls new samples from the cloud providers into ResourceMetric'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep collecting every COLLECTOR_INTERVAL_SECONDS')
+
+    def handle(self, *args, **options):
+        runner = build_collector_runner()
+        while True:
+            started = time.monotonic()
+            result = collect_metrics(runner=runner)
+            self.stdout.write(f"Collected {result.samples} samples from {result.resources} resources "
+                              f"({result.inserted} new, {result.failed} failed)")
+            if not options['loop']:
+                return
+            time.sleep(max(0.0, settings.COLLECTOR_SETTINGS['interval'] - (time.monotonic() - started)))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.tickets import build_ticket_dispatcher
+
+class Command(BaseCommand):
+    help = 'Delivers pending ticket outbox entries to the ticket webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Dispatch one batch and exit')
+        parser.add_argument('--poll-interval', type=float, default=2.0)
+
+    def handle(self, *args, **options):
+        dispatcher = build_ticket_dispatcher()
+        if dispatcher is None:
+            raise CommandError('TICKET_WEBHOOK_URL is not configured')
+
+        if options['once']:
+            self.stdout.write(f"Delivered {dispatcher.dispatch_pending()} tickets")
+            return
+        dispatcher.run_forever(poll_interval=options['poll_interval'])
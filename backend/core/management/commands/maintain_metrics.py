@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from core.timeseries import apply_retention, ensure_metric_partitions
+
+class Command(BaseCommand):
+    help = 'Creates upcoming ResourceMetric partitions and applies metric retention policies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days-ahead', type=int, default=7)
+
+    def handle(self, *args, **options):
+        created = ensure_metric_partitions(days_ahead=options['days_ahead'])
+        if created:
+            self.stdout.write(f"Ensured {len(created)} metric partitions")
+        apply_retention()
+        self.stdout.write("Metric retention applied")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from core.classifier import train_email_classifier, train_email_classifiers
+from core.models import Organization
+
+class Command(BaseCommand):
+    help = 'Trains the per-organization email classifiers from EmailInteraction history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', type=int, help='Only train this organization id')
+
+    def handle(self, *args, **options):
+        if options['organization']:
+            organization = Organization.objects.get(id=options['organization'])
+            results = {organization.id: train_email_classifier(organization)}
+        else:
+            results = train_email_classifiers()
+        for organization_id, metadata in results.items():
+            if metadata is None:
+                self.stdout.write(f"Organization {organization_id}: skipped (too little history or training failed)")
+            else:
+                self.stdout.write(f"Organization {organization_id}: {metadata['samples']} samples, "
+                                  f"{metadata['holdout_coverage']:.0%} answered locally, "
+                                  f"{metadata['holdout_agreement']:.0%} agreement with the LLM")
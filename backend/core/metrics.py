@@ -0,0 +1,59 @@
+from typing import Dict, Iterable, List, Optional, Union
+from datetime import datetime
+from itertools import islice
+import numpy as np
+import pandas as pd
+from .models import ResourceMetric
+
+def load_resource_metrics(resources: Union[int, Iterable[int]], since: datetime,
+                          until: Optional[datetime] = None, wide: bool = False,
+                          chunk_size: int = 20000) -> pd.DataFrame:
+    resource_ids = [resources] if isinstance(resources, int) else list(resources)
+    metrics = ResourceMetric.objects.filter(resource_id__in=resource_ids, timestamp__gte=since)
+    if until is not None:
+        metrics = metrics.filter(timestamp__lt=until)
+
+    with_resource = len(resource_ids) > 1
+    fields = ['metric_name', 'value', 'timestamp'] + (['resource_id'] if with_resource else [])
+    # iterator() streams through a server-side cursor on PostgreSQL
+    rows = metrics.order_by().values_list(*fields).iterator(chunk_size=chunk_size)
+
+    # Metric names are encoded to category codes chunk by chunk so no column of
+    # Python strings is ever built for the whole window
+    categories: Dict[str, int] = {}
+    codes: List[np.ndarray] = []
+    values: List[np.ndarray] = []
+    stamps: List[np.ndarray] = []
+    owners: List[np.ndarray] = []
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        columns = list(zip(*chunk))
+        codes.append(np.fromiter((categories.setdefault(name, len(categories)) for name in columns[0]),
+                                 dtype=np.int32, count=len(chunk)))
+        values.append(np.fromiter(columns[1], dtype=np.float64, count=len(chunk)))
+        stamps.append(pd.DatetimeIndex(pd.to_datetime(columns[2], utc=True)).asi8)
+        if with_resource:
+            owners.append(np.fromiter(columns[3], dtype=np.int64, count=len(chunk)))
+
+    index = pd.DatetimeIndex(
+        pd.to_datetime(np.concatenate(stamps) if stamps else np.array([], dtype=np.int64), utc=True),
+        name='timestamp'
+    )
+    data = {
+        'metric_name': pd.Categorical.from_codes(
+            np.concatenate(codes) if codes else np.array([], dtype=np.int32),
+            categories=list(categories)
+        ),
+        'value': np.concatenate(values) if values else np.array([], dtype=np.float64),
+    }
+    if with_resource:
+        data['resource_id'] = np.concatenate(owners) if owners else np.array([], dtype=np.int64)
+    df = pd.DataFrame(data, index=index).sort_index(kind='stable')
+
+    if wide:
+        columns = ['resource_id', 'metric_name'] if with_resource else 'metric_name'
+        return df.pivot_table(index='timestamp', columns=columns, values='value',
+                              aggfunc='mean', observed=True)
+    return df
@@ -1,11 +1,22 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields import JSONField
+from django.utils import timezone
+import uuid
 
 class Organization(models.Model):
+    PLANS = [
+        ('free', 'Free'),
+        ('pro', 'Pro'),
+        ('enterprise', 'Enterprise')
+    ]
+
     name = models.CharField(max_length=200)
     api_key = models.CharField(max_length=100, unique=True)
+    # Bounds the model tiers core.router may pick for this organization
+    plan = models.CharField(max_length=20, choices=PLANS, default='pro')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Days to keep per metric tier ('raw', '1m', '1h', '1d'), falls back to METRIC_SETTINGS
+    metric_retention = models.JSONField(default=dict, blank=True)
     
     def __str__(self):
         return self.name
@@ -15,18 +26,39 @@ class Usage(models.Model):
     feature = models.CharField(max_length=100)
     tokens = models.IntegerField()
     cost = models.DecimalField(max_digits=10, decimal_places=4)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the usage is recorded, buffered rows reach the database later
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
         indexes = [
             models.Index(fields=['organization', 'timestamp']),
         ] 
 
+class UsageRollup(models.Model):
+    # Hourly totals per feature, kept up to date by core.usage.record_usage
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    feature = models.CharField(max_length=100)
+    bucket = models.DateTimeField()
+    tokens = models.BigIntegerField(default=0)
+    cost = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+    requests = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'feature', 'bucket'],
+                                    name='unique_usage_rollup_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['organization', 'bucket']),
+        ]
+
 class EmailThread(models.Model):
     organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
     subject = models.CharField(max_length=500)
     sender_email = models.EmailField()
     thread_id = models.CharField(max_length=100, unique=True)
+    # SHA-256 of organization, normalized subject and sender, see core.threads
+    thread_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -34,6 +66,11 @@ class EmailThread(models.Model):
             models.Index(fields=['thread_id']),
         ]
 
+class EmailThreadRef(models.Model):
+    # SHA-256 of organization and a Message-ID seen in the thread, so replies find it by header
+    key = models.CharField(max_length=64, unique=True)
+    thread = models.ForeignKey(EmailThread, on_delete=models.CASCADE, related_name='refs')
+
 class EmailInteraction(models.Model):
     thread = models.ForeignKey(EmailThread, on_delete=models.CASCADE)
     email_content = models.TextField()
@@ -42,6 +79,22 @@ class EmailInteraction(models.Model):
     needs_human_review = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+class EmailBacklog(models.Model):
+    # Non-urgent mail waiting for the bulk worker, which classifies it in large batches
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    subject = models.CharField(max_length=500)
+    sender_email = models.EmailField()
+    email_content = models.TextField()
+    # message_id, in_reply_to and references, used to resolve the thread
+    headers = models.JSONField(default=dict, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['claimed_until', 'received_at']),
+        ]
+
 class InfrastructureComponent(models.Model):
     COMPONENT_TYPES = [
         ('server', 'Server'),
@@ -65,7 +118,7 @@ class InfrastructureComponent(models.Model):
     component_type = models.CharField(max_length=50, choices=COMPONENT_TYPES)
     cloud_provider = models.CharField(max_length=50, choices=CLOUD_PROVIDERS)
     identifier = models.CharField(max_length=200)  # Instance ID, Resource ID, etc.
-    configuration = JSONField()
+    configuration = models.JSONField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -95,10 +148,39 @@ class ResourceMetric(models.Model):
     timestamp = models.DateTimeField()
 
     class Meta:
-        indexes = [
-            models.Index(fields=['resource', 'metric_name', 'timestamp'])
+        # Also serves as the lookup index, and lets ingestion deduplicate with ON CONFLICT
+        constraints = [
+            models.UniqueConstraint(fields=['resource', 'metric_name', 'timestamp'],
+                                    name='unique_resource_metric_sample')
+        ]
+
+class MetricRollup(models.Model):
+    # Downsampled samples, maintained by core.timeseries as metrics are ingested
+    resource = models.ForeignKey(CloudResource, on_delete=models.CASCADE)
+    metric_name = models.CharField(max_length=100)
+    bucket = models.DateTimeField()
+    min_value = models.FloatField()
+    max_value = models.FloatField()
+    sum_value = models.FloatField()
+    count = models.IntegerField()
+    p95 = models.FloatField()
+
+    class Meta:
+        abstract = True
+        constraints = [
+            models.UniqueConstraint(fields=['resource', 'metric_name', 'bucket'],
+                                    name='unique_%(class)s_bucket')
         ]
 
+class ResourceMetricMinute(MetricRollup):
+    pass
+
+class ResourceMetricHour(MetricRollup):
+    pass
+
+class ResourceMetricDay(MetricRollup):
+    pass
+
 class Alert(models.Model):
     SEVERITY_LEVELS = [
         ('critical', 'Critical'),
@@ -107,6 +189,7 @@ class Alert(models.Model):
     ]
 
     resource = models.ForeignKey(CloudResource, on_delete=models.CASCADE)
+    rule = models.CharField(max_length=100, default='')
     title = models.CharField(max_length=200)
     description = models.TextField()
     severity = models.CharField(max_length=20, choices=SEVERITY_LEVELS)
@@ -115,6 +198,13 @@ class Alert(models.Model):
     resolved_at = models.DateTimeField(null=True, blank=True)
     resolution_note = models.TextField(null=True, blank=True)
 
+    class Meta:
+        # At most one open alert per resource and rule, core.alerts relies on it to deduplicate
+        constraints = [
+            models.UniqueConstraint(fields=['resource', 'rule'], condition=models.Q(is_active=True),
+                                    name='unique_active_alert')
+        ]
+
 class SocialConversation(models.Model):
     PLATFORMS = [
         ('whatsapp', 'WhatsApp'),
@@ -140,8 +230,12 @@ class SocialConversation(models.Model):
     lead_score = models.FloatField(default=0.0)
     
     class Meta:
+        # Concurrent first messages from a contact can't create two conversations
+        constraints = [
+            models.UniqueConstraint(fields=['organization', 'platform', 'contact_id'],
+                                    name='unique_social_conversation')
+        ]
         indexes = [
-            models.Index(fields=['organization', 'platform', 'contact_id']),
             models.Index(fields=['stage', 'lead_score'])
         ]
 
@@ -149,6 +243,8 @@ class SocialConversation(models.Model):
     last_intent = models.CharField(max_length=100, null=True)
     customer_preferences = models.JSONField(default=dict)
     conversation_summary = models.TextField(null=True)
+    # Last SocialMessage folded into conversation_summary, see core.conversation
+    summarized_message_id = models.BigIntegerField(default=0)
     tags = models.JSONField(default=list)
 
 class SocialMessage(models.Model):
@@ -171,12 +267,45 @@ class Trace(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     reviewed = models.BooleanField(default=False)
     ticket_id = models.CharField(max_length=100, null=True, blank=True)
+    ticket_outbox = models.ForeignKey('TicketOutbox', on_delete=models.SET_NULL, null=True, blank=True,
+                                      related_name='traces')
 
     class Meta:
         indexes = [
             models.Index(fields=['status', 'created_at']),
         ]
 
+class TicketOutbox(models.Model):
+    # Ticket intents written with their traces and delivered by core.tickets
+    STATUS = [
+        ('pending', 'Pending'),
+        ('delivered', 'Delivered'),
+        ('failed', 'Failed'),
+    ]
+
+    resource = models.ForeignKey(CloudResource, on_delete=models.CASCADE)
+    coalesce_key = models.CharField(max_length=64)
+    payload = models.JSONField()
+    occurrences = models.IntegerField(default=1)
+    status = models.CharField(max_length=20, choices=STATUS, default='pending')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    ticket_id = models.CharField(max_length=100, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+        # Occurrences only coalesce into an open row, after a terminal failure the next one
+        # starts a new row for the same key
+        constraints = [
+            models.UniqueConstraint(fields=['coalesce_key'], condition=models.Q(status__in=['pending', 'delivered']),
+                                    name='unique_open_ticket_outbox')
+        ]
+
 class TraceDataset(models.Model):
     DATASET_TYPE = [
         ('error', 'Error Traces'),
@@ -185,4 +314,80 @@ class TraceDataset(models.Model):
 
     type = models.CharField(max_length=20, choices=DATASET_TYPE)
     traces = models.ManyToManyField(Trace)
-    created_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class SocialChannel(models.Model):
+    # A WhatsApp number, Facebook page or Instagram account connected through the Meta webhooks
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    platform = models.CharField(max_length=20, choices=SocialConversation.PLATFORMS)
+    # WhatsApp phone_number_id, page id or Instagram account id
+    external_id = models.CharField(max_length=100)
+    # Empty WhatsApp tokens fall back to SOCIAL_SETTINGS['whatsapp']['api_key']
+    access_token = models.TextField(blank=True)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['platform', 'external_id'], name='unique_social_channel'),
+        ]
+
+class AgentJob(models.Model):
+    # Agent requests run on the Celery workers, see core.tasks
+    STATUSES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed')
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUSES, default='queued')
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    callback_url = models.URLField(max_length=500, null=True, blank=True)
+    callback_delivered_at = models.DateTimeField(null=True, blank=True)
+    # Set for webhook messages, the suggested response is sent back through this channel
+    reply_channel = models.ForeignKey(SocialChannel, on_delete=models.SET_NULL, null=True, blank=True)
+    reply_sent_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['organization', 'created_at']),
+        ]
+
+class InboundEvent(models.Model):
+    # One message received on a Meta webhook, stored raw before anything else happens with it.
+    # The unique (platform, message_id) pair drops Meta's redeliveries
+    STATUSES = [
+        ('received', 'Received'),
+        ('queued', 'Queued'),
+        ('ignored', 'Ignored'),
+        ('failed', 'Failed'),
+    ]
+
+    platform = models.CharField(max_length=20)
+    message_id = models.CharField(max_length=255)
+    channel_external_id = models.CharField(max_length=100)
+    contact_id = models.CharField(max_length=100)
+    # None for media and other non-text messages, which are stored but not answered
+    text = models.TextField(null=True, blank=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUSES, default='received')
+    job = models.ForeignKey(AgentJob, on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['platform', 'message_id'], name='unique_inbound_event'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'received_at']),
+        ]
@@ -0,0 +1,110 @@
+from typing import Dict, NamedTuple, Optional
+from contextlib import contextmanager
+import contextvars
+import logging
+import threading
+from django.conf import settings
+from .usage import completion_cost
+
+logger = logging.getLogger(__name__)
+
+TIER_ORDER = ['small', 'large']
+
+class Route(NamedTuple):
+    tier: str
+    model: str
+    reason: str
+
+_current_plan: contextvars.ContextVar = contextvars.ContextVar('routing_plan', default=None)
+_current_organization: contextvars.ContextVar = contextvars.ContextVar('routing_organization', default=None)
+
+def current_organization_id() -> Optional[int]:
+    return _current_organization.get()
+
+@contextmanager
+def routing(organization):
+    # Calls made inside are routed with the organization's plan and may be answered by its
+    # local classifier, copied into the LLM executor threads along with the usage meter
+    token = _current_plan.set(getattr(organization, 'plan', None))
+    organization_token = _current_organization.set(getattr(organization, 'id', None))
+    try:
+        yield
+    finally:
+        _current_organization.reset(organization_token)
+        _current_plan.reset(token)
+
+class ModelRouter:
+    def __init__(self, models: Dict[str, str], features: Dict[str, str], plans: Dict[str, Dict],
+                 long_input_chars: int = 6000, min_confidence: float = 0.6,
+                 max_escalation_rate: float = 0.3, escalation_alpha: float = 0.05, enabled: bool = True):
+        self.models = models
+        self.features = features
+        self.plans = plans
+        self.long_input_chars = long_input_chars
+        self.min_confidence = min_confidence
+        self.max_escalation_rate = max_escalation_rate
+        self.escalation_alpha = escalation_alpha
+        self.enabled = enabled
+        # EWMA of how often the small tier had to be escalated, per feature
+        self._escalation_rates: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def route(self, feature: Optional[str], input_chars: int) -> Route:
+        if not self.enabled:
+            return self._route('large', 'disabled')
+
+        tier, reason = self.features.get(feature, 'large'), 'feature'
+        if tier == 'small' and input_chars > self.long_input_chars:
+            tier, reason = 'large', 'long_input'
+        elif tier == 'small' and self._escalation_rates.get(feature, 0.0) > self.max_escalation_rate:
+            # The small model keeps failing this feature, stop paying for the failed attempt
+            tier, reason = 'large', 'escalation_rate'
+        return self._clamp(tier, reason)
+
+    def escalate(self, route: Route) -> Optional[Route]:
+        position = TIER_ORDER.index(route.tier)
+        if position + 1 >= len(TIER_ORDER):
+            return None
+        escalated = self._clamp(TIER_ORDER[position + 1], 'escalated')
+        return escalated if escalated.tier != route.tier else None
+
+    def record_outcome(self, feature: Optional[str], route: Route, escalated: bool) -> None:
+        if route.tier != 'small':
+            return
+        with self._lock:
+            rate = self._escalation_rates.get(feature, 0.0)
+            self._escalation_rates[feature] = rate + self.escalation_alpha * (float(escalated) - rate)
+
+    def log(self, feature: Optional[str], route: Route, latency: float, usage, outcome: str = 'ok') -> None:
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        logger.info(
+            "llm_call feature=%s model=%s tier=%s reason=%s plan=%s outcome=%s latency_ms=%.0f "
+            "prompt_tokens=%d completion_tokens=%d cost=%s",
+            feature, route.model, route.tier, route.reason, _current_plan.get(), outcome, latency * 1000,
+            prompt_tokens, completion_tokens, completion_cost(route.model, prompt_tokens, completion_tokens)
+        )
+
+    def _clamp(self, tier: str, reason: str) -> Route:
+        plan = self.plans.get(_current_plan.get()) or {}
+        position = TIER_ORDER.index(tier)
+        if 'max_tier' in plan and position > TIER_ORDER.index(plan['max_tier']):
+            tier, reason = plan['max_tier'], 'plan'
+        elif 'min_tier' in plan and position < TIER_ORDER.index(plan['min_tier']):
+            tier, reason = plan['min_tier'], 'plan'
+        return self._route(tier, reason)
+
+    def _route(self, tier: str, reason: str) -> Route:
+        return Route(tier, self.models[tier], reason)
+
+def build_model_router() -> ModelRouter:
+    router_settings = settings.MODEL_ROUTER_SETTINGS
+    return ModelRouter(
+        models=router_settings['models'],
+        features=router_settings['features'],
+        plans=router_settings['plans'],
+        long_input_chars=router_settings['long_input_chars'],
+        min_confidence=router_settings['min_confidence'],
+        max_escalation_rate=router_settings['max_escalation_rate'],
+        enabled=router_settings['enabled']
+    )
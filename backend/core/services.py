@@ -0,0 +1,314 @@
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from datetime import datetime, timedelta
+import logging
+import math
+import os
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .agents import CallAnalysisError, MessageAnalysis, SalesCallAnalysis, get_agent
+from .conversation import conversation_key, conversation_lock, load_prompt_history, needs_summary, prune_context
+from .models import CloudResource, EmailBacklog, EmailInteraction, Organization, SocialConversation, SocialMessage
+from .router import routing
+from .threads import resolve_thread, resolve_threads
+from .transcription import Transcript, TranscriptChunk, get_transcriber
+from .timeseries import DEFAULT_HEALTH_POINTS, query_metrics
+from .usage import UsageMeter, metered, record_usage, parse_timeframe
+
+logger = logging.getLogger(__name__)
+
+# Agent operations shared by the synchronous endpoints and the Celery job tasks.
+# Each takes the organization plus the request fields and returns a JSON-ready dict
+
+def process_email(organization: Organization, email_content: str, subject: str, sender_email: str,
+                  message_id: Optional[str] = None, in_reply_to: Optional[str] = None,
+                  references: Union[str, List[str], None] = None) -> Dict:
+    thread = resolve_thread(organization, subject, sender_email, message_id, in_reply_to, references)
+
+    with metered() as meter, routing(organization):
+        result = get_agent().process_email(email_content, organization.name)
+
+    EmailInteraction.objects.create(
+        thread=thread,
+        email_content=email_content,
+        classification=result.classification,
+        response=result.response
+    )
+
+    record_usage(
+        organization=organization,
+        feature='email_assistant',
+        tokens=meter.tokens,
+        cost=meter.cost
+    )
+    return result.dict()
+
+def classify_email_batch(organization: Organization, emails: List[Dict]) -> List[Dict]:
+    # Classification only, for backlog mail: items are packed into a few LLM calls and stored
+    # without a drafted reply, so every interaction is left for human review
+    email_settings = settings.EMAIL_SETTINGS
+    with metered() as meter, routing(organization):
+        classifications = get_agent().classify_emails(
+            [(str(i), email['email_content']) for i, email in enumerate(emails)],
+            email_settings['batch_size'],
+            email_settings['batch_max_item_chars']
+        )
+
+    threads = resolve_threads(organization, emails)
+    interactions = EmailInteraction.objects.bulk_create([
+        EmailInteraction(
+            thread=threads[i],
+            email_content=email['email_content'],
+            classification=classifications[str(i)],
+            response='',
+            needs_human_review=True
+        )
+        for i, email in enumerate(emails)
+    ])
+
+    record_usage(
+        organization=organization,
+        feature='email_assistant',
+        tokens=meter.tokens,
+        cost=meter.cost
+    )
+    return [
+        {'interaction_id': interaction.id, 'thread_id': interaction.thread.thread_id,
+         'classification': interaction.classification}
+        for interaction in interactions
+    ]
+
+def drain_email_backlog(claim_size: Optional[int] = None) -> int:
+    # Claims the oldest backlog rows across organizations under a lease, classifies them per
+    # organization and deletes what was stored. Rows of a failed batch come back once the lease ends
+    email_settings = settings.EMAIL_SETTINGS
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            EmailBacklog.objects.select_for_update(skip_locked=True)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+            .select_related('organization')
+            .order_by('received_at')[:claim_size or email_settings['backlog_claim_size']]
+        )
+        EmailBacklog.objects.filter(id__in=[row.id for row in rows]).update(
+            claimed_until=now + timedelta(seconds=email_settings['backlog_lease'])
+        )
+
+    by_organization: Dict[int, List[EmailBacklog]] = {}
+    for row in rows:
+        by_organization.setdefault(row.organization_id, []).append(row)
+    drained = 0
+    for batch in by_organization.values():
+        try:
+            with transaction.atomic():
+                classify_email_batch(batch[0].organization, [
+                    {'email_content': row.email_content, 'subject': row.subject,
+                     'sender_email': row.sender_email, **row.headers}
+                    for row in batch
+                ])
+                EmailBacklog.objects.filter(id__in=[row.id for row in batch]).delete()
+        except Exception:
+            logger.exception("Email backlog batch of organization %s failed", batch[0].organization_id)
+            continue
+        drained += len(batch)
+    return drained
+
+def health_window(window: str = '24h', resolution: Optional[float] = None) -> Tuple[datetime, datetime, timedelta]:
+    # Raises ValueError for windows and resolutions the views should answer with a 400
+    try:
+        start_date, end_date = parse_timeframe(str(window or '24h'))
+    except ValueError:
+        raise ValueError(f"Unsupported window: {window}")
+    if start_date >= end_date:
+        raise ValueError(f"Unsupported window: {window}")
+    if resolution in (None, ''):
+        return start_date, end_date, (end_date - start_date) / DEFAULT_HEALTH_POINTS
+    try:
+        seconds = float(resolution)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid resolution: {resolution}")
+    if not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError(f"Invalid resolution: {resolution}")
+    return start_date, end_date, timedelta(seconds=seconds)
+
+def analyze_infrastructure(organization: Organization, resource_id: int, window: str = '24h',
+                           resolution: Optional[float] = None) -> Dict:
+    resource = CloudResource.objects.get(
+        id=resource_id,
+        organization=organization
+    )
+
+    # Longer windows are read from the coarsest rollup tier that still gives
+    # about DEFAULT_HEALTH_POINTS points per metric
+    start_date, end_date, resolution = health_window(window, resolution)
+    df = query_metrics(organization, [resource.id], start_date, end_date, resolution)
+    with metered() as meter, routing(organization):
+        analysis = get_agent().analyze_resource_health(df, resource.configuration, str(resource.id))
+
+    record_usage(
+        organization=organization,
+        feature='infrastructure_analysis',
+        tokens=meter.tokens,
+        cost=meter.cost
+    )
+    return analysis.dict()
+
+def process_social_message(organization: Organization, platform: str, contact_id: str, message: str,
+                           locked: bool = False) -> Dict:
+    return process_social_messages(organization, platform, contact_id, [message], locked)
+
+def process_social_messages(organization: Organization, platform: str, contact_id: str,
+                            messages: List[str], locked: bool = False) -> Dict:
+    # Consecutive customer messages are analyzed as one turn. locked=True means the caller
+    # already holds the conversation lock
+    if not locked:
+        with conversation_lock(conversation_key(organization.id, platform, contact_id)):
+            return process_social_messages(organization, platform, contact_id, messages, locked=True)
+
+    message = "\n".join(messages)
+    conversation = _get_conversation(organization, platform, contact_id)
+    history, summary = load_prompt_history(conversation, message)
+
+    with metered() as meter, routing(organization):
+        analysis = get_agent().process_social_message(
+            message,
+            history,
+            conversation.stage,
+            conversation.context_data,
+            summary
+        )
+
+    conversation = _save_social_analysis(organization, conversation, messages, analysis, meter)
+    return _social_result(conversation, analysis)
+
+def stream_social_message(organization: Organization, platform: str, contact_id: str,
+                          message: str) -> Iterator[Union[str, Dict]]:
+    # Yields reply text as it arrives and the same dict as process_social_message once the
+    # analysis is stored. A client that disconnects mid-reply leaves the conversation as it was
+    with conversation_lock(conversation_key(organization.id, platform, contact_id)):
+        conversation = _get_conversation(organization, platform, contact_id)
+        history, summary = load_prompt_history(conversation, message)
+
+        with metered() as meter, routing(organization):
+            for item in get_agent().stream_social_message(
+                message,
+                history,
+                conversation.stage,
+                conversation.context_data,
+                summary
+            ):
+                if isinstance(item, str):
+                    yield item
+                else:
+                    analysis = item
+
+        conversation = _save_social_analysis(organization, conversation, [message], analysis, meter)
+    yield _social_result(conversation, analysis)
+
+def analyze_call(organization: Organization, path: str, language: Optional[str] = None) -> Iterator[Dict]:
+    # Events of a sales call analysis: partial transcripts as chunks finish, sentiment per
+    # window of the call, the full transcript, and the coaching analysis last
+    transcription_settings = settings.TRANSCRIPTION_SETTINGS
+    with metered() as meter, routing(organization):
+        try:
+            for item in get_agent().analyze_sales_call(
+                get_transcriber().stream(path, language),
+                transcription_settings['sentiment_window_seconds'],
+                transcription_settings['max_transcript_chars']
+            ):
+                if isinstance(item, TranscriptChunk):
+                    yield {'type': 'partial', **item.model_dump()}
+                elif isinstance(item, Transcript):
+                    yield {'type': 'transcript', **item.model_dump(exclude={'chunks'})}
+                elif isinstance(item, SalesCallAnalysis):
+                    yield {'type': 'analysis', **item.model_dump()}
+                elif isinstance(item, CallAnalysisError):
+                    yield {'type': 'error', **item.model_dump()}
+                else:
+                    yield {'type': 'sentiment', **item.model_dump()}
+        except Exception:
+            # Whatever was produced before the failure is kept, followed by an error event
+            logger.exception("Sales call analysis failed for organization %s", organization.id)
+            yield {'type': 'error', 'stage': 'analysis', 'error': "Call analysis failed"}
+
+    record_usage(
+        organization=organization,
+        feature='sales_coach',
+        tokens=meter.tokens,
+        cost=meter.cost
+    )
+
+def process_sales_call(organization: Organization, path: str, language: Optional[str] = None) -> Dict:
+    # Job handler for the sales coach. The recording was saved by the API for this job only
+    result = {'transcript': None, 'sentiment': [], 'analysis': None, 'errors': []}
+    try:
+        for event in analyze_call(organization, path, language):
+            kind = event.pop('type')
+            if kind == 'transcript':
+                result['transcript'] = event
+            elif kind == 'sentiment':
+                result['sentiment'].append(event)
+            elif kind == 'analysis':
+                result['analysis'] = event
+            elif kind == 'error':
+                result['errors'].append(event)
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    return result
+
+def _get_conversation(organization: Organization, platform: str, contact_id: str) -> SocialConversation:
+    # Obtener o crear conversación
+    conversation, created = SocialConversation.objects.get_or_create(
+        organization=organization,
+        platform=platform,
+        contact_id=contact_id
+    )
+    return conversation
+
+def _save_social_analysis(organization: Organization, conversation: SocialConversation, messages: List[str],
+                          analysis: MessageAnalysis, meter: UsageMeter) -> SocialConversation:
+    with transaction.atomic():
+        # Guardar mensajes y análisis
+        # The analysis covers the whole burst and is stored on its last message
+        last = len(messages) - 1
+        SocialMessage.objects.bulk_create([
+            SocialMessage(
+                conversation=conversation,
+                is_from_contact=True,
+                content=message,
+                intent=analysis.intent if i == last else None,
+                sentiment=analysis.sentiment if i == last else None
+            )
+            for i, message in enumerate(messages)
+        ])
+
+        # Actualizar conversación y contexto
+        # Applied to the locked row, not the copy read before the LLM call
+        conversation = SocialConversation.objects.select_for_update().get(id=conversation.id)
+        conversation.stage = analysis.suggested_stage
+        conversation.lead_score += analysis.lead_score_delta
+        conversation.context_data = prune_context({**conversation.context_data, **analysis.updated_context})
+        conversation.last_intent = analysis.intent.get('type')
+        conversation.save()
+
+    if needs_summary(conversation):
+        from .tasks import summarize_conversation_task
+        summarize_conversation_task.delay(conversation.id)
+
+    record_usage(
+        organization=organization,
+        feature='social_assistant',
+        tokens=meter.tokens,
+        cost=meter.cost
+    )
+    return conversation
+
+def _social_result(conversation: SocialConversation, analysis: MessageAnalysis) -> Dict:
+    return {
+        'suggested_response': analysis.suggested_response,
+        'stage': analysis.suggested_stage,
+        'lead_score': conversation.lead_score,
+        'context': conversation.context_data
+    }
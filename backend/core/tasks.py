@@ -0,0 +1,257 @@
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import ipaddress
+import logging
+import socket
+import httpx
+import requests
+from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
+from . import services
+from .channels import get_graph_client
+from .classifier import train_email_classifiers
+from .collectors import collect_metrics
+from .conversation import (
+    burst_wait, conversation_key, conversation_lock, push_pending_message,
+    summarize_conversation, take_pending_messages
+)
+from .models import AgentJob, InboundEvent, Organization, SocialChannel
+from .timeseries import apply_retention, ensure_metric_partitions, refresh_day_rollups
+
+logger = logging.getLogger(__name__)
+
+JOB_HANDLERS = {
+    'email': services.process_email,
+    'infrastructure': services.analyze_infrastructure,
+    'social_message': services.process_social_message,
+    'sales_call': services.process_sales_call,
+}
+
+def validate_callback_url(url: str) -> str:
+    # Results are posted from inside our network, so a callback must not reach private,
+    # loopback or link-local addresses (the cloud metadata endpoint among them)
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("callback_url must be an http or https URL")
+    host = parts.hostname.lower()
+    if host in settings.AGENT_SETTINGS['callback_allowed_hosts']:
+        return url
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError, ValueError):
+        raise ValueError(f"callback_url host {host} does not resolve")
+    if not all(ipaddress.ip_address(address.split('%')[0]).is_global for address in addresses):
+        raise ValueError(f"callback_url host {host} is not a public address")
+    return url
+
+def submit_job(organization: Organization, kind: str, payload: Dict,
+               callback_url: Optional[str] = None, reply_channel: Optional[SocialChannel] = None) -> AgentJob:
+    job = AgentJob.objects.create(
+        organization=organization,
+        kind=kind,
+        payload=payload,
+        callback_url=validate_callback_url(callback_url) if callback_url else None,
+        reply_channel=reply_channel
+    )
+    queue = settings.AGENT_SETTINGS['job_queues'][kind]
+    if kind == 'social_message' and settings.SOCIAL_SETTINGS['debounce_seconds'] > 0:
+        key = conversation_key(organization.id, payload['platform'], payload['contact_id'])
+        if push_pending_message(key, str(job.id)):
+            process_social_burst.apply_async(args=[key], queue=queue,
+                                             countdown=settings.SOCIAL_SETTINGS['debounce_seconds'])
+    else:
+        run_agent_job.apply_async(args=[str(job.id)], queue=queue)
+    return job
+
+def job_representation(job: AgentJob) -> Dict:
+    return {
+        'job_id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'result': job.result,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+@shared_task
+def run_agent_job(job_id: str) -> None:
+    # Only a queued job is claimed, so a redelivered message doesn't run it twice
+    claimed = AgentJob.objects.filter(id=job_id, status='queued').update(
+        status='running', started_at=timezone.now()
+    )
+    if not claimed:
+        return
+
+    job = AgentJob.objects.select_related('organization').get(id=job_id)
+    try:
+        job.result = JOB_HANDLERS[job.kind](job.organization, **job.payload)
+        job.status = 'succeeded'
+    except Exception as e:
+        logger.exception("Agent job %s (%s) failed", job.id, job.kind)
+        job.status = 'failed'
+        job.error = str(e)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+
+    if job.callback_url:
+        deliver_job_callback.delay(str(job.id))
+    if job.reply_channel_id and job.status == 'succeeded':
+        send_social_reply.delay(str(job.id))
+
+@shared_task(bind=True)
+def process_social_burst(self, key: str, lock_attempts: int = 0) -> None:
+    # Runs once the contact has been quiet for the debounce window and answers every
+    # message queued since the last burst with a single analysis
+    wait = burst_wait(key)
+    if wait > 0:
+        raise self.retry(countdown=wait, max_retries=None)
+
+    try:
+        with conversation_lock(key):
+            outcome = _answer_burst(key)
+    except TimeoutError as e:
+        # The previous turn still holds the conversation, the messages stay queued meanwhile
+        if lock_attempts < settings.SOCIAL_SETTINGS['lock_retries']:
+            raise self.retry(exc=e, kwargs={'lock_attempts': lock_attempts + 1},
+                             countdown=max(1.0, settings.SOCIAL_SETTINGS['debounce_seconds']), max_retries=None)
+        logger.error("Giving up on social burst %s: %s", key, e)
+        jobs = list(AgentJob.objects.filter(id__in=take_pending_messages(key), status='queued')
+                    .order_by('created_at'))
+        outcome = (jobs, None, 'failed', str(e)) if jobs else None
+    if outcome is None:
+        return
+    jobs, result, status, error = outcome
+    last = jobs[-1]
+
+    # The reply goes to the newest job, earlier ones point at it
+    finished = timezone.now()
+    for job in jobs:
+        AgentJob.objects.filter(id=job.id).update(
+            status=status,
+            result=result if job is last else {'coalesced_into': str(last.id)},
+            error=error,
+            finished_at=finished
+        )
+    if last.callback_url:
+        deliver_job_callback.delay(str(last.id))
+    if last.reply_channel_id and status == 'succeeded':
+        send_social_reply.delay(str(last.id))
+
+def _answer_burst(key: str) -> Optional[Tuple[List[AgentJob], Optional[Dict], str, Optional[str]]]:
+    # Runs under the conversation lock, returns (jobs, result, status, error) or None when
+    # another run already answered the queued messages
+    job_ids = take_pending_messages(key)
+    jobs = list(AgentJob.objects.filter(id__in=job_ids, status='queued')
+                .select_related('organization').order_by('created_at'))
+    if not jobs:
+        return None
+
+    now = timezone.now()
+    AgentJob.objects.filter(id__in=[job.id for job in jobs]).update(status='running', started_at=now)
+    last = jobs[-1]
+    try:
+        result = services.process_social_messages(
+            last.organization,
+            last.payload['platform'],
+            last.payload['contact_id'],
+            [job.payload['message'] for job in jobs],
+            locked=True
+        )
+        return jobs, result, 'succeeded', None
+    except Exception as e:
+        logger.exception("Social burst %s failed", key)
+        return jobs, None, 'failed', str(e)
+
+@shared_task(bind=True, max_retries=settings.AGENT_SETTINGS['callback_max_retries'])
+def deliver_job_callback(self, job_id: str) -> None:
+    job = AgentJob.objects.get(id=job_id)
+    try:
+        # Checked again, the host may resolve elsewhere by now
+        validate_callback_url(job.callback_url)
+    except ValueError as e:
+        logger.error("Not delivering job %s: %s", job.id, e)
+        return
+    try:
+        response = requests.post(job.callback_url, json=job_representation(job),
+                                 timeout=settings.AGENT_SETTINGS['callback_timeout'], allow_redirects=False)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        # 2s, 4s, 8s... so a restarting n8n instance still gets the result
+        raise self.retry(exc=e, countdown=2 ** (self.request.retries + 1))
+    AgentJob.objects.filter(id=job.id).update(callback_delivered_at=timezone.now())
+
+@shared_task
+def handle_inbound_events(platform: str, message_ids: List[str]) -> None:
+    # Turns webhook messages into social jobs, which go through the same debounce and
+    # conversation lock as API messages. Each event is claimed once, whatever Meta redelivers
+    events = list(InboundEvent.objects.filter(platform=platform, message_id__in=message_ids, status='received')
+                  .order_by('received_at', 'id'))
+    channels = {
+        channel.external_id: channel
+        for channel in SocialChannel.objects.filter(
+            platform=platform, is_active=True,
+            external_id__in={event.channel_external_id for event in events}
+        ).select_related('organization')
+    }
+    for event in events:
+        channel = channels.get(event.channel_external_id)
+        status = 'queued' if channel is not None and event.text else 'ignored'
+        if not InboundEvent.objects.filter(id=event.id, status='received').update(status=status):
+            continue
+        if status == 'ignored':
+            continue
+        try:
+            job = submit_job(channel.organization, 'social_message', {
+                'platform': platform,
+                'contact_id': event.contact_id,
+                'message': event.text,
+            }, reply_channel=channel)
+            InboundEvent.objects.filter(id=event.id).update(job=job)
+        except Exception as e:
+            logger.exception("Inbound %s message %s could not be queued", platform, event.message_id)
+            InboundEvent.objects.filter(id=event.id).update(status='failed', error=str(e))
+
+@shared_task(bind=True, max_retries=settings.SOCIAL_SETTINGS['meta']['send_max_retries'])
+def send_social_reply(self, job_id: str) -> None:
+    job = AgentJob.objects.select_related('reply_channel').get(id=job_id)
+    text = (job.result or {}).get('suggested_response')
+    if job.reply_sent_at or job.reply_channel is None or not text:
+        return
+    try:
+        get_graph_client().send_text(job.reply_channel, job.payload['contact_id'], text)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code < 500 and e.response.status_code != 429:
+            # Expired token, closed messaging window... retrying won't help
+            logger.error("Graph API rejected the reply of job %s: %s", job.id, e.response.text[:500])
+            return
+        raise self.retry(exc=e, countdown=2 ** (self.request.retries + 1))
+    except httpx.HTTPError as e:
+        raise self.retry(exc=e, countdown=2 ** (self.request.retries + 1))
+    AgentJob.objects.filter(id=job.id).update(reply_sent_at=timezone.now())
+
+@shared_task
+def collect_metrics_task() -> Dict:
+    return collect_metrics().dict()
+
+@shared_task
+def maintain_metrics_task() -> None:
+    ensure_metric_partitions()
+    apply_retention()
+
+@shared_task
+def refresh_day_rollups_task() -> None:
+    refresh_day_rollups()
+
+@shared_task
+def summarize_conversation_task(conversation_id: int) -> bool:
+    return summarize_conversation(conversation_id)
+
+@shared_task
+def drain_email_backlog_task() -> int:
+    return services.drain_email_backlog()
+
+@shared_task
+def train_email_classifiers_task() -> Dict:
+    return train_email_classifiers()
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from core.alerts import AlertEvaluator, AlertRule, AlertStateStore, evaluate
+from core.models import Alert, CloudResource, Organization
+
+RULE = AlertRule(name='cpu_utilization_high', metric_name='cpu_utilization', threshold=80.0, aggregate='last',
+                 window=300, for_duration=60, hysteresis=0.1, severity='warning')
+START = datetime(2024, 5, 1, 12, 0, tzinfo=dt_timezone.utc)
+
+def new_state():
+    return {'window': [], 'pending_since': None, 'firing': False, 'last_ts': 0.0}
+
+def series(*values, step=30):
+    return [(START.timestamp() + i * step, value) for i, value in enumerate(values)]
+
+class EvaluateTests(SimpleTestCase):
+    def test_fires_only_after_the_condition_held_for_the_duration(self):
+        state = new_state()
+        samples = series(90, 90, 90)
+
+        self.assertIsNone(evaluate(state, RULE, samples[:2], 600))
+        self.assertIsNotNone(state['pending_since'])
+        self.assertEqual(evaluate(state, RULE, samples[2:], 600), (True, 90, samples[2][0]))
+        self.assertTrue(state['firing'])
+
+    def test_a_dip_below_the_threshold_restarts_the_pending_period(self):
+        state = new_state()
+
+        self.assertIsNone(evaluate(state, RULE, series(90, 90, 70, 90, 90), 600))
+        self.assertFalse(state['firing'])
+
+    def test_resolves_only_below_the_hysteresis_band(self):
+        state = new_state()
+        evaluate(state, RULE, series(90, 90, 90), 600)
+        # 75 is under the threshold but above the 72 clear threshold
+        self.assertIsNone(evaluate(state, RULE, [(START.timestamp() + 90, 75)], 600))
+        self.assertTrue(state['firing'])
+
+        self.assertEqual(evaluate(state, RULE, [(START.timestamp() + 120, 70)], 600)[:2], (False, 70))
+        self.assertFalse(state['firing'])
+
+    def test_replayed_samples_are_ignored(self):
+        state = new_state()
+        evaluate(state, RULE, series(90, 90, 90), 600)
+
+        self.assertIsNone(evaluate(state, RULE, series(10, 10, 10), 600))
+        self.assertTrue(state['firing'])
+
+@override_settings(ALERT_SETTINGS={**settings.ALERT_SETTINGS, 'window': 300, 'aggregate': 'last',
+                                   'for_duration': 60, 'hysteresis': 0.1})
+class AlertEvaluatorTests(TestCase):
+    def setUp(self):
+        organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.resource = CloudResource.objects.create(organization=organization, name='web-1', provider='aws',
+                                                     resource_id='i-1', resource_type='ec2', region='eu',
+                                                     configuration={})
+
+    def rows(self, *values, offset=0):
+        return [(self.resource.id, 'cpu_utilization', value, '%', START + timedelta(seconds=30 * i))
+                for i, value in enumerate(values)][offset:]
+
+    def test_one_active_alert_per_rule_until_it_resolves(self):
+        evaluator = AlertEvaluator(AlertStateStore(), {'cpu_utilization': 80})
+        self.assertEqual([t.firing for t in evaluator.process(self.rows(90, 90, 90))], [True])
+
+        # A worker that lost its state fires again, the active alert is not duplicated
+        AlertEvaluator(AlertStateStore(), {'cpu_utilization': 80}).process(self.rows(90, 90, 90))
+        self.assertEqual(Alert.objects.filter(is_active=True).count(), 1)
+
+        self.assertEqual([t.firing for t in evaluator.process(self.rows(90, 90, 90, 50, offset=3))], [False])
+        alert = Alert.objects.get()
+        self.assertFalse(alert.is_active)
+        self.assertIn("below 72", alert.resolution_note)
+
+    def test_redis_state_is_updated_under_a_lock_per_resource(self):
+        redis_client = mock.Mock()
+        redis_client.mget.return_value = [None]
+        evaluator = AlertEvaluator(AlertStateStore(redis_client, lock_timeout=5), {'cpu_utilization': 80})
+
+        evaluator.process(self.rows(90))
+
+        redis_client.lock.assert_called_once_with(f"alerts:lock:{self.resource.id}", timeout=5, blocking_timeout=5)
+        lock = redis_client.lock.return_value
+        lock.release.assert_called_once_with()
+        calls = [call[0] for call in redis_client.mock_calls]
+        self.assertLess(calls.index('lock().acquire'), calls.index('mget'))
+        self.assertLess(calls.index('pipeline().execute'), calls.index('lock().release'))
+
+    def test_busy_resource_is_not_evaluated(self):
+        redis_client = mock.Mock()
+        redis_client.lock.return_value.acquire.return_value = False
+        evaluator = AlertEvaluator(AlertStateStore(redis_client), {'cpu_utilization': 80})
+
+        with self.assertRaises(TimeoutError):
+            evaluator.process(self.rows(90))
+        redis_client.mget.assert_not_called()
+        redis_client.pipeline.assert_not_called()
@@ -0,0 +1,81 @@
+from unittest import mock
+import redis
+from django.test import SimpleTestCase
+from core.cache import LLMCache, llm_cache_key
+
+class LLMCacheKeyTests(SimpleTestCase):
+    def test_key_is_stable_and_ignores_whitespace(self):
+        key = llm_cache_key('gpt-4', "You classify email.", "Classify:\n  hello  world\n")
+        self.assertEqual(key, llm_cache_key(user="Classify: hello world", system="You classify email.",
+                                            model='gpt-4'))
+        self.assertEqual(key, llm_cache_key('gpt-4', "  You classify\temail. ", "Classify: hello world"))
+        # Pinned so the key can't start depending on the process, e.g. through hash()
+        self.assertEqual(key, 'llm:01fbd180f83ff50c6157264837105d955c8fc156fa582542027bef8a46f665c7')
+
+    def test_each_argument_keeps_its_place(self):
+        key = llm_cache_key('gpt-4', "system", "user")
+        self.assertNotEqual(key, llm_cache_key('gpt-4', "user", "system"))
+        self.assertNotEqual(key, llm_cache_key('gpt-3.5-turbo', "system", "user"))
+        self.assertNotEqual(llm_cache_key('gpt-4', "a b", "c"), llm_cache_key('gpt-4', "a", "b c"))
+
+class LLMCacheTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('core.cache.time.monotonic', return_value=1000.0)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entries_expire_after_the_feature_ttl(self):
+        cache = LLMCache({'email': 60})
+        cache.set('k', 'v', 'email')
+
+        self.clock.return_value = 1059.0
+        self.assertEqual(cache.get('k', 'email'), 'v')
+        self.clock.return_value = 1060.0
+        self.assertIsNone(cache.get('k', 'email'))
+        self.assertEqual(cache.stats(), {'l1_hits': 1, 'l2_hits': 0, 'misses': 1, 'errors': 0, 'l1_size': 0})
+
+    def test_features_without_a_ttl_are_not_cached(self):
+        cache = LLMCache({'email': 60})
+        cache.set('k', 'v', 'social')
+        self.assertIsNone(cache.get('k', 'social'))
+        self.assertEqual(cache.stats()['l1_size'], 0)
+
+        disabled = LLMCache({'email': 60}, enabled=False)
+        disabled.set('k', 'v', 'email')
+        self.assertIsNone(disabled.get('k', 'email'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LLMCache({'email': 60}, l1_max_entries=2)
+        cache.set('a', '1', 'email')
+        cache.set('b', '2', 'email')
+        cache.get('a', 'email')
+        cache.set('c', '3', 'email')
+
+        self.assertEqual(cache.get('a', 'email'), '1')
+        self.assertIsNone(cache.get('b', 'email'))
+        self.assertEqual(cache.get('c', 'email'), '3')
+
+    def test_redis_backs_the_local_cache_with_the_same_ttl(self):
+        client = mock.Mock()
+        client.get.return_value = b'from redis'
+        cache = LLMCache({'email': 60}, redis_client=client)
+
+        cache.set('k', 'v', 'email')
+        client.set.assert_called_once_with('k', 'v', ex=60)
+
+        self.assertEqual(cache.get('other', 'email'), 'from redis')
+        self.assertEqual(cache.get('other', 'email'), 'from redis')
+        client.get.assert_called_once_with('other')
+        self.assertEqual(cache.stats()['l2_hits'], 1)
+
+    def test_redis_errors_are_misses(self):
+        client = mock.Mock()
+        client.get.side_effect = redis.ConnectionError("down")
+        client.set.side_effect = redis.ConnectionError("down")
+        cache = LLMCache({'email': 60}, redis_client=client)
+
+        with self.assertLogs('core.cache', 'WARNING'):
+            self.assertIsNone(cache.get('k', 'email'))
+            cache.set('k', 'v', 'email')
+        self.assertEqual(cache.get('k', 'email'), 'v')
+        self.assertEqual(cache.stats()['errors'], 2)
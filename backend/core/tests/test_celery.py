@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.test import SimpleTestCase
+from core.tasks import run_agent_job, summarize_conversation_task
+
+class CeleryAppTests(SimpleTestCase):
+    def test_tasks_use_the_configured_app(self):
+        conf = run_agent_job.app.conf
+        self.assertEqual(run_agent_job.app.main, 'config')
+        self.assertEqual(conf.broker_url, settings.CELERY_BROKER_URL)
+        self.assertEqual(conf.task_routes, settings.CELERY_TASK_ROUTES)
+        self.assertEqual(conf.task_default_queue, settings.CELERY_TASK_DEFAULT_QUEUE)
+
+    def test_bulk_tasks_are_routed_to_the_bulk_queue(self):
+        router = summarize_conversation_task.app.amqp.router
+        route = router.route({}, summarize_conversation_task.name)
+        self.assertEqual(route['queue'].name, 'bulk')
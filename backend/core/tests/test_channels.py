@@ -0,0 +1,113 @@
+import copy
+import hashlib
+import hmac
+import json
+from unittest import mock
+import httpx
+from django.conf import settings
+from django.test import TestCase, override_settings
+from config.celery import app
+from core import tasks
+from core.channels import GraphAPIClient
+from core.models import AgentJob, InboundEvent, Organization, SocialChannel
+
+APP_SECRET = 'test-secret'
+
+def social_settings():
+    social = copy.deepcopy(settings.SOCIAL_SETTINGS)
+    social['meta']['app_secret'] = APP_SECRET
+    social['debounce_seconds'] = 0
+    return social
+
+def whatsapp_delivery(message_id, text):
+    return {
+        'object': 'whatsapp_business_account',
+        'entry': [{'id': 'waba-1', 'changes': [{'field': 'messages', 'value': {
+            'messaging_product': 'whatsapp',
+            'metadata': {'display_phone_number': '15550000000', 'phone_number_id': 'phone-1'},
+            'contacts': [{'wa_id': '34600000000', 'profile': {'name': 'Ana'}}],
+            'messages': [{'from': '34600000000', 'id': message_id, 'timestamp': '1700000000',
+                          'type': 'text', 'text': {'body': text}}],
+        }}]}],
+    }
+
+class MetaWebhookTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.channel = SocialChannel.objects.create(organization=self.organization, platform='whatsapp',
+                                                    external_id='phone-1', access_token='page-token')
+        self.requests = []
+
+        def graph_api(request):
+            self.requests.append(request)
+            return httpx.Response(200, json={'messages': [{'id': 'wamid.reply'}]})
+
+        self.graph = GraphAPIClient('https://graph.test', 'v19.0', transport=httpx.MockTransport(graph_api))
+        self.handler = mock.Mock(return_value={'suggested_response': "Hi Ana, our plans start at $10"})
+
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, 'task_always_eager', eager)
+        overrides = override_settings(SOCIAL_SETTINGS=social_settings())
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        for patcher in (mock.patch.dict(tasks.JOB_HANDLERS, {'social_message': self.handler}),
+                        mock.patch.object(tasks, 'get_graph_client', return_value=self.graph)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def deliver(self, data):
+        body = json.dumps(data).encode('utf-8')
+        signature = 'sha256=' + hmac.new(APP_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        return self.client.post('/webhooks/meta/', body, content_type='application/json',
+                                HTTP_X_HUB_SIGNATURE_256=signature)
+
+    def test_message_is_answered_through_the_graph_api(self):
+        response = self.deliver(whatsapp_delivery('wamid.1', "How much is it?"))
+
+        self.assertEqual(response.status_code, 200)
+        event = InboundEvent.objects.get(message_id='wamid.1')
+        self.assertEqual(event.status, 'queued')
+        self.handler.assert_called_once_with(self.organization, platform='whatsapp',
+                                             contact_id='34600000000', message="How much is it?")
+
+        self.assertEqual(len(self.requests), 1)
+        request = self.requests[0]
+        self.assertEqual(str(request.url), 'https://graph.test/v19.0/phone-1/messages')
+        self.assertEqual(request.headers['Authorization'], 'Bearer page-token')
+        self.assertEqual(json.loads(request.content), {
+            'messaging_product': 'whatsapp',
+            'recipient_type': 'individual',
+            'to': '34600000000',
+            'type': 'text',
+            'text': {'body': "Hi Ana, our plans start at $10"},
+        })
+        job = AgentJob.objects.get(id=event.job_id)
+        self.assertEqual(job.status, 'succeeded')
+        self.assertIsNotNone(job.reply_sent_at)
+
+    def test_redelivered_message_is_answered_once(self):
+        self.deliver(whatsapp_delivery('wamid.1', "How much is it?"))
+        response = self.deliver(whatsapp_delivery('wamid.1', "How much is it?"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(InboundEvent.objects.count(), 1)
+        self.assertEqual(AgentJob.objects.count(), 1)
+        self.assertEqual(self.handler.call_count, 1)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_unsigned_delivery_is_rejected(self):
+        response = self.client.post('/webhooks/meta/', whatsapp_delivery('wamid.1', "hi"),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(InboundEvent.objects.exists())
+
+    def test_rejected_reply_is_not_retried(self):
+        self.graph.client = httpx.Client(transport=httpx.MockTransport(
+            lambda request: self.requests.append(request) or httpx.Response(400, json={'error': {'code': 131047}})
+        ))
+        with self.assertLogs('core.tasks', 'ERROR'):
+            self.deliver(whatsapp_delivery('wamid.1', "How much is it?"))
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertIsNone(AgentJob.objects.get().reply_sent_at)
@@ -0,0 +1,95 @@
+import os
+import tempfile
+from unittest import mock
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.conf import settings
+from core.classifier import EmailClassifier, load_training_data, model_path, train_email_classifier
+from core.models import EmailInteraction, EmailThread, Organization
+
+SAMPLES = {
+    'billing': ["Invoice {} was charged twice on my card", "Please send a refund for invoice {}"],
+    'support': ["The app crashes when I open report {}", "I can't log in since update {}"],
+}
+
+class EmailClassifierTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.thread = EmailThread.objects.create(organization=self.organization, subject='Hi',
+                                                 sender_email='a@example.com', thread_id='acme-1')
+
+    def interaction(self, content, classification):
+        return EmailInteraction.objects.create(thread=self.thread, email_content=content,
+                                               classification=classification, response='')
+
+    def test_training_data_keeps_llm_rows_and_drops_local_ones(self):
+        self.interaction("llm", {'category': 'billing', 'priority': 'high', 'intent': 'refund'})
+        self.interaction("llm tagged", {'category': 'support', 'priority': 'low', 'source': 'llm'})
+        self.interaction("local", {'category': 'billing', 'priority': 'high', 'source': 'local'})
+        self.interaction("unlabelled", {'error': 'timeout'})
+
+        contents = sorted(content for content, _ in load_training_data(self.organization, 100))
+        self.assertEqual(contents, ["llm", "llm tagged"])
+
+    def test_trained_model_answers_confident_emails_locally(self):
+        for i in range(40):
+            for category, templates in SAMPLES.items():
+                for template in templates:
+                    self.interaction(template.format(i), {'category': category, 'priority': 'medium',
+                                                          'intent': category})
+        with tempfile.TemporaryDirectory() as directory, override_settings(EMAIL_SETTINGS={
+            **settings.EMAIL_SETTINGS, 'classifier_dir': directory, 'classifier_min_samples': 50,
+        }):
+            metadata = train_email_classifier(self.organization)
+            self.assertEqual(metadata['samples'], 160)
+
+            classifier = EmailClassifier(threshold=0.5)
+            result, category = classifier.predict(self.organization.id, "Invoice 999 was charged twice on my card")
+            self.assertEqual(category, 'billing')
+            self.assertEqual(result['source'], 'local')
+            self.assertEqual(result['priority'], 'medium')
+
+class BundleReloadTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(EMAIL_SETTINGS={**settings.EMAIL_SETTINGS, 'classifier_dir': directory.name})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.classifier = EmailClassifier(threshold=0.5, reload_interval=60)
+
+    def expire(self):
+        bundle, mtime, checked = self.classifier._bundles[1]
+        self.classifier._bundles[1] = (bundle, mtime, checked - 61)
+
+    def write_model(self, mtime):
+        with open(model_path(1), 'wb') as f:
+            f.write(b'model')
+        os.utime(model_path(1), (mtime, mtime))
+
+    def test_retrained_file_is_loaded_outside_the_lock(self):
+        self.write_model(1000)
+        with mock.patch('core.classifier.joblib.load', return_value={'version': 1}):
+            self.assertEqual(self.classifier.bundle(1), {'version': 1})
+        self.write_model(2000)
+        self.expire()
+
+        def load(path):
+            self.assertFalse(self.classifier._lock.locked())
+            # Callers arriving meanwhile keep the previous bundle instead of waiting
+            self.assertEqual(self.classifier.bundle(1), {'version': 1})
+            return {'version': 2}
+
+        with mock.patch('core.classifier.joblib.load', side_effect=load) as joblib_load:
+            self.assertEqual(self.classifier.bundle(1), {'version': 2})
+            self.assertEqual(self.classifier.bundle(1), {'version': 2})
+        joblib_load.assert_called_once_with(model_path(1))
+
+    def test_unchanged_or_missing_file_is_not_loaded(self):
+        with mock.patch('core.classifier.joblib.load') as joblib_load:
+            self.assertIsNone(self.classifier.bundle(1))
+            self.write_model(1000)
+            self.expire()
+            self.classifier.bundle(1)
+            self.expire()
+            self.classifier.bundle(1)
+        joblib_load.assert_called_once_with(model_path(1))
@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from types import SimpleNamespace
+from unittest import mock
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from core import alerts
+from core.collectors import (
+    AWSCollector, AzureCollector, Collector, CollectorRunner, GCPCollector, KubernetesCollector,
+    collect_metrics, parse_quantity
+)
+from core.health import score_metrics
+from core.ingest import Sample
+from core.models import Alert, CloudResource, Organization, ResourceMetric
+from core.timeseries import query_metrics
+
+SINCE = datetime(2024, 5, 1, 12, 0, tzinfo=dt_timezone.utc)
+UNTIL = SINCE + timedelta(minutes=5)
+
+def at(minutes: int) -> datetime:
+    return SINCE + timedelta(minutes=minutes)
+
+def resource(provider, resource_type, resource_id, configuration=None, region='eu-west-1'):
+    return CloudResource(provider=provider, resource_type=resource_type, resource_id=resource_id,
+                         region=region, configuration=configuration or {})
+
+class FakeCloudWatch:
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.requests = []
+
+    def get_metric_data(self, **request):
+        self.requests.append(request)
+        return self.pages.pop(0)
+
+class ProviderCollectorTests(SimpleTestCase):
+    def test_aws_follows_pages_and_drops_the_boundary_point(self):
+        cloudwatch = FakeCloudWatch([
+            {'MetricDataResults': [{'Id': 'm0', 'Timestamps': [SINCE, at(1)], 'Values': [10.0, 20.0]}],
+             'NextToken': 'page-2'},
+            {'MetricDataResults': [{'Id': 'm0', 'Timestamps': [at(2)], 'Values': [30.0]},
+                                   {'Id': 'm1', 'Timestamps': [at(2)], 'Values': [61.0]},
+                                   {'Id': 'm2', 'Timestamps': [at(2)], 'Values': [512.0]}]},
+        ])
+        regions = []
+        collector = AWSCollector(client_factory=lambda region: regions.append(region) or cloudwatch, rate=0)
+
+        samples = collector.collect(resource('aws', 'ec2', 'i-1'), SINCE, UNTIL)
+
+        self.assertEqual(samples, [
+            Sample('i-1', 'cpu_utilization', 20.0, at(1), 'percent'),
+            Sample('i-1', 'cpu_utilization', 30.0, at(2), 'percent'),
+            Sample('i-1', 'memory_utilization', 61.0, at(2), 'percent'),
+            Sample('i-1', 'network_in', 512.0, at(2), 'bytes'),
+        ])
+        self.assertEqual(regions, ['eu-west-1'])
+        self.assertEqual(cloudwatch.requests[1]['NextToken'], 'page-2')
+        query = cloudwatch.requests[0]['MetricDataQueries'][2]['MetricStat']
+        self.assertEqual(query['Metric']['Dimensions'], [{'Name': 'InstanceId', 'Value': 'i-1'}])
+        self.assertEqual(query['Stat'], 'Sum')
+
+    def test_configured_metrics_replace_the_defaults(self):
+        cloudwatch = FakeCloudWatch([{'MetricDataResults': []}])
+        collector = AWSCollector(client_factory=lambda region: cloudwatch, rate=0)
+        configuration = {'metrics': {'queue_depth': {'namespace': 'AWS/SQS', 'name': 'ApproximateNumberOfMessagesVisible',
+                                                     'dimension': 'QueueName'}}}
+
+        collector.collect(resource('aws', 'sqs', 'jobs', configuration), SINCE, UNTIL)
+        queries = cloudwatch.requests[0]['MetricDataQueries']
+        self.assertEqual([query['MetricStat']['Metric']['MetricName'] for query in queries],
+                         ['ApproximateNumberOfMessagesVisible'])
+
+    def test_unknown_resource_type_is_not_queried(self):
+        collector = AWSCollector(client_factory=mock.Mock(), rate=0)
+        self.assertEqual(collector.collect(resource('aws', 'lambda', 'fn'), SINCE, UNTIL), [])
+        collector.client_factory.assert_not_called()
+
+    def test_gcp_scales_utilization_to_percent(self):
+        point = SimpleNamespace(value=SimpleNamespace(double_value=0.25, int64_value=0),
+                                interval=SimpleNamespace(end_time=at(1)))
+        client = mock.Mock()
+        client.list_time_series.return_value = [SimpleNamespace(points=[point])]
+        collector = GCPCollector(client=client, project='acme', rate=0)
+
+        samples = collector.collect(resource('gcp', 'instance', '123'), SINCE, UNTIL)
+
+        self.assertEqual(samples, [Sample('123', 'cpu_utilization', 25.0, at(1), 'percent')])
+        request = client.list_time_series.call_args.kwargs['request']
+        self.assertEqual(request['name'], 'projects/acme')
+        self.assertIn('resource.labels.instance_id = "123"', request['filter'])
+
+    def test_azure_maps_metric_names_and_skips_empty_points(self):
+        def series(*points):
+            return [SimpleNamespace(data=[SimpleNamespace(timestamp=timestamp, average=average)
+                                          for timestamp, average in points])]
+        client = mock.Mock()
+        client.query_resource.return_value = SimpleNamespace(metrics=[
+            SimpleNamespace(name='Percentage CPU', timeseries=series((at(1), 40.0), (at(2), None))),
+            SimpleNamespace(name='Available Memory Bytes', timeseries=series((at(1), 2048.0))),
+        ])
+        collector = AzureCollector(client=client, rate=0)
+
+        samples = collector.collect(resource('azure', 'vm', '/subscriptions/s/vm-1'), SINCE, UNTIL)
+
+        self.assertEqual(samples, [
+            Sample('/subscriptions/s/vm-1', 'cpu_utilization', 40.0, at(1), 'percent'),
+            Sample('/subscriptions/s/vm-1', 'available_memory', 2048.0, at(1), 'bytes'),
+        ])
+        self.assertEqual(client.query_resource.call_args.kwargs['metric_names'],
+                         ['Percentage CPU', 'Available Memory Bytes'])
+
+    def test_kubernetes_pod_usage_is_summed_over_containers(self):
+        api = mock.Mock()
+        api.get_namespaced_custom_object.return_value = {
+            'timestamp': '2024-05-01T12:01:00Z',
+            'containers': [{'usage': {'cpu': '250000000n', 'memory': '1Ki'}},
+                           {'usage': {'cpu': '500m', 'memory': '1Mi'}}],
+        }
+        collector = KubernetesCollector(api=api, rate=0)
+
+        samples = collector.collect(resource('k8s', 'pod', 'shop/web-1'), SINCE, UNTIL)
+
+        self.assertEqual(samples, [
+            Sample('shop/web-1', 'cpu_cores', 0.75, at(1), 'cores'),
+            Sample('shop/web-1', 'memory_bytes', 1024.0 + 1024.0 ** 2, at(1), 'bytes'),
+        ])
+        api.get_namespaced_custom_object.assert_called_once_with('metrics.k8s.io', 'v1beta1', 'shop', 'pods', 'web-1')
+
+    def test_parse_quantity(self):
+        self.assertEqual(parse_quantity('2'), 2.0)
+        self.assertEqual(parse_quantity('1500m'), 1.5)
+        self.assertEqual(parse_quantity('2Gi'), 2 * 1024.0 ** 3)
+
+class FakeCollector(Collector):
+    def __init__(self, values, **kwargs):
+        super().__init__(rate=0, **kwargs)
+        self.values = values
+        self.windows = []
+
+    def metrics_for(self, resource):
+        return {'cpu_utilization': {}}
+
+    def fetch(self, resource, metrics, since, until):
+        if resource.resource_id in self.values and isinstance(self.values[resource.resource_id], Exception):
+            raise self.values[resource.resource_id]
+        self.windows.append((resource.resource_id, since))
+        return [Sample(resource.resource_id, 'cpu_utilization', value, until - timedelta(seconds=len(values) - i), '%')
+                for values in [self.values.get(resource.resource_id, [])] for i, value in enumerate(values)]
+
+@override_settings(ALERT_SETTINGS={**settings.ALERT_SETTINGS, 'enabled': False})
+class CollectorRunnerTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        for provider, resource_id in (('aws', 'i-1'), ('aws', 'i-broken'), ('gcp', '123'), ('azure', 'vm-1')):
+            CloudResource.objects.create(organization=self.organization, name=resource_id, provider=provider,
+                                         resource_id=resource_id, resource_type='vm', region='eu', configuration={})
+
+    def test_samples_are_stored_and_failures_counted(self):
+        aws = FakeCollector({'i-1': [10.0, 20.0], 'i-broken': RuntimeError("throttled")})
+        gcp = FakeCollector({'123': [30.0]})
+        runner = CollectorRunner({'aws': aws, 'gcp': gcp}, max_workers=4)
+
+        with self.assertLogs('core.collectors', 'ERROR'):
+            result = runner.run(CloudResource.objects.select_related('organization'))
+
+        # The azure resource has no collector configured and is left out
+        self.assertEqual(result.dict(), {'resources': 3, 'failed': 1, 'samples': 3, 'inserted': 3})
+        self.assertEqual(sorted(ResourceMetric.objects.values_list('resource__resource_id', 'value')),
+                         [('123', 30.0), ('i-1', 10.0), ('i-1', 20.0)])
+
+    def test_next_run_starts_after_the_last_stored_sample(self):
+        aws = FakeCollector({'i-1': [10.0]})
+        runner = CollectorRunner({'aws': aws}, lookback=timedelta(hours=1))
+        resources = CloudResource.objects.filter(resource_id='i-1').select_related('organization')
+        runner.run(resources)
+        stored = ResourceMetric.objects.get().timestamp
+
+        runner.run(resources)
+
+        first, second = aws.windows
+        self.assertLess(timezone.now() - timedelta(hours=1) - first[1], timedelta(seconds=5))
+        self.assertEqual(second[1], stored)
+
+    def test_a_lagging_metric_keeps_its_own_cursor(self):
+        now = timezone.now()
+        i_1 = CloudResource.objects.get(resource_id='i-1')
+        ResourceMetric.objects.create(resource=i_1, metric_name='cpu_utilization', value=1.0, unit='%',
+                                      timestamp=now - timedelta(minutes=1))
+        ResourceMetric.objects.create(resource=i_1, metric_name='memory_utilization', value=2.0, unit='%',
+                                      timestamp=now - timedelta(minutes=30))
+
+        class LaggingCollector(Collector):
+            windows = []
+
+            def metrics_for(self, resource):
+                return {'cpu_utilization': {}, 'memory_utilization': {}}
+
+            def fetch(self, resource, metrics, since, until):
+                self.windows.append(since)
+                # Memory is published 20 minutes late, after cpu has moved on
+                return [Sample('i-1', 'cpu_utilization', 3.0, now - timedelta(minutes=20), '%'),
+                        Sample('i-1', 'cpu_utilization', 4.0, now - timedelta(seconds=30), '%'),
+                        Sample('i-1', 'memory_utilization', 5.0, now - timedelta(minutes=20), '%')]
+
+        aws = LaggingCollector(rate=0)
+        result = CollectorRunner({'aws': aws}, lookback=timedelta(hours=1)).run(
+            CloudResource.objects.filter(resource_id='i-1').select_related('organization'))
+
+        self.assertEqual(aws.windows, [now - timedelta(minutes=30)])
+        self.assertEqual(result.inserted, 2)
+        self.assertEqual(sorted(ResourceMetric.objects.values_list('metric_name', 'value')),
+                         [('cpu_utilization', 1.0), ('cpu_utilization', 4.0),
+                          ('memory_utilization', 2.0), ('memory_utilization', 5.0)])
+
+    def test_large_batches_are_flushed_while_collecting(self):
+        aws = FakeCollector({'i-1': [1.0, 2.0, 3.0]})
+        gcp = FakeCollector({'123': [4.0]})
+        runner = CollectorRunner({'aws': aws, 'gcp': gcp}, flush_samples=2)
+
+        with mock.patch.object(CollectorRunner, '_flush', wraps=CollectorRunner._flush) as flush:
+            result = runner.run(CloudResource.objects.exclude(resource_id='i-broken').select_related('organization'))
+
+        self.assertEqual(result.inserted, 4)
+        self.assertEqual(sorted(len(call.args[1]) for call in flush.call_args_list), [1, 3])
+
+@override_settings(ALERT_SETTINGS={**settings.ALERT_SETTINGS, 'enabled': True, 'state_backend': 'memory',
+                                   'for_duration': 60, 'window': 300})
+class CollectedMetricNameTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.resource = CloudResource.objects.create(organization=self.organization, name='web-1', provider='aws',
+                                                     resource_id='i-1', resource_type='ec2', region='eu-west-1',
+                                                     configuration={})
+        patcher = mock.patch.object(alerts, '_alert_evaluator', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_collected_samples_reach_alerts_and_health_scoring(self):
+        now = timezone.now().replace(microsecond=0)
+        timestamps = [now - timedelta(minutes=minutes) for minutes in (4, 3, 2, 1)]
+        cloudwatch = FakeCloudWatch([{'MetricDataResults': [
+            {'Id': 'm0', 'Timestamps': timestamps, 'Values': [95.0, 96.0, 97.0, 98.0]},
+            {'Id': 'm1', 'Timestamps': timestamps, 'Values': [40.0, 40.0, 40.0, 40.0]},
+        ]}])
+        runner = CollectorRunner({'aws': AWSCollector(client_factory=lambda region: cloudwatch, rate=0)})
+
+        result = collect_metrics(self.organization, runner)
+
+        self.assertEqual(result.inserted, 8)
+        alert = Alert.objects.get(resource=self.resource, is_active=True)
+        self.assertEqual(alert.rule, 'cpu_utilization_high')
+
+        report = score_metrics(query_metrics(self.organization, [self.resource.id], now - timedelta(hours=1)),
+                               settings.DEVOPS_SETTINGS['alert_thresholds'])
+        self.assertIn("cpu_utilization at 98.00 is above the 80 threshold", report.issues)
+        self.assertFalse(any(issue.startswith('memory_utilization') for issue in report.issues))
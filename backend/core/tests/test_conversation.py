@@ -0,0 +1,108 @@
+import copy
+from contextlib import nullcontext
+from decimal import Decimal
+from unittest import mock
+from django.conf import settings
+from django.test import TestCase, override_settings
+from core import conversation, tasks
+from core.models import AgentJob, Organization, SocialConversation, SocialMessage
+from core.router import current_organization_id
+from core.usage import meter_tokens
+
+def social_settings():
+    social = copy.deepcopy(settings.SOCIAL_SETTINGS)
+    social['keep_recent_messages'] = 2
+    return social
+
+class FakeSummaryAgent:
+    def __init__(self):
+        self.organization_ids = []
+
+    def summarize_conversation(self, summary, messages, max_words):
+        self.organization_ids.append(current_organization_id())
+        meter_tokens('gpt-4o-mini', 400, 60)
+        return f"{summary} {len(messages)} turns".strip()
+
+@override_settings(SOCIAL_SETTINGS=social_settings())
+class SummarizeConversationTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.conversation = SocialConversation.objects.create(organization=self.organization, platform='whatsapp',
+                                                              contact_id='34600000000')
+        for i in range(5):
+            SocialMessage.objects.create(conversation=self.conversation, is_from_contact=i % 2 == 0,
+                                         content=f"message {i}")
+        patcher = mock.patch.object(conversation, 'get_redis_client')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_summary_is_routed_and_billed_to_the_organization(self):
+        agent = FakeSummaryAgent()
+        with mock.patch.object(conversation, 'record_usage') as record_usage:
+            self.assertTrue(conversation.summarize_conversation(self.conversation.id, agent=agent))
+
+        self.assertEqual(agent.organization_ids, [self.organization.id])
+        record_usage.assert_called_once()
+        usage = record_usage.call_args.kwargs
+        self.assertEqual((usage['organization'], usage['feature'], usage['tokens']),
+                         (self.organization, 'social_assistant', 460))
+        self.assertGreater(Decimal(usage['cost']), 0)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.conversation_summary, "3 turns")
+
+@override_settings(SOCIAL_SETTINGS={**settings.SOCIAL_SETTINGS, 'debounce_seconds': 3, 'lock_retries': 2})
+class SocialBurstTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.key = conversation.conversation_key(self.organization.id, 'whatsapp', '34600000000')
+        self.pending = []
+        for name, replacement in (('push_pending_message', self.push), ('take_pending_messages', self.take),
+                                  ('burst_wait', lambda key: 0.0)):
+            patcher = mock.patch.object(tasks, name, side_effect=replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def push(self, key, job_id):
+        self.pending.append(job_id)
+        return len(self.pending) == 1
+
+    def take(self, key):
+        job_ids, self.pending = self.pending, []
+        return job_ids
+
+    def submit(self, *messages):
+        with mock.patch.object(tasks.process_social_burst, 'apply_async') as schedule:
+            jobs = [tasks.submit_job(self.organization, 'social_message', {
+                'platform': 'whatsapp', 'contact_id': '34600000000', 'message': message
+            }) for message in messages]
+        return jobs, schedule
+
+    def test_a_burst_is_answered_with_one_llm_turn(self):
+        jobs, schedule = self.submit("hola", "tenéis envío?", "a Madrid")
+        schedule.assert_called_once_with(args=[self.key], queue='realtime', countdown=3)
+
+        with mock.patch.object(tasks, 'conversation_lock', return_value=nullcontext()), \
+                mock.patch.object(tasks.services, 'process_social_messages',
+                                  return_value={'suggested_response': "Sí"}) as process:
+            tasks.process_social_burst.apply(args=[self.key])
+
+        process.assert_called_once_with(self.organization, 'whatsapp', '34600000000',
+                                        ["hola", "tenéis envío?", "a Madrid"], locked=True)
+        statuses = {job.id: (job.status, job.result) for job in AgentJob.objects.all()}
+        self.assertEqual(statuses[jobs[-1].id], ('succeeded', {'suggested_response': "Sí"}))
+        self.assertEqual(statuses[jobs[0].id], ('succeeded', {'coalesced_into': str(jobs[-1].id)}))
+
+    def test_busy_conversation_is_retried_then_fails_its_jobs(self):
+        jobs, _ = self.submit("hola")
+        lock = mock.Mock(side_effect=TimeoutError("Conversation is still busy"))
+
+        with mock.patch.object(tasks, 'conversation_lock', lock), \
+                mock.patch.object(tasks.services, 'process_social_messages') as process, \
+                self.assertLogs('core.tasks', 'ERROR'):
+            tasks.process_social_burst.apply(args=[self.key])
+
+        self.assertEqual(lock.call_count, 3)
+        process.assert_not_called()
+        job = AgentJob.objects.get()
+        self.assertEqual((job.status, job.error), ('failed', "Conversation is still busy"))
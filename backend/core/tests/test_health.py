@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
+from core.health import score_metrics
+
+def frame(values, metric='cpu_usage'):
+    timestamps = pd.date_range('2024-05-01', periods=len(values), freq='5min', tz='UTC')
+    return pd.DataFrame({'metric_name': metric, 'value': values, 'timestamp': timestamps})
+
+def ewma_flagged(values) -> bool:
+    return any('anomalous samples' in issue for issue in score_metrics(frame(values), {}).issues)
+
+class EwmaAnomalyTests(SimpleTestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(42)
+
+    def test_stationary_noise_is_rarely_flagged(self):
+        flagged = sum(ewma_flagged(self.rng.normal(50.0, 5.0, 168)) for _ in range(200))
+        self.assertLessEqual(flagged / 200, 0.01)
+
+    def test_single_outlier_is_not_an_ewma_anomaly(self):
+        values = self.rng.normal(50.0, 5.0, 168)
+        values[-3] += 60.0
+        self.assertFalse(ewma_flagged(values))
+
+    def test_sustained_shift_is_flagged(self):
+        values = self.rng.normal(50.0, 5.0, 168)
+        values[-5:] += 30.0
+        report = score_metrics(frame(values), {})
+        self.assertTrue(report.anomalous)
+        self.assertTrue(any('anomalous samples in the last 5' in issue for issue in report.issues))
+
+    def test_metrics_are_scored_independently(self):
+        steady = frame(self.rng.normal(50.0, 5.0, 168), 'cpu_usage')
+        shifted_values = self.rng.normal(200.0, 10.0, 168)
+        shifted_values[-5:] += 60.0
+        shifted = frame(shifted_values, 'memory_usage')
+        report = score_metrics(pd.concat([steady, shifted]), {})
+        ewma_issues = [issue for issue in report.issues if 'anomalous samples' in issue]
+        self.assertEqual(len(ewma_issues), 1)
+        self.assertTrue(ewma_issues[0].startswith('memory_usage'))
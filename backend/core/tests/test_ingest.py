@@ -0,0 +1,102 @@
+from datetime import datetime, timezone as dt_timezone
+from unittest import mock
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from core.ingest import ResourceLookup, Sample, ingest_samples, parse_csv, parse_ndjson, parse_remote_write
+from core.models import CloudResource, Organization, ResourceMetric
+
+AT = datetime(2024, 5, 1, 12, 0, tzinfo=dt_timezone.utc)
+
+class ParserTests(SimpleTestCase):
+    def test_ndjson_reports_bad_lines_and_keeps_the_rest(self):
+        body = b'\n'.join([
+            b'{"resource_id": "i-1", "metric": "cpu", "value": 12.5, "timestamp": 1714564800000, "unit": "%"}',
+            b'',
+            b'{"resource_id": "i-1", "metric": "cpu", "timestamp": "2024-05-01T12:00:00"}',
+            b'{"resource_id": "i-1", "metric": "cpu", "value": "high", "timestamp": 1714564800}',
+            b'{"resource_id": 7, "metric": "mem", "value": 3, "timestamp": "2024-05-01T12:00:00Z"}',
+            b'not json',
+        ])
+
+        samples, errors = parse_ndjson(body)
+
+        self.assertEqual(samples, [Sample('i-1', 'cpu', 12.5, AT, '%'), Sample('7', 'mem', 3.0, AT, '')])
+        self.assertEqual([error.split(':')[0] for error in errors], ['line 3', 'line 4', 'line 6'])
+
+    def test_csv_accepts_epoch_and_iso_timestamps(self):
+        body = (b"resource_id,metric,value,timestamp,unit\n"
+                b"i-1,cpu,12.5,1714564800,%\n"
+                b"i-1,cpu,13,2024-05-01T12:00:00Z,\n"
+                b"i-1,cpu,,1714564800,%\n"
+                b"i-1,cpu,14,yesterday,%\n")
+
+        samples, errors = parse_csv(body)
+
+        self.assertEqual(samples, [Sample('i-1', 'cpu', 12.5, AT, '%'), Sample('i-1', 'cpu', 13.0, AT, '')])
+        self.assertEqual([error.split(':')[0] for error in errors], ['line 4', 'line 5'])
+
+    def test_csv_without_the_required_columns_rejects_every_row(self):
+        samples, errors = parse_csv(b"resource_id,value\ni-1,12.5\n")
+
+        self.assertEqual(samples, [])
+        self.assertEqual(errors, ["line 2: 'timestamp'"])
+
+    def test_remote_write_reports_bad_series(self):
+        payload = {'timeseries': [
+            {'labels': {'__name__': 'cpu', 'resource_id': 'i-1', 'unit': '%'},
+             'samples': [[1714564800000, '12.5'], [1714564860000, 13]]},
+            {'labels': {'resource_id': 'i-1'}, 'samples': [[1714564800000, 1]]},
+            {'labels': {'__name__': 'mem', 'resource_id': 'i-1'}, 'samples': [[1714564800000]]},
+        ]}
+
+        samples, errors = parse_remote_write(payload)
+
+        self.assertEqual([(s.metric_name, s.value, s.unit) for s in samples], [('cpu', 12.5, '%'), ('cpu', 13.0, '%')])
+        self.assertEqual(samples[1].timestamp, datetime(2024, 5, 1, 12, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual([error.split(':')[0] for error in errors], ['series 1', 'series 2'])
+        self.assertEqual(parse_remote_write({}), ([], []))
+
+@override_settings(ALERT_SETTINGS={**settings.ALERT_SETTINGS, 'enabled': False},
+                   METRIC_SETTINGS={**settings.METRIC_SETTINGS, 'rollups_enabled': False})
+class IngestSamplesTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.resource = CloudResource.objects.create(organization=self.organization, name='web-1', provider='aws',
+                                                     resource_id='i-1', resource_type='ec2', region='eu',
+                                                     configuration={})
+        # A fresh lookup per test, the shared one would keep primary keys of rolled back resources
+        patcher = mock.patch('core.ingest.get_resource_lookup', return_value=ResourceLookup())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_repeated_samples_in_a_batch_keep_the_last_value(self):
+        for method in ('copy', 'bulk'):
+            with self.subTest(method=method):
+                ResourceMetric.objects.all().delete()
+                result = ingest_samples(self.organization, [
+                    Sample('i-1', 'cpu', 10.0, AT, '%'),
+                    Sample('i-1', 'cpu', 20.0, AT, '%'),
+                    Sample('i-9', 'cpu', 30.0, AT, '%'),
+                ], method=method)
+
+                self.assertEqual((result.received, result.inserted, result.duplicates, result.rejected),
+                                 (3, 1, 1, 1))
+                self.assertEqual(result.errors, ["unknown resource_id: i-9"])
+                self.assertEqual(ResourceMetric.objects.get().value, 20.0)
+
+    def test_copy_skips_and_counts_samples_already_stored(self):
+        ingest_samples(self.organization, [Sample('i-1', 'cpu', 10.0, AT, '%')], method='copy')
+
+        result = ingest_samples(self.organization, [
+            Sample('i-1', 'cpu', 99.0, AT, '%'),
+            Sample('i-1', 'cpu', 11.0, AT.replace(minute=1), '%'),
+        ], method='copy')
+
+        self.assertEqual((result.inserted, result.duplicates), (1, 1))
+        self.assertEqual(sorted(ResourceMetric.objects.values_list('value', flat=True)), [10.0, 11.0])
+
+    def test_copy_stores_values_and_units_exactly(self):
+        ingest_samples(self.organization, [Sample('i-1', 'latency', 0.1 + 0.2, AT, 'ms, p99')], method='copy')
+
+        metric = ResourceMetric.objects.get()
+        self.assertEqual((metric.value, metric.unit, metric.timestamp), (0.1 + 0.2, 'ms, p99', AT))
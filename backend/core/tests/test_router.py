@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+from unittest import mock
+from django.test import SimpleTestCase
+from prometheus_client import CollectorRegistry
+from pydantic import BaseModel
+from core.agents import AIAgent
+from core.router import ModelRouter, Route, routing
+
+PLANS = {'free': {'max_tier': 'small'}, 'pro': {}, 'enterprise': {'min_tier': 'large'}}
+
+def build_router(**kwargs) -> ModelRouter:
+    return ModelRouter(models={'small': 'gpt-small', 'large': 'gpt-large'},
+                       features={'classify': 'small', 'coach': 'large'}, plans=PLANS,
+                       long_input_chars=100, min_confidence=0.6, max_escalation_rate=0.3,
+                       escalation_alpha=0.5, **kwargs)
+
+class Answer(BaseModel):
+    label: str
+    confidence: float
+
+class ModelRouterTests(SimpleTestCase):
+    def test_tier_comes_from_the_feature_and_input_length(self):
+        router = build_router()
+        self.assertEqual(router.route('classify', 50), Route('small', 'gpt-small', 'feature'))
+        self.assertEqual(router.route('classify', 500), Route('large', 'gpt-large', 'long_input'))
+        self.assertEqual(router.route('coach', 50), Route('large', 'gpt-large', 'feature'))
+        self.assertEqual(router.route('unknown', 50).tier, 'large')
+        self.assertEqual(build_router(enabled=False).route('classify', 50), Route('large', 'gpt-large', 'disabled'))
+
+    def test_plan_bounds_the_tier(self):
+        router = build_router()
+        with routing(SimpleNamespace(plan='free', id=1)):
+            self.assertEqual(router.route('coach', 50), Route('small', 'gpt-small', 'plan'))
+            self.assertIsNone(router.escalate(router.route('classify', 50)))
+        with routing(SimpleNamespace(plan='enterprise', id=2)):
+            self.assertEqual(router.route('classify', 50), Route('large', 'gpt-large', 'plan'))
+
+    def test_escalation_goes_one_tier_up(self):
+        router = build_router()
+        self.assertEqual(router.escalate(router.route('classify', 50)), Route('large', 'gpt-large', 'escalated'))
+        self.assertIsNone(router.escalate(router.route('coach', 50)))
+
+    def test_frequent_escalations_skip_the_small_tier(self):
+        router = build_router()
+        small = router.route('classify', 50)
+        router.record_outcome('classify', small, True)
+        self.assertEqual(router._escalation_rates['classify'], 0.5)
+        self.assertEqual(router.route('classify', 50), Route('large', 'gpt-large', 'escalation_rate'))
+
+        router.record_outcome('classify', small, False)
+        self.assertEqual(router._escalation_rates['classify'], 0.25)
+        self.assertEqual(router.route('classify', 50).tier, 'small')
+
+        router.record_outcome('coach', router.route('coach', 50), True)
+        self.assertNotIn('coach', router._escalation_rates)
+
+class StructuredRoutingTests(SimpleTestCase):
+    def setUp(self):
+        self.router = build_router()
+        self.agent = AIAgent(api_key='test', client=mock.Mock(), registry=CollectorRegistry(), router=self.router)
+        self.create = self.agent.client.chat.completions.create
+
+    def models_called(self):
+        return [call.kwargs['model'] for call in self.create.call_args_list]
+
+    def test_low_confidence_escalates_and_counts_against_the_small_tier(self):
+        self.create.side_effect = [Answer(label='spam', confidence=0.3), Answer(label='sales', confidence=0.9)]
+
+        result = self.agent._complete_structured("system", "user", Answer, feature='classify')
+
+        self.assertEqual(result.label, 'sales')
+        self.assertEqual(self.models_called(), ['gpt-small', 'gpt-large'])
+        self.assertEqual(self.router._escalation_rates['classify'], 0.5)
+
+    def test_confident_small_answer_is_a_success(self):
+        self.router._escalation_rates['classify'] = 0.2
+        self.create.return_value = Answer(label='spam', confidence=0.9)
+
+        self.assertEqual(self.agent._complete_structured("system", "user", Answer, feature='classify').label, 'spam')
+        self.assertEqual(self.models_called(), ['gpt-small'])
+        self.assertEqual(self.router._escalation_rates['classify'], 0.1)
+
+    def test_low_confidence_without_a_higher_tier_leaves_the_stats_alone(self):
+        self.router._escalation_rates['classify'] = 0.2
+        self.create.return_value = Answer(label='spam', confidence=0.3)
+
+        with routing(SimpleNamespace(plan='free', id=1)):
+            result = self.agent._complete_structured("system", "user", Answer, feature='classify')
+
+        self.assertEqual(result.label, 'spam')
+        self.assertEqual(self.models_called(), ['gpt-small'])
+        self.assertEqual(self.router._escalation_rates['classify'], 0.2)
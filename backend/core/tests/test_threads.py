@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from core.models import EmailThread, EmailThreadRef, Organization
+from core.threads import normalize_subject, parse_message_ids, resolve_thread, resolve_threads, subject_key
+
+class HeaderParsingTests(SimpleTestCase):
+    def test_subject_prefixes_and_spacing_are_ignored(self):
+        self.assertEqual(normalize_subject("RE: Fwd:  AW[2]: Invoice   March"), "invoice march")
+
+    def test_message_ids_from_strings_and_lists(self):
+        self.assertEqual(parse_message_ids("<A@mail.test> <b@mail.test>"), ['a@mail.test', 'b@mail.test'])
+        self.assertEqual(parse_message_ids(['<a@mail.test>', '<b@mail.test>']), ['a@mail.test', 'b@mail.test'])
+        self.assertEqual(parse_message_ids(None), [])
+
+class ResolveThreadTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+
+    def test_replies_follow_in_reply_to_whatever_their_subject(self):
+        first = resolve_thread(self.organization, "Invoice", 'bob@mail.test', message_id='<a@mail.test>')
+        reply = resolve_thread(self.organization, "Something else", 'ana@mail.test',
+                               message_id='<b@mail.test>', in_reply_to='<a@mail.test>')
+
+        self.assertEqual(reply.id, first.id)
+        self.assertEqual(EmailThreadRef.objects.filter(thread=first).count(), 2)
+
+    def test_references_find_the_thread_when_in_reply_to_is_unknown(self):
+        first = resolve_thread(self.organization, "Invoice", 'bob@mail.test', message_id='<a@mail.test>')
+        reply = resolve_thread(self.organization, "Other", 'ana@mail.test', in_reply_to='<lost@mail.test>',
+                               references='<a@mail.test> <lost@mail.test>')
+
+        self.assertEqual(reply.id, first.id)
+        # The unknown parent now points at the thread too
+        self.assertEqual(resolve_thread(self.organization, "New", 'eve@mail.test',
+                                       in_reply_to='<lost@mail.test>').id, first.id)
+
+    def test_unrelated_emails_fall_back_to_subject_and_sender(self):
+        threads = resolve_threads(self.organization, [
+            {'subject': "Invoice", 'sender_email': 'bob@mail.test'},
+            {'subject': "RE: invoice", 'sender_email': 'Bob@mail.test'},
+            {'subject': "Invoice", 'sender_email': 'ana@mail.test'},
+        ])
+
+        self.assertEqual(threads[0].id, threads[1].id)
+        self.assertNotEqual(threads[0].id, threads[2].id)
+        self.assertEqual(EmailThread.objects.count(), 2)
+
+    def test_threads_without_a_key_are_adopted_instead_of_duplicated(self):
+        legacy = EmailThread.objects.create(organization=self.organization, subject="Invoice",
+                                            sender_email='Bob@mail.test', thread_id='legacy-1')
+
+        thread = resolve_thread(self.organization, "Re: invoice", 'bob@mail.test')
+
+        self.assertEqual(thread.id, legacy.id)
+        self.assertEqual(thread.thread_key, subject_key(self.organization.id, "Invoice", 'bob@mail.test'))
+        self.assertEqual(EmailThread.objects.count(), 1)
+
+class ConcurrentResolveTests(TransactionTestCase):
+    def test_simultaneous_emails_share_one_thread(self):
+        organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        barrier = threading.Barrier(4)
+
+        def resolve(i):
+            try:
+                barrier.wait()
+                return resolve_thread(organization, "Outage", 'ops@mail.test', message_id=f'<{i}@mail.test>').id
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            thread_ids = set(executor.map(resolve, range(4)))
+
+        self.assertEqual(len(thread_ids), 1)
+        self.assertEqual(EmailThread.objects.count(), 1)
+        self.assertEqual(EmailThreadRef.objects.filter(thread_id__in=thread_ids).count(), 4)
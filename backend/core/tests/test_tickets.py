@@ -0,0 +1,106 @@
+from unittest import mock
+import json
+import httpx
+from django.test import TestCase
+from prometheus_client import CollectorRegistry
+from core import agents
+from core.agents import AIAgent
+from core.models import CloudResource, Organization, TicketOutbox, Trace
+from core.tickets import TicketDispatcher
+
+ERROR_TRACE = {'error': {'type': 'TimeoutError', 'message': 'upstream timed out'}}
+
+class TicketDeliveryTests(TestCase):
+    def setUp(self):
+        organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.resource = CloudResource.objects.create(
+            organization=organization, name='web-1', provider='aws', resource_id='i-1',
+            resource_type='ec2', region='eu-west-1', configuration={}
+        )
+        patcher = mock.patch.dict(agents._trace_dataset_ids, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.agent = AIAgent(api_key='test', client=mock.Mock(), registry=CollectorRegistry(),
+                             webhook_url='https://tickets.test/hook', trace_sample_rate=0.0)
+        self.requests = []
+        self.responses = []
+
+    def webhook(self, request):
+        self.requests.append(json.loads(request.content))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def dispatcher(self, **kwargs):
+        dispatcher = TicketDispatcher('https://tickets.test/hook', concurrency=1,
+                                      transport=httpx.MockTransport(self.webhook), **kwargs)
+        dispatcher.executor.shutdown()
+        # Deliveries run inline so they share the test transaction
+        dispatcher.executor = mock.Mock(map=map)
+        return dispatcher
+
+    def test_delivery_sets_ticket_on_outbox_and_traces(self):
+        self.agent.process_traces([(ERROR_TRACE, self.resource), (ERROR_TRACE, self.resource)])
+        self.responses = [httpx.Response(201, json={'ticket_id': 'T-1'})]
+
+        self.assertEqual(self.dispatcher().dispatch_pending(), 1)
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.requests[0]['occurrences'], 2)
+        outbox = TicketOutbox.objects.get()
+        self.assertEqual((outbox.status, outbox.ticket_id, outbox.attempts), ('delivered', 'T-1', 1))
+        self.assertEqual(set(Trace.objects.values_list('ticket_id', flat=True)), {'T-1'})
+
+    def test_trace_coalesced_after_delivery_gets_the_ticket(self):
+        dispatcher = self.dispatcher()
+        self.agent.process_traces([(ERROR_TRACE, self.resource)])
+        self.responses = [httpx.Response(201, json={'ticket_id': 'T-1'})]
+        dispatcher.dispatch_pending()
+
+        late, = self.agent.process_traces([(ERROR_TRACE, self.resource)])
+        late.refresh_from_db()
+        self.assertEqual(late.ticket_id, 'T-1')
+        self.assertEqual(TicketOutbox.objects.get().occurrences, 2)
+        self.assertEqual(dispatcher.dispatch_pending(), 0)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_failed_delivery_is_retried_later(self):
+        self.agent.process_traces([(ERROR_TRACE, self.resource)])
+        self.responses = [httpx.ConnectError("refused")]
+
+        self.assertEqual(self.dispatcher().dispatch_pending(), 0)
+
+        outbox = TicketOutbox.objects.get()
+        self.assertEqual((outbox.status, outbox.attempts, outbox.last_error), ('pending', 1, 'refused'))
+        self.assertIsNone(Trace.objects.get().ticket_id)
+
+    def test_server_errors_are_retried_like_connection_errors(self):
+        self.agent.process_traces([(ERROR_TRACE, self.resource)])
+        self.responses = [httpx.Response(503)]
+
+        self.assertEqual(self.dispatcher().dispatch_pending(), 0)
+
+        outbox = TicketOutbox.objects.get()
+        self.assertEqual((outbox.status, outbox.attempts), ('pending', 1))
+        self.assertIn('503', outbox.last_error)
+
+    def test_occurrences_after_a_terminal_failure_open_a_new_ticket(self):
+        self.agent.process_traces([(ERROR_TRACE, self.resource)])
+        self.responses = [httpx.ConnectError("refused")]
+        with self.assertLogs('core.tickets', 'ERROR'):
+            self.dispatcher(max_attempts=1).dispatch_pending()
+        failed = TicketOutbox.objects.get()
+        self.assertEqual(failed.status, 'failed')
+
+        late, = self.agent.process_traces([(ERROR_TRACE, self.resource)])
+        self.responses = [httpx.Response(201, json={'ticket_id': 'T-2'})]
+        self.assertEqual(self.dispatcher().dispatch_pending(), 1)
+
+        reopened = TicketOutbox.objects.exclude(id=failed.id).get()
+        self.assertEqual((reopened.coalesce_key, reopened.status, reopened.occurrences, reopened.ticket_id),
+                         (failed.coalesce_key, 'delivered', 1, 'T-2'))
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.occurrences), ('failed', 1))
+        late.refresh_from_db()
+        self.assertEqual((late.ticket_outbox_id, late.ticket_id), (reopened.id, 'T-2'))
@@ -0,0 +1,81 @@
+from datetime import timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from core.ingest import Sample, ingest_samples
+from core.models import (
+    CloudResource, Organization, ResourceMetric, ResourceMetricDay, ResourceMetricHour, ResourceMetricMinute
+)
+from core.timeseries import refresh_day_rollups, refresh_rollups
+
+@override_settings(ALERT_SETTINGS={**settings.ALERT_SETTINGS, 'enabled': False})
+class RollupTests(TestCase):
+    def setUp(self):
+        organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.resource = CloudResource.objects.create(
+            organization=organization, name='web-1', provider='aws', resource_id='i-1',
+            resource_type='ec2', region='eu-west-1', configuration={}
+        )
+
+    def sample(self, timestamp, value):
+        ResourceMetric.objects.create(resource=self.resource, metric_name='cpu', value=value,
+                                      unit='%', timestamp=timestamp)
+
+    def test_buckets_are_truncated_in_utc(self):
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        for minute, value in ((5, 10.0), (40, 20.0), (50, 30.0)):
+            self.sample(hour + timedelta(minutes=minute), value)
+
+        # 04:50 UTC seen from +05:30 is 10:20, whose local hour starts at 04:30 UTC
+        start = (hour + timedelta(minutes=50)).astimezone(dt_timezone(timedelta(hours=5, minutes=30)))
+        refresh_rollups([self.resource.id], start, start)
+
+        bucket = ResourceMetricHour.objects.get(resource=self.resource, bucket=hour)
+        self.assertEqual(bucket.count, 3)
+        self.assertEqual(bucket.sum_value, 60.0)
+
+    def test_recent_days_are_folded_by_the_periodic_refresh(self):
+        timestamp = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=5)
+        self.sample(timestamp, 10.0)
+        refresh_rollups([self.resource.id], timestamp, timestamp)
+        self.assertFalse(ResourceMetricDay.objects.exists())
+
+        refresh_day_rollups()
+        day = ResourceMetricDay.objects.get(resource=self.resource)
+        self.assertEqual(day.bucket, timestamp.replace(hour=0, minute=0))
+        self.assertEqual(day.count, 1)
+
+    def test_backfills_fold_their_days_inline(self):
+        timestamp = timezone.now().replace(second=0, microsecond=0) - timedelta(days=10)
+        self.sample(timestamp, 10.0)
+        refresh_rollups([self.resource.id], timestamp, timestamp)
+        self.assertEqual(ResourceMetricDay.objects.get(resource=self.resource).count, 1)
+
+    def test_copy_ingest_can_run_twice_in_one_transaction(self):
+        timestamp = timezone.now().replace(second=0, microsecond=0) - timedelta(minutes=5)
+        organization = self.resource.organization
+        with transaction.atomic():
+            first = ingest_samples(organization, [Sample('i-1', 'cpu', 10.0, timestamp, '%')], method='copy')
+            second = ingest_samples(organization, [Sample('i-1', 'cpu', 20.0, timestamp + timedelta(minutes=1), '%')],
+                                    method='copy')
+        self.assertEqual((first.inserted, second.inserted), (1, 1))
+
+    def test_out_of_order_batch_keeps_later_samples_in_its_buckets(self):
+        hour = timezone.now().replace(hour=3, minute=0, second=0, microsecond=0) - timedelta(days=10)
+        # Already stored and rolled up: a sample late in the minute, the hour and the day
+        for offset, value in ((timedelta(seconds=50), 10.0), (timedelta(minutes=40), 20.0),
+                              (timedelta(hours=5), 30.0)):
+            self.sample(hour + offset, value)
+            refresh_rollups([self.resource.id], hour + offset, hour + offset)
+
+        # A late batch with only an earlier sample in the same buckets
+        self.sample(hour + timedelta(seconds=10), 40.0)
+        refresh_rollups([self.resource.id], hour + timedelta(seconds=10), hour + timedelta(seconds=10))
+
+        minute = ResourceMetricMinute.objects.get(resource=self.resource, bucket=hour)
+        self.assertEqual((minute.count, minute.sum_value), (2, 50.0))
+        hourly = ResourceMetricHour.objects.get(resource=self.resource, bucket=hour)
+        self.assertEqual((hourly.count, hourly.sum_value), (3, 70.0))
+        day = ResourceMetricDay.objects.get(resource=self.resource)
+        self.assertEqual((day.count, day.sum_value), (4, 100.0))
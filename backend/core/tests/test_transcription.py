@@ -0,0 +1,68 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+from django.test import SimpleTestCase
+from core import transcription
+from core.transcription import SAMPLE_RATE, Transcriber, Transcript, TranscriptChunk, find_chunks
+
+def speech(seconds: float) -> np.ndarray:
+    return np.random.default_rng(0).uniform(-0.5, 0.5, int(seconds * SAMPLE_RATE)).astype(np.float32)
+
+def silence(seconds: float) -> np.ndarray:
+    return np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
+
+class FindChunksTests(SimpleTestCase):
+    def test_cuts_land_in_the_pauses_near_the_target_length(self):
+        audio = np.concatenate([speech(23), silence(1), speech(25), silence(1), speech(20)])
+
+        chunks = find_chunks(audio, target_seconds=25, max_seconds=30, search_seconds=4)
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], len(audio))
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+        self.assertTrue(23 <= chunks[0][1] / SAMPLE_RATE <= 24)
+        self.assertTrue(49 <= chunks[1][1] / SAMPLE_RATE <= 50)
+
+    def test_no_chunk_is_longer_than_the_maximum(self):
+        chunks = find_chunks(speech(95), target_seconds=25, max_seconds=30, search_seconds=4)
+
+        self.assertGreater(len(chunks), 3)
+        self.assertTrue(all(end - start <= 30 * SAMPLE_RATE for start, end in chunks))
+
+    def test_short_and_empty_recordings(self):
+        self.assertEqual(find_chunks(speech(10), 25, 30, 4), [(0, 10 * SAMPLE_RATE)])
+        self.assertEqual(find_chunks(np.zeros(100, dtype=np.float32), 25, 30, 4), [(0, 100)])
+        self.assertEqual(find_chunks(np.zeros(0, dtype=np.float32), 25, 30, 4), [])
+
+class InlinePool:
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+def fake_transcribe(index, audio, offset, language):
+    return {'index': index, 'start': offset, 'end': offset + len(audio) / SAMPLE_RATE,
+            'text': f"part {index}", 'segments': [], 'language': 'es' if index else 'en'}
+
+class TranscriberStreamTests(SimpleTestCase):
+    def test_chunks_are_merged_in_recording_order(self):
+        audio = np.concatenate([speech(23), silence(1), speech(25), silence(1), speech(20)])
+        whisper = SimpleNamespace(load_audio=mock.Mock(return_value=audio))
+
+        with mock.patch.dict('sys.modules', {'whisper': whisper}), \
+                mock.patch.object(transcription, '_transcribe_chunk', fake_transcribe), \
+                mock.patch.object(transcription, 'as_completed', lambda futures: reversed(futures)):
+            # Chunks finish last to first
+            items = list(Transcriber('base', pool=InlinePool()).stream(__file__))
+
+        partials, transcript = items[:-1], items[-1]
+        self.assertTrue(all(isinstance(item, TranscriptChunk) for item in partials))
+        self.assertEqual([chunk.index for chunk in partials], [2, 1, 0])
+        self.assertIsInstance(transcript, Transcript)
+        self.assertEqual([chunk.index for chunk in transcript.chunks], [0, 1, 2])
+        self.assertEqual(transcript.text, "part 0 part 1 part 2")
+        self.assertEqual(transcript.language, 'es')
+        self.assertAlmostEqual(transcript.duration, 70.0)
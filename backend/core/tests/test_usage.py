@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
+from api.views import AgentViewSet
+from core.models import Organization, Usage, UsageRollup
+from core.usage import UsageRecorder, parse_timeframe, rebuild_usage_rollups, usage_summary
+
+RECORDED = datetime(2024, 5, 1, 12, 59, 58, tzinfo=dt_timezone.utc)
+
+class UsageRecorderTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        # The background flush thread would use its own connection, flushes are called directly
+        patcher = mock.patch.object(UsageRecorder, '_run')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, recorder, count, at=RECORDED):
+        with mock.patch('core.usage.timezone.now', return_value=at):
+            for _ in range(count):
+                recorder.record(self.organization.id, 'email', 10, Decimal('0.0100'))
+
+    def test_rows_are_buffered_until_flushed(self):
+        recorder = UsageRecorder(max_batch=10)
+        self.record(recorder, 3)
+
+        self.assertEqual(Usage.objects.count(), 0)
+        self.assertFalse(recorder._wakeup.is_set())
+        self.assertEqual(recorder.flush(), 3)
+        self.assertEqual(recorder.flush(), 0)
+
+    def test_a_full_batch_wakes_the_flush_thread(self):
+        recorder = UsageRecorder(max_batch=3)
+        self.record(recorder, 2)
+        self.assertFalse(recorder._wakeup.is_set())
+
+        self.record(recorder, 1)
+        self.assertTrue(recorder._wakeup.is_set())
+
+    def test_rows_and_rollups_keep_the_time_they_were_recorded(self):
+        recorder = UsageRecorder()
+        self.record(recorder, 2)
+
+        recorder.flush()
+
+        self.assertEqual(set(Usage.objects.values_list('timestamp', flat=True)), {RECORDED})
+        rollup = UsageRollup.objects.get()
+        self.assertEqual((rollup.bucket, rollup.tokens, rollup.requests),
+                         (datetime(2024, 5, 1, 12, tzinfo=dt_timezone.utc), 20, 2))
+
+    def test_failed_flush_keeps_the_rows_for_the_next_one(self):
+        recorder = UsageRecorder()
+        self.record(recorder, 2)
+
+        with mock.patch('core.usage.increment_rollups', side_effect=RuntimeError("connection lost")), \
+                self.assertLogs('core.usage', 'ERROR'):
+            self.assertEqual(recorder.flush(), 0)
+        self.assertEqual(Usage.objects.count(), 0)
+
+        self.assertEqual(recorder.flush(), 2)
+        self.assertEqual(UsageRollup.objects.get().requests, 2)
+
+    def test_oldest_rows_are_dropped_beyond_the_buffer_limit(self):
+        recorder = UsageRecorder(max_batch=2, max_buffer=3)
+        self.record(recorder, 2, at=datetime(2024, 5, 1, 10, tzinfo=dt_timezone.utc))
+        self.record(recorder, 3)
+
+        with self.assertLogs('core.usage', 'ERROR') as logs:
+            self.assertEqual(recorder.flush(), 3)
+
+        self.assertEqual(recorder.dropped, 2)
+        self.assertIn("dropped the 2 oldest records", logs.output[0])
+        self.assertEqual(set(Usage.objects.values_list('timestamp', flat=True)), {RECORDED})
+
+def at(hour, minute=0):
+    return datetime(2024, 5, 1, hour, minute, tzinfo=dt_timezone.utc)
+
+class UsageSummaryTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        # Tokens encode the row so a wrong sum points at the row counted twice or missed
+        for timestamp, feature, tokens in ((at(10, 10), 'email', 1), (at(10, 45), 'email', 10),
+                                           (at(11, 20), 'email', 100), (at(12, 50), 'social', 1000),
+                                           (at(13, 5), 'social', 10000), (at(13, 30), 'email', 100000)):
+            Usage.objects.create(organization=self.organization, feature=feature, tokens=tokens,
+                                 cost=Decimal('0.0100'), timestamp=timestamp)
+        rebuild_usage_rollups()
+
+    def test_partial_hours_at_both_edges_come_from_raw_rows(self):
+        with self.assertNumQueries(2):
+            stats = usage_summary(self.organization, at(10, 30), at(13, 15))
+
+        self.assertEqual(stats['total_tokens'], 11110)
+        self.assertEqual(stats['total_cost'], Decimal('0.0400'))
+        self.assertEqual(stats['by_feature']['email']['tokens'], 110)
+        self.assertEqual(stats['by_feature']['social']['tokens'], 11000)
+
+    def test_window_inside_one_hour_uses_raw_rows_only(self):
+        self.assertEqual(usage_summary(self.organization, at(13), at(13, 15))['total_tokens'], 10000)
+
+    def test_hourly_series_merges_rollups_and_raw_rows(self):
+        stats = usage_summary(self.organization, at(10, 30), at(13, 15), granularity='hour')
+
+        self.assertEqual([(row['period'], row['feature'], row['tokens']) for row in stats['series']], [
+            (at(10), 'email', 10), (at(11), 'email', 100), (at(12), 'social', 1000), (at(13), 'social', 10000),
+        ])
+
+class TimeframeTests(SimpleTestCase):
+    def test_hours_and_days(self):
+        end = at(12)
+        self.assertEqual(parse_timeframe('24h', end), (end - timedelta(hours=24), end))
+        self.assertEqual(parse_timeframe('7d', end), (end - timedelta(days=7), end))
+
+    def test_invalid_timeframes_raise_value_error(self):
+        for timeframe in ('0h', '-3d', '7w', 'd', 'abc'):
+            with self.subTest(timeframe=timeframe), self.assertRaises(ValueError):
+                parse_timeframe(timeframe)
+
+class UsageStatsViewTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        patcher = mock.patch('api.views.get_agent')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, params):
+        request = APIRequestFactory().get('/', params)
+        force_authenticate(request, user=mock.Mock(organization=self.organization, is_authenticated=True))
+        return AgentViewSet.as_view({'get': 'usage_stats'})(request)
+
+    def test_invalid_windows_are_rejected(self):
+        for params in ({'timeframe': '0d'}, {'timeframe': '-1h'}, {'start': 'yesterday'},
+                       {'start': '2024-05-02T00:00:00Z', 'end': '2024-05-01T00:00:00Z'}):
+            with self.subTest(**params):
+                self.assertEqual(self.get(params).status_code, 400)
+
+    def test_naive_start_and_end_are_made_aware(self):
+        with mock.patch('api.views.usage_summary', return_value={}) as summary:
+            response = self.get({'start': '2024-05-01T10:30:00', 'end': '2024-05-01T13:15:00'})
+
+        self.assertEqual(response.status_code, 200)
+        start, end = summary.call_args.args[1:3]
+        self.assertIsNotNone(start.tzinfo)
+        self.assertEqual(end - start, timedelta(hours=2, minutes=45))
@@ -0,0 +1,181 @@
+from datetime import timedelta
+from unittest import mock
+import os
+import tempfile
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+from api.views import AgentViewSet, SalesCoachViewSet
+from core import views
+from core.models import AgentJob, CloudResource, Organization
+from core.services import health_window, process_sales_call
+from core.tasks import deliver_job_callback, validate_callback_url
+from core.timeseries import DEFAULT_HEALTH_POINTS
+
+INVALID = [
+    {'window': 'abc'},
+    {'window': '0h'},
+    {'window': '24h', 'resolution': 'fast'},
+    {'window': '24h', 'resolution': -60},
+    {'window': '24h', 'resolution': 'nan'},
+]
+
+class HealthWindowTests(SimpleTestCase):
+    def test_default_resolution_spreads_the_window_over_the_health_points(self):
+        start, end, resolution = health_window('7d')
+        self.assertEqual(end - start, timedelta(days=7))
+        self.assertEqual(resolution, timedelta(days=7) / DEFAULT_HEALTH_POINTS)
+        self.assertEqual(health_window('24h', '300')[2], timedelta(seconds=300))
+
+    def test_invalid_values_raise_value_error(self):
+        for data in INVALID:
+            with self.subTest(**data), self.assertRaises(ValueError):
+                health_window(data['window'], data.get('resolution'))
+
+class InfrastructureValidationTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        CloudResource.objects.create(organization=self.organization, name='web-1', provider='aws',
+                                     resource_id='i-1', resource_type='ec2', region='eu-west-1', configuration={})
+        self.user = mock.Mock(organization=self.organization, is_authenticated=True)
+        self.factory = APIRequestFactory()
+        for patcher in (mock.patch('core.views.get_agent'), mock.patch('api.views.get_agent')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, viewset, action, data):
+        request = self.factory.post('/', data, format='json')
+        force_authenticate(request, user=self.user)
+        return viewset.as_view({'post': action})(request)
+
+    def test_invalid_window_or_resolution_is_rejected_before_dispatch(self):
+        endpoints = [(views.AIAgentViewSet, 'analyze_infrastructure'), (AgentViewSet, 'analyze_infrastructure'),
+                     (AgentViewSet, 'analyze_fleet')]
+        handler = mock.Mock()
+        with mock.patch('core.views.submit_job') as submit_job, \
+                mock.patch.dict(views.JOB_HANDLERS, {'infrastructure': handler}), \
+                mock.patch('api.views.query_metrics') as query_metrics:
+            for viewset, action in endpoints:
+                for data in INVALID:
+                    for run_async in (True, False):
+                        with self.subTest(view=viewset.__name__, action=action, run_async=run_async, **data):
+                            response = self.post(viewset, action, {**data, 'resource_id': 1, 'async': run_async})
+                            self.assertEqual(response.status_code, 400)
+                            self.assertIn('error', response.data)
+        submit_job.assert_not_called()
+        handler.assert_not_called()
+        query_metrics.assert_not_called()
+
+    def test_valid_request_is_dispatched(self):
+        handler = mock.Mock(return_value={'health_score': 90})
+        with mock.patch.dict(views.JOB_HANDLERS, {'infrastructure': handler}):
+            response = self.post(views.AIAgentViewSet, 'analyze_infrastructure',
+                                 {'resource_id': 1, 'window': '7d', 'resolution': '3600', 'async': False})
+        self.assertEqual(response.status_code, 200)
+        handler.assert_called_once_with(self.organization, resource_id=1, window='7d', resolution='3600')
+
+class SalesCoachJobTests(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        self.user = mock.Mock(organization=self.organization, is_authenticated=True)
+        upload_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(upload_dir.cleanup)
+        self.upload_dir = upload_dir.name
+        override = override_settings(
+            TRANSCRIPTION_SETTINGS={**settings.TRANSCRIPTION_SETTINGS, 'upload_dir': self.upload_dir}
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_upload_is_saved_and_queued_on_the_transcription_queue(self):
+        request = APIRequestFactory().post('/', {
+            'audio_file': SimpleUploadedFile('call.mp3', b'ID3 audio'),
+            'language': 'es',
+        }, format='multipart')
+        force_authenticate(request, user=self.user)
+
+        with mock.patch('core.tasks.run_agent_job.apply_async') as apply_async:
+            response = SalesCoachViewSet.as_view({'post': 'analyze_call'}, basename='sales-coach')(request)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertIn(response.data['job_id'], response.data['status_url'])
+        job = AgentJob.objects.get(id=response.data['job_id'])
+        self.assertEqual((job.kind, job.payload['language']), ('sales_call', 'es'))
+        self.assertEqual(os.path.dirname(job.payload['path']), self.upload_dir)
+        with open(job.payload['path'], 'rb') as f:
+            self.assertEqual(f.read(), b'ID3 audio')
+        apply_async.assert_called_once_with(args=[str(job.id)], queue='transcription')
+
+    def test_handler_returns_the_analysis_and_removes_the_recording(self):
+        path = os.path.join(self.upload_dir, 'call.mp3')
+        with open(path, 'wb') as f:
+            f.write(b'ID3 audio')
+        events = [
+            {'type': 'partial', 'index': 0, 'text': "hola"},
+            {'type': 'sentiment', 'start': 0.0, 'end': 300.0, 'score': 0.4},
+            {'type': 'transcript', 'text': "hola"},
+            {'type': 'analysis', 'summary': "Good call"},
+        ]
+
+        with mock.patch('core.services.analyze_call', return_value=iter(events)) as analyze_call:
+            result = process_sales_call(self.organization, path, 'es')
+
+        analyze_call.assert_called_once_with(self.organization, path, 'es')
+        self.assertEqual(result, {
+            'transcript': {'text': "hola"},
+            'sentiment': [{'start': 0.0, 'end': 300.0, 'score': 0.4}],
+            'analysis': {'summary': "Good call"},
+            'errors': [],
+        })
+        self.assertFalse(os.path.exists(path))
+
+def resolves_to(*addresses):
+    return mock.patch('core.tasks.socket.getaddrinfo',
+                      return_value=[(2, 1, 6, '', (address, 443)) for address in addresses])
+
+class CallbackUrlTests(TestCase):
+    def test_public_and_allowed_hosts_are_accepted(self):
+        with resolves_to('93.184.216.34'):
+            self.assertEqual(validate_callback_url('https://hooks.example.com/done'), 'https://hooks.example.com/done')
+        with resolves_to('172.18.0.5') as getaddrinfo:
+            validate_callback_url('http://n8n:5678/webhook/job')
+        getaddrinfo.assert_not_called()
+
+    def test_internal_targets_are_rejected(self):
+        cases = [
+            ('http://localhost/admin', ['127.0.0.1']),
+            ('http://metadata/latest', ['169.254.169.254']),
+            ('http://db:5432/', ['10.0.0.7']),
+            ('http://mixed.example.com/', ['93.184.216.34', '192.168.1.2']),
+            ('http://v6.example.com/', ['::1']),
+            ('ftp://hooks.example.com/done', ['93.184.216.34']),
+            ('file:///etc/passwd', []),
+        ]
+        for url, addresses in cases:
+            with self.subTest(url=url), resolves_to(*addresses), self.assertRaises(ValueError):
+                validate_callback_url(url)
+
+    def test_rejected_callback_is_a_400_and_nothing_is_queued(self):
+        organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        request = APIRequestFactory().post('/', {'resource_id': 1, 'async': True,
+                                                 'callback_url': 'http://127.0.0.1:8000/'}, format='json')
+        force_authenticate(request, user=mock.Mock(organization=organization, is_authenticated=True))
+
+        with mock.patch('core.tasks.run_agent_job.apply_async') as apply_async, resolves_to('127.0.0.1'):
+            response = AgentViewSet.as_view({'post': 'analyze_infrastructure'}, basename='agent')(request)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('callback_url', response.data['error'])
+        self.assertFalse(AgentJob.objects.exists())
+        apply_async.assert_not_called()
+
+    def test_delivery_is_checked_again(self):
+        organization = Organization.objects.create(name='Acme', api_key='acme-key')
+        job = AgentJob.objects.create(organization=organization, kind='email', status='succeeded',
+                                      callback_url='https://hooks.example.com/done')
+
+        with resolves_to('10.0.0.7'), mock.patch('core.tasks.requests.post') as post, \
+                self.assertLogs('core.tasks', 'ERROR'):
+            deliver_job_callback(str(job.id))
+        post.assert_not_called()
@@ -0,0 +1,116 @@
+from typing import Dict, List, Optional, Union
+import hashlib
+import re
+import uuid
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Lower
+from .models import EmailThread, EmailThreadRef, Organization
+
+# Emails are matched to threads through their Message-ID / In-Reply-To / References headers,
+# falling back to the normalized subject and sender. Every lookup goes through a unique
+# SHA-256 key, and new threads and refs are upserted so concurrent emails never duplicate them
+
+SUBJECT_PREFIX = re.compile(r'^\s*((re|fw|fwd|aw|wg|sv|vs|rv|tr|antw)(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+MESSAGE_ID = re.compile(r'<([^<>\s]+)>')
+
+def normalize_subject(subject: str) -> str:
+    return " ".join(SUBJECT_PREFIX.sub('', subject or '').split()).lower()
+
+def parse_message_ids(value: Union[str, List[str], None]) -> List[str]:
+    if not value:
+        return []
+    if isinstance(value, list):
+        value = " ".join(str(item) for item in value)
+    ids = MESSAGE_ID.findall(value) or value.split()
+    return [message_id.strip('<>').lower() for message_id in ids if message_id.strip('<>')]
+
+def hash_key(organization_id: int, kind: str, value: str) -> str:
+    return hashlib.sha256(f"{organization_id}:{kind}:{value}".encode('utf-8')).hexdigest()
+
+def subject_key(organization_id: int, subject: str, sender_email: str) -> str:
+    return hash_key(organization_id, 'subject', f"{normalize_subject(subject)}\n{(sender_email or '').strip().lower()}")
+
+def resolve_threads(organization: Organization, emails: List[Dict]) -> List[EmailThread]:
+    # emails carry subject and sender_email plus optional message_id, in_reply_to and
+    # references. Returns one thread per email with a fixed number of queries for the batch
+    parents = []
+    for email in emails:
+        # Closest ancestor first: In-Reply-To, then References from the newest back
+        ids = parse_message_ids(email.get('in_reply_to')) + parse_message_ids(email.get('references'))[::-1]
+        parents.append([hash_key(organization.id, 'message', message_id) for message_id in dict.fromkeys(ids)])
+
+    known = dict(
+        EmailThreadRef.objects.filter(key__in={key for keys in parents for key in keys})
+        .values_list('key', 'thread_id')
+    )
+    thread_ids: List[Optional[int]] = [
+        next((known[key] for key in keys if key in known), None) for keys in parents
+    ]
+
+    # Emails without a known ancestor fall back to subject + sender, upserted on thread_key
+    fallback = {
+        i: subject_key(organization.id, email['subject'], email['sender_email'])
+        for i, email in enumerate(emails) if thread_ids[i] is None
+    }
+    if fallback:
+        _adopt_unkeyed_threads(organization, {key: emails[i] for i, key in fallback.items()})
+        EmailThread.objects.bulk_create([
+            EmailThread(organization=organization, subject=emails[i]['subject'],
+                        sender_email=emails[i]['sender_email'], thread_key=key,
+                        thread_id=f"{organization.id}-{uuid.uuid4().hex}")
+            for key, i in {key: i for i, key in fallback.items()}.items()
+        ], ignore_conflicts=True)
+        by_key = dict(EmailThread.objects.filter(thread_key__in=set(fallback.values()))
+                      .values_list('thread_key', 'id'))
+        for i, key in fallback.items():
+            thread_ids[i] = by_key[key]
+
+    # The email's own Message-ID, and ancestors we hadn't seen, now point at its thread.
+    # Existing refs are kept, so a thread is never moved once a message is in it
+    refs = {}
+    for email, keys, thread_id in zip(emails, parents, thread_ids):
+        for message_id in parse_message_ids(email.get('message_id')):
+            refs.setdefault(hash_key(organization.id, 'message', message_id), thread_id)
+        for key in keys:
+            if key not in known:
+                refs.setdefault(key, thread_id)
+    EmailThreadRef.objects.bulk_create(
+        [EmailThreadRef(key=key, thread_id=thread_id) for key, thread_id in refs.items()],
+        ignore_conflicts=True
+    )
+
+    threads = EmailThread.objects.in_bulk(set(thread_ids))
+    return [threads[thread_id] for thread_id in thread_ids]
+
+def _adopt_unkeyed_threads(organization: Organization, emails: Dict[str, Dict]) -> None:
+    # Threads created before thread_key existed have it NULL. The oldest one matching a
+    # subject + sender key takes the key the first time that key is looked up
+    missing = set(emails) - set(EmailThread.objects.filter(thread_key__in=set(emails))
+                                .values_list('thread_key', flat=True))
+    if not missing:
+        return
+    senders = {(emails[key]['sender_email'] or '').strip().lower() for key in missing}
+    adopted = {}
+    for thread in (EmailThread.objects.filter(organization=organization, thread_key__isnull=True)
+                   .annotate(sender=Lower('sender_email')).filter(sender__in=senders).order_by('created_at', 'id')):
+        key = subject_key(organization.id, thread.subject, thread.sender_email)
+        if key in missing:
+            adopted.setdefault(key, thread.id)
+    for key, thread_id in adopted.items():
+        try:
+            with transaction.atomic():
+                EmailThread.objects.filter(id=thread_id, thread_key__isnull=True).update(thread_key=key)
+        except IntegrityError:
+            # A concurrent email created a thread with this key first, that one is used
+            pass
+
+def resolve_thread(organization: Organization, subject: str, sender_email: str,
+                   message_id: Optional[str] = None, in_reply_to: Optional[str] = None,
+                   references: Union[str, List[str], None] = None) -> EmailThread:
+    return resolve_threads(organization, [{
+        'subject': subject,
+        'sender_email': sender_email,
+        'message_id': message_id,
+        'in_reply_to': in_reply_to,
+        'references': references,
+    }])[0]
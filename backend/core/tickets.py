@@ -0,0 +1,151 @@
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import hashlib
+import logging
+import random
+import time
+import httpx
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import CloudResource, Trace, TicketOutbox
+
+logger = logging.getLogger(__name__)
+
+def ticket_coalesce_key(trace_data: Dict, resource: CloudResource) -> str:
+    error = trace_data.get('error')
+    if isinstance(error, dict):
+        signature = f"{error.get('type', '')}:{error.get('message', '')}"
+    else:
+        signature = str(error)
+    window = settings.TRACE_SETTINGS['ticket_coalesce_window']
+    bucket = int(time.time() // window) if window else 0
+    return hashlib.sha256(f"{resource.id}:{signature}:{bucket}".encode('utf-8')).hexdigest()
+
+def enqueue_ticket_outbox(rows: List[Tuple]) -> Dict[str, Tuple[int, Optional[str]]]:
+    # rows are (resource_id, coalesce_key, payload_json, occurrences), returns coalesce_key ->
+    # (outbox id, ticket_id). ticket_id is set when the key coalesced into a delivered ticket.
+    # A failed row is left alone and the key gets a new pending row
+    if not rows:
+        return {}
+
+    table = TicketOutbox._meta.db_table
+    now = timezone.now()
+    placeholders = ", ".join(["(%s, %s, %s, %s, 'pending', 0, %s, %s, %s)"] * len(rows))
+    params = []
+    for resource_id, key, payload, occurrences in rows:
+        params.extend([resource_id, key, payload, occurrences, now, now, now])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (resource_id, coalesce_key, payload, occurrences, status, attempts,
+                                 next_attempt_at, created_at, updated_at)
+            VALUES {placeholders}
+            ON CONFLICT (coalesce_key) WHERE status IN ('pending', 'delivered') DO UPDATE SET
+                occurrences = {table}.occurrences + EXCLUDED.occurrences,
+                updated_at = EXCLUDED.updated_at
+            RETURNING coalesce_key, id, ticket_id
+            """,
+            params
+        )
+        return {key: (outbox_id, ticket_id) for key, outbox_id, ticket_id in cursor.fetchall()}
+
+class TicketDispatcher:
+    def __init__(self, webhook_url: str, concurrency: int = 4, batch_size: int = 50,
+                 max_attempts: int = 8, base_backoff: float = 5.0, max_backoff: float = 900.0,
+                 timeout: float = 10.0, lease: float = 60.0,
+                 transport: Optional[httpx.BaseTransport] = None):
+        self.webhook_url = webhook_url
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.lease = lease
+        # One keep-alive pool sized to the concurrency cap. Tests pass an httpx.MockTransport
+        self.client = httpx.Client(
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            timeout=timeout,
+            transport=transport
+        )
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='tickets')
+
+    def claim(self) -> List[TicketOutbox]:
+        now = timezone.now()
+        with transaction.atomic():
+            rows = list(
+                TicketOutbox.objects.select_for_update(skip_locked=True)
+                .filter(status='pending', next_attempt_at__lte=now)
+                .select_related('resource')
+                .order_by('next_attempt_at')[:self.batch_size]
+            )
+            # Push the rows out of reach of other dispatchers while they are in flight
+            TicketOutbox.objects.filter(id__in=[row.id for row in rows]).update(
+                next_attempt_at=now + timedelta(seconds=self.lease)
+            )
+        return rows
+
+    def deliver(self, row: TicketOutbox) -> bool:
+        payload = {**row.payload, 'occurrences': row.occurrences}
+        try:
+            response = self.client.post(self.webhook_url, json=payload)
+            response.raise_for_status()
+            ticket_id = response.json().get('ticket_id') if response.content else None
+        except (httpx.HTTPError, ValueError) as e:
+            self._schedule_retry(row, str(e))
+            return False
+
+        with transaction.atomic():
+            TicketOutbox.objects.filter(id=row.id).update(
+                status='delivered',
+                ticket_id=ticket_id,
+                attempts=row.attempts + 1,
+                last_error=None,
+                updated_at=timezone.now()
+            )
+            Trace.objects.filter(ticket_outbox_id=row.id).update(ticket_id=ticket_id)
+        return True
+
+    def dispatch_pending(self) -> int:
+        rows = self.claim()
+        return sum(self.executor.map(self.deliver, rows))
+
+    def run_forever(self, poll_interval: float = 2.0) -> None:
+        while True:
+            try:
+                delivered = self.dispatch_pending()
+            except Exception:
+                logger.exception("Ticket dispatch failed")
+                delivered = 0
+            if not delivered:
+                time.sleep(poll_interval)
+
+    def _schedule_retry(self, row: TicketOutbox, error: str) -> None:
+        attempts = row.attempts + 1
+        if attempts >= self.max_attempts:
+            logger.error("Giving up on ticket outbox %s after %d attempts: %s", row.id, attempts, error)
+            TicketOutbox.objects.filter(id=row.id).update(
+                status='failed', attempts=attempts, last_error=error, updated_at=timezone.now()
+            )
+            return
+
+        # Exponential backoff with jitter so a recovering webhook isn't hit by every row at once
+        delay = min(self.max_backoff, self.base_backoff * 2 ** row.attempts) * random.uniform(0.5, 1.0)
+        TicketOutbox.objects.filter(id=row.id).update(
+            attempts=attempts,
+            last_error=error,
+            next_attempt_at=timezone.now() + timedelta(seconds=delay),
+            updated_at=timezone.now()
+        )
+
+def build_ticket_dispatcher() -> Optional[TicketDispatcher]:
+    trace_settings = settings.TRACE_SETTINGS
+    if not trace_settings['ticket_webhook_url']:
+        return None
+    return TicketDispatcher(
+        trace_settings['ticket_webhook_url'],
+        concurrency=trace_settings['ticket_concurrency'],
+        max_attempts=trace_settings['ticket_max_attempts'],
+        timeout=trace_settings['ticket_timeout']
+    )
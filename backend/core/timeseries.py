@@ -0,0 +1,256 @@
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+import logging
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .metrics import load_resource_metrics
+from .models import (
+    CloudResource, Organization, ResourceMetric,
+    ResourceMetricMinute, ResourceMetricHour, ResourceMetricDay
+)
+
+logger = logging.getLogger(__name__)
+
+class Tier(NamedTuple):
+    name: str
+    seconds: int
+    model: Optional[type]
+
+# Coarsest first, query_metrics picks the first one that satisfies the request
+TIERS = [
+    Tier('1d', 86400, ResourceMetricDay),
+    Tier('1h', 3600, ResourceMetricHour),
+    Tier('1m', 60, ResourceMetricMinute),
+    Tier('raw', 0, None),
+]
+
+# Fields zeroed to truncate a timestamp to each rollup unit
+BUCKET_FIELDS = {
+    'minute': ('second', 'microsecond'),
+    'hour': ('minute', 'second', 'microsecond'),
+    'day': ('hour', 'minute', 'second', 'microsecond'),
+}
+
+# Health views ask for roughly this many points per metric, e.g. hourly buckets for 7d
+DEFAULT_HEALTH_POINTS = 168
+
+def refresh_rollups(resource_ids: Iterable[int], start: datetime, end: datetime) -> None:
+    # Recomputes every minute and hour bucket touched by samples in [start, end] for the
+    # given resources. Recent day buckets are left to refresh_day_rollups on the bulk queue
+    resource_ids = sorted(set(resource_ids))
+    if not resource_ids:
+        return
+
+    raw_table = ResourceMetric._meta.db_table
+    # date_trunc works in the session time zone, which Django keeps at UTC
+    start = start.astimezone(dt_timezone.utc)
+    end = end.astimezone(dt_timezone.utc)
+    with transaction.atomic(), connection.cursor() as cursor:
+        for model, unit in ((ResourceMetricMinute, 'minute'), (ResourceMetricHour, 'hour')):
+            # Minute and hour buckets come from raw samples so their p95 is exact. Whole
+            # buckets are recomputed, stored samples beyond the batch included, since the
+            # upsert replaces the row
+            source_start, source_end = bucket_bounds(start, end, unit)
+            cursor.execute(
+                _upsert_sql(model, f"""
+                    SELECT resource_id, metric_name, date_trunc('{unit}', timestamp),
+                           min(value), max(value), sum(value), count(*),
+                           percentile_cont(0.95) WITHIN GROUP (ORDER BY value)
+                    FROM {raw_table}
+                    WHERE resource_id = ANY(%s) AND timestamp >= %s AND timestamp < %s
+                    GROUP BY 1, 2, 3
+                """),
+                [resource_ids, source_start, source_end]
+            )
+
+        # Backfills older than the periodic job looks back fold their days right away
+        if start < timezone.now() - timedelta(hours=settings.METRIC_SETTINGS['day_rollup_lookback_hours']):
+            _fold_day_rollups(cursor, start, end, resource_ids)
+
+def bucket_bounds(start: datetime, end: datetime, unit: str) -> Tuple[datetime, datetime]:
+    # [start of the bucket holding start, end of the bucket holding end), both in UTC
+    zero = {field: 0 for field in BUCKET_FIELDS[unit]}
+    return (start.astimezone(dt_timezone.utc).replace(**zero),
+            end.astimezone(dt_timezone.utc).replace(**zero) + timedelta(**{f"{unit}s": 1}))
+
+def refresh_day_rollups(since: Optional[datetime] = None) -> None:
+    # Refolds every day bucket with hour buckets since `since` for all resources. Runs
+    # periodically so ingest requests don't rescan a whole day of hours on every batch
+    now = timezone.now()
+    since = since or now - timedelta(hours=settings.METRIC_SETTINGS['day_rollup_lookback_hours'])
+    with transaction.atomic(), connection.cursor() as cursor:
+        _fold_day_rollups(cursor, since.astimezone(dt_timezone.utc), now)
+
+def _fold_day_rollups(cursor, start: datetime, end: datetime, resource_ids: Optional[List[int]] = None) -> None:
+    # Day buckets are folded from hours, which outlive raw samples. min/max/sum/count
+    # are exact, p95 is the 95th percentile of the hourly p95s
+    hour_table = ResourceMetricHour._meta.db_table
+    resource_filter = "resource_id = ANY(%s) AND" if resource_ids is not None else ""
+    params = [resource_ids] if resource_ids is not None else []
+    cursor.execute(
+        _upsert_sql(ResourceMetricDay, f"""
+            SELECT resource_id, metric_name, date_trunc('day', bucket),
+                   min(min_value), max(max_value), sum(sum_value), sum(count),
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY p95)
+            FROM {hour_table}
+            WHERE {resource_filter} bucket >= %s AND bucket < %s
+            GROUP BY 1, 2, 3
+        """),
+        params + list(bucket_bounds(start, end, 'day'))
+    )
+
+def _upsert_sql(model: type, select: str) -> str:
+    table = model._meta.db_table
+    return f"""
+        INSERT INTO {table} (resource_id, metric_name, bucket, min_value, max_value, sum_value, count, p95)
+        {select}
+        ON CONFLICT (resource_id, metric_name, bucket) DO UPDATE SET
+            min_value = EXCLUDED.min_value,
+            max_value = EXCLUDED.max_value,
+            sum_value = EXCLUDED.sum_value,
+            count = EXCLUDED.count,
+            p95 = EXCLUDED.p95
+    """
+
+def retention_days(organization: Organization, tier: str) -> Optional[int]:
+    days = {**settings.METRIC_SETTINGS['retention_days'], **(organization.metric_retention or {})}
+    return days.get(tier)
+
+def select_tier(organization: Organization, start: datetime, resolution: timedelta) -> Tier:
+    now = timezone.now()
+    for tier in TIERS:
+        if tier.seconds > resolution.total_seconds():
+            continue
+        days = retention_days(organization, tier.name)
+        if days is None or now - timedelta(days=days) <= start:
+            return tier
+    return TIERS[-1]
+
+def query_metrics(organization: Organization, resource_ids: Iterable[int], start: datetime,
+                  end: Optional[datetime] = None, resolution: Optional[timedelta] = None) -> pd.DataFrame:
+    end = end or timezone.now()
+    resource_ids = list(resource_ids)
+    tier = select_tier(organization, start, resolution or timedelta(0))
+    if tier.model is None:
+        return load_resource_metrics(resource_ids if len(resource_ids) > 1 else resource_ids[0],
+                                     since=start, until=end)
+
+    fields = ['metric_name', 'bucket', 'sum_value', 'count', 'min_value', 'max_value', 'p95']
+    if len(resource_ids) > 1:
+        fields.append('resource_id')
+    rows = list(tier.model.objects.filter(
+        resource_id__in=resource_ids, bucket__gte=start, bucket__lt=end
+    ).order_by('bucket').values_list(*fields))
+
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    count = np.array(columns[3], dtype=np.float64)
+    data = {
+        'metric_name': pd.Categorical(columns[0]),
+        # Bucket averages stand in for samples, the health engine reads 'value'
+        'value': np.array(columns[2], dtype=np.float64) / np.where(count > 0, count, np.nan),
+        'min': np.array(columns[4], dtype=np.float64),
+        'max': np.array(columns[5], dtype=np.float64),
+        'count': count,
+        'p95': np.array(columns[6], dtype=np.float64),
+    }
+    if len(resource_ids) > 1:
+        data['resource_id'] = np.array(columns[7], dtype=np.int64)
+    index = pd.DatetimeIndex(pd.to_datetime(list(columns[1]), utc=True), name='timestamp')
+    return pd.DataFrame(data, index=index)
+
+def metric_partitioning_enabled() -> bool:
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+            [ResourceMetric._meta.db_table]
+        )
+        return cursor.fetchone() is not None
+
+def ensure_metric_partitions(days_ahead: int = 7) -> List[str]:
+    # Only applies once core_resourcemetric has been converted to a table
+    # PARTITION BY RANGE (timestamp) with a (id, timestamp) primary key
+    if not metric_partitioning_enabled():
+        return []
+
+    table = ResourceMetric._meta.db_table
+    today = timezone.now().date()
+    created = []
+    with connection.cursor() as cursor:
+        for offset in range(days_ahead + 1):
+            day = today + timedelta(days=offset)
+            name = f"{table}_p{day:%Y%m%d}"
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [day.isoformat(), (day + timedelta(days=1)).isoformat()]
+            )
+            created.append(name)
+    return created
+
+def _expired_partitions(before: datetime) -> List[Tuple[str, datetime]]:
+    table = ResourceMetric._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = %s
+            """,
+            [table]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    expired = []
+    for name in names:
+        try:
+            day = datetime.strptime(name.rsplit('_p', 1)[1], '%Y%m%d').replace(tzinfo=before.tzinfo)
+        except (IndexError, ValueError):
+            continue
+        if day + timedelta(days=1) <= before:
+            expired.append((name, day))
+    return expired
+
+def apply_retention() -> None:
+    now = timezone.now()
+    organizations = list(Organization.objects.all())
+
+    # Raw partitions are shared by every organization, so whole partitions are only
+    # dropped past the longest raw retention. Shorter policies are trimmed with DELETEs
+    raw_days = [retention_days(org, 'raw') for org in organizations]
+    if raw_days and None not in raw_days and metric_partitioning_enabled():
+        cutoff = now - timedelta(days=max(raw_days))
+        with connection.cursor() as cursor:
+            for name, _ in _expired_partitions(cutoff):
+                logger.info("Dropping expired metric partition %s", name)
+                cursor.execute(f"DROP TABLE IF EXISTS {name}")
+
+    for organization in organizations:
+        resources = CloudResource.objects.filter(organization=organization).values('id')
+        days = retention_days(organization, 'raw')
+        if days is not None:
+            _delete_in_batches(ResourceMetric.objects.filter(
+                resource_id__in=resources, timestamp__lt=now - timedelta(days=days)
+            ))
+        for tier in TIERS:
+            if tier.model is None:
+                continue
+            days = retention_days(organization, tier.name)
+            if days is not None:
+                _delete_in_batches(tier.model.objects.filter(
+                    resource_id__in=resources, bucket__lt=now - timedelta(days=days)
+                ))
+
+def _delete_in_batches(queryset, batch_size: int = 10000) -> None:
+    # Short transactions keep the delete from holding locks on a large table
+    model = queryset.model
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        model.objects.filter(id__in=ids).delete()
@@ -0,0 +1,206 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import numpy as np
+from pydantic import BaseModel
+from django.conf import settings
+from .cache import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Long recordings are cut at quiet points into chunks of about one Whisper window, transcribed
+# side by side in a process pool that loads the model once per process, and yielded as they
+# finish. Finished transcripts are cached by the SHA-256 of the audio file
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 480  # 30 ms
+
+class TranscriptSegment(BaseModel):
+    start: float
+    end: float
+    text: str
+
+class TranscriptChunk(BaseModel):
+    index: int
+    start: float
+    end: float
+    text: str
+    segments: List[TranscriptSegment]
+
+class Transcript(BaseModel):
+    audio_hash: str
+    language: Optional[str]
+    duration: float
+    text: str
+    chunks: List[TranscriptChunk]
+
+def audio_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def find_chunks(audio: np.ndarray, target_seconds: float, max_seconds: float,
+                search_seconds: float, silence_seconds: float = 0.3) -> List[Tuple[int, int]]:
+    # Each cut is placed at the quietest stretch of silence_seconds within search_seconds of
+    # the target length, never past max_seconds, so words are rarely split between chunks
+    frames = len(audio) // FRAME_SAMPLES
+    if frames == 0:
+        return [(0, len(audio))] if len(audio) else []
+    rms = np.sqrt(np.mean(audio[:frames * FRAME_SAMPLES].reshape(frames, FRAME_SAMPLES) ** 2, axis=1))
+    window = max(1, int(silence_seconds * SAMPLE_RATE / FRAME_SAMPLES))
+    loudness = np.convolve(rms, np.ones(window) / window, mode='same')
+
+    frames_per_second = SAMPLE_RATE / FRAME_SAMPLES
+    chunks, start = [], 0
+    while frames - start > max_seconds * frames_per_second:
+        low = start + int((target_seconds - search_seconds) * frames_per_second)
+        high = start + int(min(target_seconds + search_seconds, max_seconds) * frames_per_second)
+        cut = low + int(np.argmin(loudness[low:high]))
+        chunks.append((start * FRAME_SAMPLES, cut * FRAME_SAMPLES))
+        start = cut
+    chunks.append((start * FRAME_SAMPLES, len(audio)))
+    return chunks
+
+_model = None
+
+def _load_model(model_name: str, threads: int) -> None:
+    # Pool initializer: every worker process loads the model once and keeps it
+    global _model
+    import torch
+    import whisper
+    torch.set_num_threads(threads)
+    _model = whisper.load_model(model_name, device='cpu')
+
+def _transcribe_chunk(index: int, audio: np.ndarray, offset: float, language: Optional[str]) -> Dict:
+    result = _model.transcribe(audio, fp16=False, language=language, condition_on_previous_text=False)
+    segments = [
+        {'start': offset + segment['start'], 'end': offset + segment['end'], 'text': segment['text'].strip()}
+        for segment in result.get('segments', [])
+    ]
+    return {
+        'index': index,
+        'start': offset,
+        'end': offset + len(audio) / SAMPLE_RATE,
+        'text': result.get('text', '').strip(),
+        'segments': segments,
+        'language': result.get('language'),
+    }
+
+_transcription_pool: Optional[ProcessPoolExecutor] = None
+_transcription_pool_lock = threading.Lock()
+
+def get_transcription_pool() -> ProcessPoolExecutor:
+    global _transcription_pool
+    with _transcription_pool_lock:
+        if _transcription_pool is None:
+            transcription_settings = settings.TRANSCRIPTION_SETTINGS
+            workers = transcription_settings['workers'] or os.cpu_count()
+            threads = transcription_settings['threads_per_worker'] or max(1, (os.cpu_count() or 1) // workers)
+            # forkserver children don't inherit the web worker's threads or DB connections
+            _transcription_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('forkserver'),
+                initializer=_load_model,
+                initargs=(transcription_settings['model'], threads)
+            )
+        return _transcription_pool
+
+class Transcriber:
+    def __init__(self, model: str, pool: Optional[ProcessPoolExecutor] = None, target_seconds: float = 25.0,
+                 max_seconds: float = 30.0, search_seconds: float = 4.0, cache_ttl: int = 0):
+        self.model = model
+        self.pool = pool
+        self.target_seconds = target_seconds
+        self.max_seconds = max_seconds
+        self.search_seconds = search_seconds
+        self.cache_ttl = cache_ttl
+
+    def stream(self, path: str, language: Optional[str] = None) -> Iterator:
+        # Yields TranscriptChunk objects as they finish, in completion order, then the
+        # Transcript with every chunk in recording order
+        digest = audio_hash(path)
+        key = f"transcript:{self.model}:{language or 'auto'}:{digest}"
+        cached = self._cached(key)
+        if cached is not None:
+            yield from cached.chunks
+            yield cached
+            return
+
+        import whisper
+        # Decoded by ffmpeg to 16 kHz mono float32
+        audio = whisper.load_audio(path)
+        bounds = find_chunks(audio, self.target_seconds, self.max_seconds, self.search_seconds)
+        pool = self.pool or get_transcription_pool()
+        futures = [
+            pool.submit(_transcribe_chunk, index, audio[start:end], start / SAMPLE_RATE, language)
+            for index, (start, end) in enumerate(bounds)
+        ]
+        results = []
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                yield TranscriptChunk(**result)
+        finally:
+            # A client that stops reading shouldn't keep the pool busy
+            for future in futures:
+                future.cancel()
+
+        results.sort(key=lambda result: result['index'])
+        languages = [result['language'] for result in results if result['language']]
+        transcript = Transcript(
+            audio_hash=digest,
+            language=language or (max(set(languages), key=languages.count) if languages else None),
+            duration=len(audio) / SAMPLE_RATE,
+            text=" ".join(result['text'] for result in results if result['text']),
+            chunks=[TranscriptChunk(**result) for result in results]
+        )
+        self._store(key, transcript)
+        yield transcript
+
+    def transcribe(self, path: str, language: Optional[str] = None) -> Transcript:
+        for item in self.stream(path, language):
+            if isinstance(item, Transcript):
+                return item
+
+    def _cached(self, key: str) -> Optional[Transcript]:
+        if not self.cache_ttl:
+            return None
+        try:
+            raw = get_redis_client().get(key)
+        except Exception:
+            logger.warning("Transcript cache lookup failed, treating as miss", exc_info=True)
+            return None
+        return Transcript(**json.loads(raw)) if raw else None
+
+    def _store(self, key: str, transcript: Transcript) -> None:
+        if not self.cache_ttl:
+            return
+        try:
+            get_redis_client().set(key, transcript.model_dump_json(), ex=self.cache_ttl)
+        except Exception:
+            logger.warning("Could not cache transcript", exc_info=True)
+
+_transcriber: Optional[Transcriber] = None
+_transcriber_lock = threading.Lock()
+
+def get_transcriber() -> Transcriber:
+    global _transcriber
+    with _transcriber_lock:
+        if _transcriber is None:
+            transcription_settings = settings.TRANSCRIPTION_SETTINGS
+            _transcriber = Transcriber(
+                model=transcription_settings['model'],
+                target_seconds=transcription_settings['chunk_seconds'],
+                max_seconds=transcription_settings['max_chunk_seconds'],
+                search_seconds=transcription_settings['chunk_search_seconds'],
+                cache_ttl=transcription_settings['cache_ttl']
+            )
+        return _transcriber
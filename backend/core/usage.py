@@ -0,0 +1,300 @@
+from typing import Dict, List, Optional, Tuple
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+import atexit
+import contextvars
+import logging
+import threading
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+from .models import Organization, Usage, UsageRollup
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = {
+    'hour': TruncHour,
+    'day': TruncDay,
+}
+
+def hour_bucket(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def completion_cost(model: str, prompt_tokens: int, completion_tokens: int) -> Decimal:
+    pricing = settings.MODEL_PRICING.get(model, settings.MODEL_PRICING['default'])
+    return (Decimal(str(pricing['prompt'])) * prompt_tokens +
+            Decimal(str(pricing['completion'])) * completion_tokens) / 1000
+
+class UsageMeter:
+    # Collects the token counts OpenAI reports for every completion made while it is active
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = Decimal('0')
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, model: str, prompt_tokens: int, completion_tokens: int) -> None:
+        cost = completion_cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += cost
+
+_current_meter: contextvars.ContextVar = contextvars.ContextVar('usage_meter', default=None)
+
+@contextmanager
+def metered():
+    meter = UsageMeter()
+    token = _current_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _current_meter.reset(token)
+
+def meter_completion(model: str, usage) -> None:
+    meter = _current_meter.get()
+    if meter is not None and usage is not None:
+        meter.add(model, usage.prompt_tokens, usage.completion_tokens)
+
+def meter_tokens(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    # For streamed completions, which come back without a usage block
+    meter = _current_meter.get()
+    if meter is not None:
+        meter.add(model, prompt_tokens, completion_tokens)
+
+class UsageRecorder:
+    # Buffers Usage rows per worker and writes them with one bulk_create per flush
+    def __init__(self, max_batch: int = 500, flush_interval: float = 5.0, max_buffer: int = 10000):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_buffer = max(max_buffer, max_batch)
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._buffer: List[Tuple] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, organization_id: int, feature: str, tokens: int, cost) -> None:
+        with self._lock:
+            self._buffer.append((organization_id, feature, tokens, cost, timezone.now()))
+            self._trim()
+            full = len(self._buffer) >= self.max_batch
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='usage-recorder', daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                pending, self._buffer = self._buffer, []
+            if not pending:
+                return 0
+
+            try:
+                with transaction.atomic():
+                    rows = Usage.objects.bulk_create([
+                        Usage(organization_id=org_id, feature=feature, tokens=tokens, cost=cost, timestamp=ts)
+                        for org_id, feature, tokens, cost, ts in pending
+                    ])
+                    increment_rollups(_rollup_rows(rows))
+            except Exception:
+                logger.exception("Flushing %d usage records failed, keeping them for the next flush",
+                                 len(pending))
+                with self._lock:
+                    self._buffer = pending + self._buffer
+                    self._trim()
+                return 0
+            finally:
+                self._report_dropped()
+            return len(pending)
+
+    def _trim(self) -> None:
+        # Called with _lock held. During a long outage the newest usage is the one worth keeping
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            self.dropped += overflow
+
+    def _report_dropped(self) -> None:
+        with self._lock:
+            dropped, self._reported_dropped = self.dropped - self._reported_dropped, self.dropped
+        if dropped:
+            logger.error("Usage buffer full, dropped the %d oldest records (%d since start)",
+                         dropped, self.dropped)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            # This thread never sees request_started, so stale or broken connections are
+            # only closed here. Not done in flush, which may run inside a request's transaction
+            close_old_connections()
+            self.flush()
+
+def _rollup_rows(rows: List[Usage]) -> List[Tuple]:
+    totals = defaultdict(lambda: [0, Decimal('0'), 0])
+    for usage in rows:
+        total = totals[(usage.organization_id, usage.feature, hour_bucket(usage.timestamp))]
+        total[0] += usage.tokens
+        total[1] += Decimal(str(usage.cost))
+        total[2] += 1
+    return [key + tuple(total) for key, total in totals.items()]
+
+_usage_recorder: Optional[UsageRecorder] = None
+_usage_recorder_lock = threading.Lock()
+
+def get_usage_recorder() -> UsageRecorder:
+    global _usage_recorder
+    with _usage_recorder_lock:
+        if _usage_recorder is None:
+            _usage_recorder = UsageRecorder(
+                max_batch=settings.USAGE_SETTINGS['max_batch'],
+                flush_interval=settings.USAGE_SETTINGS['flush_interval'],
+                max_buffer=settings.USAGE_SETTINGS['max_buffer']
+            )
+            # Covers interpreter shutdown, gunicorn also flushes from worker_exit
+            atexit.register(_usage_recorder.flush)
+        return _usage_recorder
+
+def record_usage(organization: Organization, feature: str, tokens: int, cost) -> None:
+    cost = Decimal(str(cost)).quantize(Decimal('0.0001'))
+    if settings.USAGE_SETTINGS['buffered']:
+        get_usage_recorder().record(organization.id, feature, tokens, cost)
+        return
+
+    with transaction.atomic():
+        usage = Usage.objects.create(
+            organization=organization,
+            feature=feature,
+            tokens=tokens,
+            cost=cost
+        )
+        increment_rollups(_rollup_rows([usage]))
+
+def increment_rollups(rows: List[Tuple]) -> None:
+    # rows are (organization_id, feature, bucket, tokens, cost, requests)
+    if not rows:
+        return
+
+    table = UsageRollup._meta.db_table
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(rows))
+    params = [value for row in rows for value in row]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (organization_id, feature, bucket, tokens, cost, requests)
+            VALUES {placeholders}
+            ON CONFLICT (organization_id, feature, bucket) DO UPDATE SET
+                tokens = {table}.tokens + EXCLUDED.tokens,
+                cost = {table}.cost + EXCLUDED.cost,
+                requests = {table}.requests + EXCLUDED.requests
+            """,
+            params
+        )
+
+def rebuild_usage_rollups(since: Optional[datetime] = None) -> None:
+    # Backfills the rollup table from raw Usage rows, e.g. after first deploying it
+    usage = Usage.objects.all()
+    rollups = UsageRollup.objects.all()
+    if since is not None:
+        since = hour_bucket(since)
+        usage = usage.filter(timestamp__gte=since)
+        rollups = rollups.filter(bucket__gte=since)
+
+    totals = usage.annotate(bucket=TruncHour('timestamp')).values(
+        'organization_id', 'feature', 'bucket'
+    ).annotate(tokens_sum=Sum('tokens'), cost_sum=Sum('cost'), requests=Count('id'))
+
+    with transaction.atomic():
+        rollups.delete()
+        UsageRollup.objects.bulk_create([
+            UsageRollup(
+                organization_id=row['organization_id'],
+                feature=row['feature'],
+                bucket=row['bucket'],
+                tokens=row['tokens_sum'],
+                cost=row['cost_sum'],
+                requests=row['requests']
+            )
+            for row in totals.iterator()
+        ], batch_size=1000)
+
+def usage_summary(organization: Organization, start: datetime, end: datetime,
+                  granularity: str = 'total') -> Dict:
+    # Whole hours come from the rollup table, only the partial hours at both
+    # edges of the window are aggregated from raw Usage rows
+    rollup_start = hour_bucket(start)
+    if rollup_start < start:
+        rollup_start += timedelta(hours=1)
+    rollup_end = hour_bucket(end)
+
+    trunc = GRANULARITIES.get(granularity)
+    rollup_fields = ['feature']
+    raw_fields = ['feature']
+    rollups = UsageRollup.objects.filter(organization=organization)
+    raw = Usage.objects.filter(organization=organization)
+    if trunc is not None:
+        rollups = rollups.annotate(period=trunc('bucket'))
+        raw = raw.annotate(period=trunc('timestamp'))
+        rollup_fields.append('period')
+        raw_fields.append('period')
+
+    if rollup_start < rollup_end:
+        rollups = rollups.filter(bucket__gte=rollup_start, bucket__lt=rollup_end)
+        raw = raw.filter(
+            Q(timestamp__gte=start, timestamp__lt=rollup_start) |
+            Q(timestamp__gte=rollup_end, timestamp__lte=end)
+        )
+    else:
+        rollups = rollups.none()
+        raw = raw.filter(timestamp__gte=start, timestamp__lte=end)
+
+    totals = defaultdict(lambda: {'cost': Decimal('0'), 'tokens': 0})
+    for queryset, fields in ((rollups, rollup_fields), (raw, raw_fields)):
+        for row in queryset.values(*fields).annotate(cost_sum=Sum('cost'), tokens_sum=Sum('tokens')):
+            key = (row['feature'], row.get('period'))
+            totals[key]['cost'] += row['cost_sum'] or 0
+            totals[key]['tokens'] += row['tokens_sum'] or 0
+
+    stats = {
+        'total_cost': sum((t['cost'] for t in totals.values()), Decimal('0')),
+        'total_tokens': sum(t['tokens'] for t in totals.values()),
+        'by_feature': {}
+    }
+    for (feature, _), t in totals.items():
+        by_feature = stats['by_feature'].setdefault(feature, {'cost': Decimal('0'), 'tokens': 0})
+        by_feature['cost'] += t['cost']
+        by_feature['tokens'] += t['tokens']
+
+    if trunc is not None:
+        stats['series'] = [
+            {'period': period, 'feature': feature, 'cost': t['cost'], 'tokens': t['tokens']}
+            for (feature, period), t in sorted(totals.items(), key=lambda item: (item[0][1], item[0][0]))
+        ]
+
+    return stats
+
+def parse_timeframe(timeframe: str, end: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    # Accepts the dashboard presets (24h, 7d, 30d) and any other <n>h / <n>d window
+    end = end or timezone.now()
+    unit = timeframe[-1:]
+    amount = int(timeframe[:-1])
+    if amount <= 0:
+        raise ValueError(f"Timeframe must be positive: {timeframe}")
+    if unit == 'h':
+        return end - timedelta(hours=amount), end
+    if unit == 'd':
+        return end - timedelta(days=amount), end
+    raise ValueError(f"Unsupported timeframe: {timeframe}")
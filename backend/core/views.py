@@ -1,103 +1,155 @@
-from rest_framework import viewsets
+from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from .agents import AIAgent
-from .models import Organization, Usage, CloudResource, ResourceMetric, SocialConversation, SocialMessage
+from .agents import get_agent
+from . import services
+from .channels import parse_webhook, verify_signature
+from .models import AgentJob, InboundEvent
+from .tasks import JOB_HANDLERS, handle_inbound_events, job_representation, submit_job
 from django.conf import settings
-import pandas as pd
-from datetime import datetime, timedelta
+from django.http import HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+import hmac
+import json
+import logging
 
-class AIAgentViewSet(viewsets.ViewSet):
+logger = logging.getLogger(__name__)
+
+class AsyncJobMixin:
+    # Agent endpoints either answer inline or queue an AgentJob and return 202
+    def run_async(self, request) -> bool:
+        value = request.data.get('async', settings.AGENT_SETTINGS['async_by_default'])
+        if isinstance(value, str):
+            return value.lower() in ('1', 'true', 'yes')
+        return bool(value)
+
+    def dispatch_job(self, request, kind: str, payload):
+        organization = request.user.organization
+        if not self.run_async(request):
+            return Response(JOB_HANDLERS[kind](organization, **payload))
+        return self.queue_job(request, kind, payload)
+
+    def queue_job(self, request, kind: str, payload):
+        try:
+            job = submit_job(request.user.organization, kind, payload, request.data.get('callback_url'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data = job_representation(job)
+        data['status_url'] = request.build_absolute_uri(
+            reverse(f'{self.basename}-job-status', kwargs={'job_id': str(job.id)})
+        )
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>[0-9a-f-]{36})')
+    def job_status(self, request, job_id=None):
+        job = AgentJob.objects.filter(id=job_id, organization=request.user.organization).first()
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job_representation(job))
+
+class AIAgentViewSet(AsyncJobMixin, viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.agent = AIAgent(
-            api_key=settings.OPENAI_API_KEY,
-            prometheus_url=settings.DEVOPS_SETTINGS.get('prometheus_url')
-        )
+        self.agent = get_agent()
 
     @action(detail=False, methods=['post'])
     def process_email(self, request):
-        # Reference existing EmailAssistantViewSet implementation
-        startLine: 17
-        endLine: 40
+        return self.dispatch_job(request, 'email', {
+            'email_content': request.data.get('email_content'),
+            'subject': request.data.get('subject'),
+            'sender_email': request.data.get('sender_email'),
+            'message_id': request.data.get('message_id'),
+            'in_reply_to': request.data.get('in_reply_to'),
+            'references': request.data.get('references'),
+        })
 
     @action(detail=False, methods=['post'])
     def analyze_infrastructure(self, request):
-        organization = request.user.organization
-        resource_id = request.data.get('resource_id')
-        
-        resource = CloudResource.objects.get(
-            id=resource_id, 
-            organization=organization
-        )
-        
-        metrics = ResourceMetric.objects.filter(
-            resource=resource,
-            timestamp__gte=datetime.now() - timedelta(hours=24)
-        )
-        
-        df = pd.DataFrame(list(metrics.values()))
-        analysis = self.agent.analyze_resource_health(df, resource.configuration)
-        
-        # Track usage
-        Usage.objects.create(
-            organization=organization,
-            feature='infrastructure_analysis',
-            tokens=len(str(metrics)) // 4,
-            cost=0.002 * (len(str(metrics)) // 4000)
-        )
-        
-        return Response(analysis.dict()) 
+        # Checked here so a bad window is a 400 rather than a failed job
+        try:
+            services.health_window(request.data.get('window', '24h'), request.data.get('resolution'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return self.dispatch_job(request, 'infrastructure', {
+            'resource_id': request.data.get('resource_id'),
+            'window': request.data.get('window', '24h'),
+            'resolution': request.data.get('resolution'),
+        })
 
     @action(detail=False, methods=['post'])
     def process_social_message(self, request):
-        platform = request.data.get('platform')
-        contact_id = request.data.get('contact_id')
-        message_content = request.data.get('message')
+        return self.dispatch_job(request, 'social_message', {
+            'platform': request.data.get('platform'),
+            'contact_id': request.data.get('contact_id'),
+            'message': request.data.get('message'),
+        })
+
+    @action(detail=False, methods=['post'])
+    def stream_social_message(self, request):
         organization = request.user.organization
-        
-        # Obtener o crear conversación
-        conversation, created = SocialConversation.objects.get_or_create(
-            organization=organization,
-            platform=platform,
-            contact_id=contact_id
-        )
-        
-        # Obtener historial y contexto
-        history = SocialMessage.objects.filter(
-            conversation=conversation
-        ).order_by('-timestamp')[:10].values()
-        
-        # Procesar mensaje con contexto
-        analysis = self.agent.process_social_message(
-            message_content,
-            history,
-            conversation.stage,
-            conversation.context_data
-        )
-        
-        # Guardar mensaje y análisis
-        SocialMessage.objects.create(
-            conversation=conversation,
-            is_from_contact=True,
-            content=message_content,
-            intent=analysis.intent,
-            sentiment=analysis.sentiment
+        events = services.stream_social_message(
+            organization,
+            request.data.get('platform'),
+            request.data.get('contact_id'),
+            request.data.get('message')
         )
-        
-        # Actualizar conversación y contexto
-        conversation.stage = analysis.suggested_stage
-        conversation.lead_score += analysis.lead_score_delta
-        conversation.context_data = analysis.updated_context
-        conversation.last_intent = analysis.intent.get('type')
-        conversation.save()
-        
-        return Response({
-            'suggested_response': analysis.suggested_response,
-            'stage': analysis.suggested_stage,
-            'lead_score': conversation.lead_score,
-            'context': conversation.context_data
-        })
\ No newline at end of file
+
+        def stream():
+            # Server-sent events: "token" for each piece of the reply, "done" with the stored analysis
+            try:
+                for item in events:
+                    if isinstance(item, str):
+                        yield f"event: token\ndata: {json.dumps({'text': item})}\n\n"
+                    else:
+                        yield f"event: done\ndata: {json.dumps(item)}\n\n"
+            except Exception:
+                logger.exception("Streaming social message for organization %s failed", organization.id)
+                yield f"event: error\ndata: {json.dumps({'error': 'Message processing failed'})}\n\n"
+
+        response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Keeps nginx from buffering the stream until it completes
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def meta_webhook(request):
+    # Meta retries anything that isn't answered quickly, so the request only verifies, stores
+    # and queues. The LLM work and the reply happen on the workers, see core.tasks
+    meta = settings.SOCIAL_SETTINGS['meta']
+    if request.method == 'GET':
+        # Subscription handshake from the Meta app dashboard
+        if (request.GET.get('hub.mode') == 'subscribe' and meta['verify_token'] and
+                hmac.compare_digest(request.GET.get('hub.verify_token', ''), meta['verify_token'])):
+            return HttpResponse(request.GET.get('hub.challenge', ''), content_type='text/plain')
+        return HttpResponse(status=403)
+
+    if not meta['app_secret'] or not verify_signature(request.body, request.headers.get('X-Hub-Signature-256'),
+                                                      meta['app_secret']):
+        return HttpResponse(status=403)
+    try:
+        messages = parse_webhook(json.loads(request.body))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        logger.warning("Unparseable Meta webhook payload")
+        return HttpResponse(status=400)
+
+    if messages:
+        # Redeliveries hit the unique (platform, message_id) constraint and are dropped here
+        InboundEvent.objects.bulk_create([
+            InboundEvent(platform=message.platform, message_id=message.message_id,
+                         channel_external_id=message.channel_external_id, contact_id=message.contact_id,
+                         text=message.text, payload=message.payload)
+            for message in messages
+        ], ignore_conflicts=True)
+        by_platform = {}
+        for message in messages:
+            by_platform.setdefault(message.platform, []).append(message.message_id)
+        for platform, message_ids in by_platform.items():
+            handle_inbound_events.delay(platform, message_ids)
+    return HttpResponse(status=200)
@@ -0,0 +1,15 @@
+# Picked up automatically by gunicorn from the working directory (/app)
+import os
+
+bind = '0.0.0.0:8000'
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+def post_worker_init(worker):
+    # Django is loaded at this point, build the shared agent before the first request
+    from core.agents import warm_up
+    warm_up()
+
+def worker_exit(server, worker):
+    # Write out usage records still buffered in this worker before it goes away
+    from core.usage import get_usage_recorder
+    get_usage_recorder().flush()